@@ -3,6 +3,8 @@ import subprocess
 import whisper
 import time # 引入 time 模組
 import sys # <--- 加入 sys 模組
+from file_utils import file_sha256
+from transcript_meta import write_transcript_meta # 轉錄稿的結構化中繼資料 sidecar
 
 # 定義要處理的影片檔案格式 (保持不變)
 VALID_EXTENSIONS = [".mp4", ".mov", ".avi", ".mkv", ".mp4 的副本"]
@@ -35,16 +37,21 @@ def get_video_duration(video_path, log_callback):
 
 # 定義函式進行語音轉文字
 def transcribe_video(model, video_path, log_callback):
-    """使用 Whisper 模型轉錄影片，並透過 log_callback 回報錯誤。"""
+    """
+    使用 Whisper 模型轉錄影片，並透過 log_callback 回報錯誤。
+
+    Returns:
+        tuple: (轉錄文字, 段落數, 語言)；失敗時為 ("", 0, "zh")。
+    """
     try:
         result = model.transcribe(video_path, language='zh') # 明確指定語言為中文
         transcription = result.get('text', '')
         if not transcription.strip():
              log_callback(f"【警告】影片轉錄結果為空，請確認影片內容：{os.path.basename(video_path)}")
-        return transcription
+        return transcription, len(result.get('segments', [])), result.get('language', 'zh')
     except Exception as e:
         log_callback(f"【錯誤】影片轉錄失敗 {os.path.basename(video_path)}: {e}")
-        return ""
+        return "", 0, "zh"
 
 # ---- 主要處理函數 ----
 def process_videos(video_folder, output_folder, model_size="large", log_callback=print):
@@ -162,7 +169,7 @@ def process_videos(video_folder, output_folder, model_size="large", log_callback
             # 呼叫 Whisper 進行語音轉文字
             start_time = time.time()
             log_callback("【日誌】開始轉錄...")
-            transcription = transcribe_video(model, video_path, log_callback)
+            transcription, segment_count, language = transcribe_video(model, video_path, log_callback)
             end_time = time.time()
             log_callback(f"【日誌】影片轉錄完成，耗時: {end_time - start_time:.2f} 秒。")
 
@@ -183,6 +190,13 @@ def process_videos(video_folder, output_folder, model_size="large", log_callback
             except Exception as e:
                 log_callback(f"【錯誤】儲存檔案失敗 {output_filename}: {e}")
                 skipped_count += 1
+                continue
+
+            # 寫入 sidecar (長度、模型、段落數、語言、內容雜湊)，後續步驟不必再解析全文標頭
+            try:
+                write_transcript_meta(output_path, duration, model_size, segment_count, language, file_sha256(output_path))
+            except Exception as e:
+                log_callback(f"【警告】儲存轉錄中繼資料失敗 {output_filename}: {e}")
         # else:
             # 可以選擇性地記錄非影片檔案
             # log_callback(f"【忽略】非目標影片格式檔案: {filename}")
@@ -1,11 +1,23 @@
 import os
 import json
+import hashlib
 import requests
 import re # 用於從文字中提取影片長度
-import docx # 導入docx處理庫
-
-# Gemini API Endpoint (模型可以根據需求調整)
-GEMINI_API_ENDPOINT = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-pro-exp-02-05:generateContent?key={api_key}"
+import docx # 導入docx處理庫 (串流擷取失敗時的備用方案)
+from api_retry import post_with_retry # 429/5xx 重試與斷路器
+from token_utils import estimate_tokens, excerpt_transcript # 本地 token 估算與節錄
+from local_classifier import LocalClassifier, TEACHING_TARGET # 以歷史標籤訓練的本地分類器 (選用)
+from file_utils import file_sha256, read_text_with_sha256, atomic_write_json, load_json
+from transcript_meta import load_transcript_meta # Step1 產生的轉錄稿 sidecar
+from docx_text import read_docx_text # 串流 DOCX 擷取 + 擷取結果快取
+from model_router import ModelRouter # 依輸入大小選擇模型 + 備援模型
+
+# 增量分類快取 (與 labels.json 放在同一資料夾)：記錄每個檔案的內容雜湊、分類條件與標籤
+LABELS_CACHE_FILENAME = "labels_cache.json"
+
+# Gemini API Endpoint (模型可以根據需求調整，或由模型路由表依輸入大小選擇)
+GEMINI_API_ENDPOINT = "https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key}"
+DEFAULT_MODEL = "gemini-2.0-pro-exp-02-05" # 路由表沒有符合的 classify 路由時使用
 HEADERS = {"Content-Type": "application/json"}
 
 # --- Prompts for Gemini ---
@@ -22,6 +34,35 @@ PROMPT_ORIGINAL = """
 請只回傳以上其中一個分類結果，且必須包含分類號碼，例如 "分類2: 影片有教學（內容完整，可獨立使用）"。不要包含其他多餘的說明。
 """
 
+# 拆解版的原始分類：長度由本地判斷，模型只需回答「是否為教學」
+PROMPT_TEACHING = """
+請閱讀以下影片轉錄內容，判斷這支影片是否「有教學」(講解觀念、步驟或方法，內容可獨立學習)，
+或只是「示範/播放輔助影片」(現場示範、實作片段、輔助播放等)。判斷不用特別嚴格。
+{transcription}
+
+請以 JSON 回傳：{{"is_teaching": true}} 或 {{"is_teaching": false}}，不要包含其他說明。
+"""
+
+# 結構化輸出設定：只允許一個布林值，並限制輸出長度
+TEACHING_GENERATION_CONFIG = {
+    "temperature": 0,
+    "maxOutputTokens": 16,
+    "responseMimeType": "application/json",
+    "responseSchema": {
+        "type": "OBJECT",
+        "properties": {"is_teaching": {"type": "BOOLEAN"}},
+        "required": ["is_teaching"]
+    }
+}
+
+# 與 PROMPT_ORIGINAL 完全相同的四個分類標籤 (Step3 兩兩配對依賴 "分類2:" 前綴)
+ORIGINAL_LABELS = {
+    1: "分類1: 影片有教學，但影片長度不足2分鐘",
+    2: "分類2: 影片有教學（內容完整，可獨立使用）",
+    3: "分類3: 示範/播放輔助影片且影片長度超過2分鐘",
+    4: "分類4: 示範/播放輔助影片且影片長度不超過2分鐘",
+}
+
 PROMPT_TOPIC = """
 請仔細閱讀以下影片轉錄內容，判斷其主要內容主題。
 內容包含影片資訊和轉錄文字：
@@ -35,6 +76,10 @@ PROMPT_TOPIC = """
 
 def read_docx(filepath, log_callback):
     """讀取docx檔案內容"""
+    try:
+        return read_docx_text(filepath)
+    except Exception as e:
+        log_callback(f"【警告】快速擷取 DOCX 失敗 {os.path.basename(filepath)}: {e}，改用 python-docx 讀取。")
     try:
         doc = docx.Document(filepath)
         full_text = [para.text for para in doc.paragraphs]
@@ -69,18 +114,39 @@ def extract_duration_from_text(text):
             return None
     return None
 
-def call_gemini_api(api_key, prompt_text, log_callback):
+def classify_by_duration(duration):
+    """依影片長度 (秒) 給出 "影片長度 (無需 API)" 條件的標籤"""
+    return "長度<2分鐘" if duration < 120 else "長度>=2分鐘"
+
+def assemble_original_label(is_teaching, duration):
+    """依「是否教學」與影片長度 (秒) 組出原始四分類標籤"""
+    if is_teaching:
+        return ORIGINAL_LABELS[1] if duration < 120 else ORIGINAL_LABELS[2]
+    return ORIGINAL_LABELS[3] if duration > 120 else ORIGINAL_LABELS[4]
+
+def parse_teaching_result(result_text):
+    """解析 PROMPT_TEACHING 的 JSON 回應，無法解析時回傳 None"""
+    try:
+        value = json.loads(result_text).get("is_teaching")
+    except (ValueError, AttributeError):
+        return None
+    return value if isinstance(value, bool) else None
+
+def call_gemini_api(api_key, prompt_text, log_callback, generation_config=None, model_name=DEFAULT_MODEL):
     """呼叫 Gemini API 並處理回應"""
     if not api_key:
         log_callback("【錯誤】未提供 Gemini API 金鑰。")
         return None
 
-    endpoint = GEMINI_API_ENDPOINT.format(api_key=api_key)
+    endpoint = GEMINI_API_ENDPOINT.format(model_name=model_name, api_key=api_key)
     payload = {"contents": [{"parts": [{"text": prompt_text}]}]}
+    if generation_config:
+        payload["generationConfig"] = generation_config
 
     try:
         log_callback("【日誌】呼叫 Gemini API 中...")
-        response = requests.post(endpoint, headers=HEADERS, data=json.dumps(payload), timeout=60) # 增加超時設定
+        # 429/5xx 會依退避策略自動重試，重試用盡仍失敗才回傳錯誤狀態碼
+        response = post_with_retry(endpoint, payload, log_callback, timeout=60, headers=HEADERS) # 增加超時設定
 
         if response.status_code == 403:
              log_callback("【錯誤】Gemini API 金鑰無效或權限不足。請檢查您的 API 金鑰設定。")
@@ -126,6 +192,30 @@ def call_gemini_api(api_key, prompt_text, log_callback):
         return None
 
 
+def build_criteria_key(classification_criteria, excerpt_max_tokens, excerpt_strategy):
+    """將分類條件、使用的 Prompt 與節錄設定組成快取鍵；任何一項改變都需要重新分類"""
+    prompts = {
+        "教學/示範 & 長度 (需 API)": PROMPT_ORIGINAL,
+        "教學/示範 (長度本地判斷，需 API)": PROMPT_TEACHING + PROMPT_ORIGINAL,
+        "主要內容主題 (需 API)": PROMPT_TOPIC,
+    }
+    prompt = prompts.get(classification_criteria, "")
+    if prompt:
+        signature = f"{classification_criteria}|{excerpt_max_tokens or 0}|{excerpt_strategy}|{prompt}"
+    else:
+        signature = classification_criteria # 不需 API 的條件與 Prompt、節錄設定無關
+    return hashlib.sha256(signature.encode('utf-8')).hexdigest()[:16]
+
+def load_labels_cache(cache_path, log_callback):
+    """讀取增量分類快取，回傳 {filename: {"hash", "criteria_key", "label"}}"""
+    if not os.path.exists(cache_path):
+        return {}
+    cache = load_json(cache_path)
+    if not isinstance(cache, dict) or not isinstance(cache.get("files"), dict):
+        log_callback(f"【警告】增量分類快取格式錯誤，將重新分類所有檔案: {cache_path}")
+        return {}
+    return cache["files"]
+
 def generate_url_config(processed_files_info, config_path, log_callback):
     """生成或更新包含已分類影片的 URL 配置 JSON 檔案"""
     existing_config = {}
@@ -166,7 +256,11 @@ def generate_url_config(processed_files_info, config_path, log_callback):
          log_callback(f"【錯誤】儲存 URL 配置檔案失敗: {e}")
 
 # --- Main Classification Function ---
-def perform_classification(transcription_folder, label_folder, url_config_path, api_key, classification_criteria, log_callback=print):
+def perform_classification(transcription_folder, label_folder, url_config_path, api_key, classification_criteria, log_callback=print,
+                           excerpt_max_tokens=None, excerpt_strategy="head_middle_tail",
+                           local_model_path=None, local_confidence=None, local_min_accuracy=0.9,
+                           incremental=True, content_cache=None, duplicate_of=None,
+                           model_routes=None, fallback_model=None, route_stats_path=None, content_hashes=None):
     """
     執行轉錄稿的分類。
 
@@ -177,6 +271,21 @@ def perform_classification(transcription_folder, label_folder, url_config_path,
         api_key (str): Gemini API 金鑰 (如果選擇的條件需要)。
         classification_criteria (str): 分類條件選項。
         log_callback (callable): 日誌回呼函數。
+        excerpt_max_tokens (int): 送進分類 Prompt 的轉錄內文估計 token 上限，None 或 0 表示送出全文。
+        excerpt_strategy (str): 節錄取樣方式 ("head", "head_tail", "head_middle_tail")。
+        local_model_path (str): 本地分類器模型路徑 (由 local_classifier.py train 產生)，None 表示停用。
+        local_confidence (float): 本地分類器信心度門檻，None 表示使用訓練時的設定。
+        local_min_accuracy (float): 模型保留資料準確率低於此值時不啟用。
+        incremental (bool): 內容與分類條件都未變更的檔案沿用上次的標籤，只對新增或變更的檔案分類。
+        content_cache (ContentCache): 讀取到的檔案內容會放入此快取 (可選)，供 Step3 合併時直接使用。
+        duplicate_of (dict): {重複檔名: 代表檔名} 近似重複偵測結果 (可選)；重複檔案不另外分類，沿用代表檔案的標籤
+            (代表檔案沒有分類結果時仍照常分類)。
+        model_routes (list): 模型路由表 (見 model_router.py)，task 為 "classify" 的路由依送出內容的估計 token 數選擇模型，
+            都不符合時使用 DEFAULT_MODEL。
+        fallback_model (str): API 呼叫因暫時性錯誤 (重試用盡的 429/5xx、網路錯誤) 失敗時改用的備援模型 (可選)。
+        route_stats_path (str): 模型路由統計的累計檔案 (JSON)，None 表示只寫入日誌。
+        content_hashes (dict): 每個檔案的內容雜湊會寫入此 dict ({檔名: SHA-256}，可選)，
+            供 Step3 的合併清單直接使用，不再重新讀取檔案計算。
 
     Returns:
         dict: 包含 {filename: classification_result} 的字典，如果成功。
@@ -191,10 +300,11 @@ def perform_classification(transcription_folder, label_folder, url_config_path,
 
     os.makedirs(label_folder, exist_ok=True) # 確保標籤輸出目錄存在
     labels_output_path = os.path.join(label_folder, "labels.json")
+    labels_cache_path = os.path.join(label_folder, LABELS_CACHE_FILENAME)
 
     labels_dict = {}
     processed_files_info = [] # 用於生成 URL 配置
-    needs_api = classification_criteria in ["教學/示範 & 長度 (需 API)", "主要內容主題 (需 API)"]
+    needs_api = classification_criteria in ["教學/示範 & 長度 (需 API)", "教學/示範 (長度本地判斷，需 API)", "主要內容主題 (需 API)"]
 
     if needs_api and not api_key:
          log_callback("【錯誤】選擇的分類條件需要 API 金鑰，但未提供。")
@@ -203,41 +313,160 @@ def perform_classification(transcription_folder, label_folder, url_config_path,
     files_to_process = [f for f in os.listdir(transcription_folder) if f.lower().endswith((".txt", ".docx"))]
     total_files = len(files_to_process)
     log_callback(f"【日誌】找到 {total_files} 個轉錄檔案，開始處理...")
-
-    for idx, filename in enumerate(files_to_process, start=1):
+    if needs_api and excerpt_max_tokens:
+        log_callback(f"【日誌】分類 Prompt 將節錄轉錄內容 (上限約 {excerpt_max_tokens} tokens，策略: {excerpt_strategy})")
+
+    # 增量分類：讀取上次的標籤快取，只保留本次仍存在的檔案
+    criteria_key = build_criteria_key(classification_criteria, excerpt_max_tokens, excerpt_strategy)
+    previous_cache = load_labels_cache(labels_cache_path, log_callback) if incremental else {}
+    new_cache = {}
+    reused_count = 0
+
+    # 本地分類器：高信心度的檔案直接給標籤，其餘才送 API
+    local_classifier = None
+    if needs_api and local_model_path:
+        local_classifier = LocalClassifier.load(local_model_path, classification_criteria, local_min_accuracy,
+                                                local_confidence, log_callback)
+    local_count = 0
+
+    model_router = ModelRouter(model_routes, DEFAULT_MODEL, fallback_model, log_callback) if needs_api else None
+
+    # 節錄統計 (用於回報本次節省的 token 數)
+    full_tokens_total = 0
+    sent_tokens_total = 0
+
+    # 近似重複的檔案排在最後處理：代表檔案已有分類結果時直接沿用 (不呼叫 API)，否則照常分類
+    duplicate_of = duplicate_of or {}
+    deduplicated_count = 0
+    ordered_files = sorted(files_to_process, key=lambda f: f in duplicate_of) # 穩定排序，其餘順序不變
+    for idx, filename in enumerate(ordered_files, start=1):
         file_path = os.path.join(transcription_folder, filename)
+        if filename in duplicate_of:
+            representative_label = labels_dict.get(duplicate_of[filename])
+            if representative_label is not None and representative_label != "分類失敗":
+                labels_dict[filename] = representative_label
+                deduplicated_count += 1
+                processed_files_info.append({
+                    "name": os.path.splitext(filename)[0],
+                    "category": representative_label
+                })
+                continue
+            log_callback(f"【警告】{filename} 的代表檔案 {duplicate_of[filename]} 沒有分類結果，改為直接分類此檔案。")
         log_callback(f"\n====== 處理檔案 {idx}/{total_files}：{filename} ======")
 
-        content = read_file_content(file_path, log_callback)
-        if content is None:
-            continue # 讀取失敗，跳過
+        # sidecar 有效時直接使用其中的內容雜湊與長度，不必讀取整份轉錄稿；
+        # 沒有 sidecar 的 .txt 一次讀入內容並計算雜湊 (內容放入快取，Step3 不必再讀)
+        meta = load_transcript_meta(file_path)
+        meta_duration = meta.get("duration") if meta else None
+        content = None
+        try:
+            if meta:
+                file_hash = meta["content_hash"]
+            elif filename.lower().endswith('.txt'):
+                content, file_hash = read_text_with_sha256(file_path)
+                if content_cache is not None:
+                    content_cache.put(filename, content)
+            else:
+                file_hash = file_sha256(file_path)
+        except (OSError, UnicodeDecodeError) as e:
+            log_callback(f"【錯誤】讀取檔案失敗 {filename}: {e}")
+            continue
+        if content_hashes is not None:
+            content_hashes[filename] = file_hash
+
+        cached = previous_cache.get(filename)
+        if cached and cached.get("hash") == file_hash and cached.get("criteria_key") == criteria_key:
+            # 內容與分類條件都沒變，直接沿用上次的標籤 (不讀內容、不呼叫 API)
+            log_callback(f"【日誌】內容未變更，沿用上次的分類: {cached['label']}")
+            reused_count += 1
+            new_cache[filename] = cached
+            labels_dict[filename] = cached["label"]
+            processed_files_info.append({
+                "name": os.path.splitext(filename)[0],
+                "category": cached["label"]
+            })
+            continue
+
+        if content is None and not (classification_criteria == "影片長度 (無需 API)" and meta_duration is not None):
+            if content_cache is not None:
+                content = content_cache.get(filename) # 近似重複偵測時可能已讀過
+            if content is None:
+                content = read_file_content(file_path, log_callback)
+                if content is None:
+                    continue # 讀取失敗，跳過
+                if content_cache is not None:
+                    content_cache.put(filename, content)
 
         classification_result = "分類失敗" # 預設值
 
+        local_label = None
+        if local_classifier is not None:
+            local_label, local_confidence_value = local_classifier.predict(content)
+            if local_label is None:
+                log_callback(f"【日誌】本地分類器信心度不足 ({local_confidence_value:.2f})，改用 API 分類。")
+            elif local_classifier.target == TEACHING_TARGET:
+                # 模型只判斷是否教學，長度與 API 路徑相同由本地依實際影片長度組合
+                duration = meta_duration if meta_duration is not None else extract_duration_from_text(content)
+                if duration is None:
+                    log_callback("【日誌】無法取得影片長度，本地分類器結果不採用，改用 API 分類。")
+                    local_label = None
+                else:
+                    local_label = assemble_original_label(local_label, duration)
+
         # --- 根據條件進行分類 ---
         if classification_criteria == "影片長度 (無需 API)":
-            duration = extract_duration_from_text(content)
+            duration = meta_duration if meta_duration is not None else extract_duration_from_text(content)
             if duration is not None:
-                if duration < 120:
-                    classification_result = "長度<2分鐘"
-                else:
-                    classification_result = "長度>=2分鐘"
+                classification_result = classify_by_duration(duration)
                 log_callback(f"【日誌】根據影片長度 ({duration:.2f} 秒) 分類為: {classification_result}")
             else:
                 log_callback(f"【警告】無法從檔案內容提取影片長度，無法進行基於長度的分類。")
                 classification_result = "長度未知"
 
+        elif needs_api and local_label is not None:
+            classification_result = local_label
+            local_count += 1
+            log_callback(f"【日誌】本地分類器判定為: {classification_result} (信心度 {local_confidence_value:.2f})，不呼叫 API")
+
         elif needs_api:
-            if classification_criteria == "教學/示範 & 長度 (需 API)":
-                prompt_text = PROMPT_ORIGINAL.format(transcription=content)
+            # 分類通常只需要幾分鐘的內容，先節錄再放進 Prompt (標頭的影片長度會完整保留)
+            prompt_content = excerpt_transcript(content, excerpt_max_tokens, excerpt_strategy)
+            full_tokens = estimate_tokens(content)
+            sent_tokens = estimate_tokens(prompt_content)
+            full_tokens_total += full_tokens
+            sent_tokens_total += sent_tokens
+            if sent_tokens < full_tokens:
+                log_callback(f"【日誌】已節錄轉錄內容：約 {full_tokens} -> {sent_tokens} tokens")
+
+            generation_config = None
+            duration = None
+            if classification_criteria == "教學/示範 (長度本地判斷，需 API)":
+                duration = meta_duration if meta_duration is not None else extract_duration_from_text(content)
+                if duration is not None:
+                    prompt_text = PROMPT_TEACHING.format(transcription=prompt_content)
+                    generation_config = TEACHING_GENERATION_CONFIG
+                else:
+                    # 沒有長度資訊時退回由模型同時判斷長度的原始 Prompt
+                    log_callback(f"【警告】無法從檔案內容提取影片長度，改用完整分類 Prompt。")
+                    prompt_text = PROMPT_ORIGINAL.format(transcription=prompt_content)
+            elif classification_criteria == "教學/示範 & 長度 (需 API)":
+                prompt_text = PROMPT_ORIGINAL.format(transcription=prompt_content)
             elif classification_criteria == "主要內容主題 (需 API)":
-                prompt_text = PROMPT_TOPIC.format(transcription=content)
+                prompt_text = PROMPT_TOPIC.format(transcription=prompt_content)
             else: # 未知的 API 類型 (理論上不應發生)
                  log_callback(f"【錯誤】未知的 API 分類條件: {classification_criteria}")
                  continue
 
-            api_result = call_gemini_api(api_key, prompt_text, log_callback)
-            if api_result is not None:
+            api_result = model_router.call("classify", prompt_text, lambda model: call_gemini_api(
+                api_key, prompt_text, log_callback, generation_config=generation_config, model_name=model), log_callback)
+            if api_result is not None and generation_config is not None:
+                is_teaching = parse_teaching_result(api_result)
+                if is_teaching is not None:
+                    classification_result = assemble_original_label(is_teaching, duration)
+                    log_callback(f"【日誌】根據影片長度 ({duration:.2f} 秒) 與教學判斷組合分類為: {classification_result}")
+                else:
+                    log_callback(f"【錯誤】無法解析教學/示範判斷結果: {api_result}")
+            elif api_result is not None:
                 classification_result = api_result
             else:
                 # API 呼叫失敗或結果為空，保留 "分類失敗"
@@ -248,6 +477,8 @@ def perform_classification(transcription_folder, label_folder, url_config_path,
 
         # --- 儲存結果 ---
         labels_dict[filename] = classification_result
+        if classification_result != "分類失敗": # 失敗的檔案下次仍需重新分類
+            new_cache[filename] = {"hash": file_hash, "criteria_key": criteria_key, "label": classification_result}
         video_name = os.path.splitext(filename)[0]
         processed_files_info.append({
             "name": video_name,
@@ -256,6 +487,21 @@ def perform_classification(transcription_folder, label_folder, url_config_path,
 
     # --- 分類循環結束 ---
 
+    if deduplicated_count:
+        log_callback(f"\n【日誌】近似重複：{deduplicated_count} 個檔案沿用代表檔案的標籤，未另外分類。")
+
+    if incremental:
+        log_callback(f"\n【日誌】增量分類：沿用 {reused_count} 個檔案的標籤，"
+                     f"重新分類 {total_files - reused_count - deduplicated_count} 個檔案。")
+
+    if local_classifier is not None:
+        log_callback(f"\n【日誌】本地分類器處理 {local_count} 個檔案，{total_files - local_count} 個檔案送 API 或讀取失敗。")
+
+    if needs_api and full_tokens_total:
+        saved_tokens = full_tokens_total - sent_tokens_total
+        log_callback(f"\n【日誌】節錄報告：轉錄內容約 {full_tokens_total} tokens，實際送出約 {sent_tokens_total} tokens，"
+                     f"節省約 {saved_tokens} tokens ({saved_tokens / full_tokens_total:.0%})")
+
     # 儲存分類標籤到 labels.json
     try:
         with open(labels_output_path, "w", encoding="utf-8") as f:
@@ -265,6 +511,18 @@ def perform_classification(transcription_folder, label_folder, url_config_path,
         log_callback(f"【錯誤】儲存分類標籤至檔案時失敗：{e}")
         # 即使儲存失敗，我們仍然可以回傳記憶體中的 labels_dict 供合併使用
 
+    # 儲存增量分類快取 (只保留本次存在的檔案)
+    try:
+        atomic_write_json(labels_cache_path, {"version": 1, "files": new_cache})
+    except Exception as e:
+        log_callback(f"【警告】儲存增量分類快取失敗：{e}，下次將重新分類所有檔案。")
+
+    # 模型路由統計 (用於調整路由門檻)
+    if model_router is not None:
+        model_router.report(log_callback)
+        if route_stats_path:
+            model_router.save_stats(route_stats_path, log_callback)
+
     # 生成/更新 URL 配置檔案
     generate_url_config(processed_files_info, url_config_path, log_callback)
 
@@ -284,6 +542,7 @@ if __name__ == "__main__":
 
     # --- 選擇要測試的分類條件 ---
     # criteria_to_test = "教學/示範 & 長度 (需 API)"
+    # criteria_to_test = "教學/示範 (長度本地判斷，需 API)"
     # criteria_to_test = "主要內容主題 (需 API)"
     criteria_to_test = "影片長度 (無需 API)"
 
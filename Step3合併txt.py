@@ -1,9 +1,16 @@
 import os
 import json
 import shutil
+import tempfile
 from collections import defaultdict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import re # 需要 re
-import docx # 導入docx處理庫 (如果需要讀取)
+import docx # 導入docx處理庫 (串流擷取失敗時的備用方案)
+from docx_text import read_docx_text # 串流 DOCX 擷取 + 擷取結果快取 (與 Step2 共用)
+from token_utils import estimate_tokens
+from merge_manifest import MergeManifest # 增量合併：只重建來源有變動的輸出
+from file_utils import copy_file_fast, atomic_write_text, replace_file, text_sha256
 
 # 設定各資料夾路徑 (修正轉義序列問題，使用原始字串r或雙反斜線)
 transcription_folder = r'G:\我的雲端硬碟\自動化生成文案\Transcriptions'
@@ -14,6 +21,10 @@ labels_file = r'G:\我的雲端硬碟\自動化生成文案\label\labels.json'
 # --- Helper Functions (與 Step2 共用，也可獨立定義或匯入) ---
 def read_docx_content(filepath, log_callback):
     """讀取docx檔案內容"""
+    try:
+        return read_docx_text(filepath)
+    except Exception as e:
+        log_callback(f"【警告】快速擷取 DOCX 失敗 {os.path.basename(filepath)}: {e}，改用 python-docx 讀取。")
     try:
         doc = docx.Document(filepath)
         full_text = [para.text for para in doc.paragraphs]
@@ -38,6 +49,14 @@ def read_file_content(filepath, log_callback):
         log_callback(f"【錯誤】讀取檔案內容失敗 {os.path.basename(filepath)}: {e}")
         return None
 
+def read_source_content(filename, transcription_folder, log_callback, content_cache=None):
+    """讀取來源轉錄稿；Step2 已讀過並放入內容快取的檔案直接取用，不再讀取磁碟"""
+    if content_cache is not None:
+        content = content_cache.get(filename)
+        if content is not None:
+            return content
+    return read_file_content(os.path.join(transcription_folder, filename), log_callback)
+
 def sanitize_filename(name):
     """移除或替換不適用於檔案名稱的字元"""
     # 移除常見的非法字元: < > : " / \ | ? *
@@ -47,8 +66,195 @@ def sanitize_filename(name):
     # 避免檔名過長 (可選)
     return name[:100] # 限制長度
 
+def write_text_file(dest_path, text):
+    """以 UTF-8 寫入文字檔"""
+    with open(dest_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+# copy_source_as_txt 的處理結果
+COPY_OK = "ok"
+COPY_READ_FAILED = "read_failed"
+COPY_WRITE_FAILED = "write_failed"
+
+def txt_output_path(folder, filename):
+    """來源檔對應的 .txt 輸出路徑"""
+    return os.path.join(folder, f"{os.path.splitext(filename)[0]}.txt")
+
+def copy_source_as_txt(filename, dest_folder, transcription_folder, log_callback, content_cache=None,
+                       passthrough=True, allow_hardlink=False):
+    """
+    讀取單一來源轉錄稿並以 .txt 寫入目的資料夾 (供執行緒池呼叫)。
+
+    內容已在 content_cache 中 (Step2 讀過) 時直接寫出，不再讀取來源；
+    否則 passthrough 為 True 時，.txt 來源不經過 Python 字串，直接以檔案層級複製
+    (硬連結 / reflink / 系統複製呼叫，見 file_utils.copy_file_fast)；只有 .docx 需要擷取文字。
+
+    Returns:
+        tuple: (處理結果, 來源檔名, 輸出檔名, 例外或 None)。
+    """
+    dest_filename = f"{os.path.splitext(filename)[0]}.txt" # 統一輸出為 txt
+    cached = content_cache.get(filename) if content_cache is not None else None
+    if cached is not None:
+        try:
+            atomic_write_text(os.path.join(dest_folder, dest_filename), cached)
+            return COPY_OK, filename, dest_filename, None
+        except Exception as e:
+            return COPY_WRITE_FAILED, filename, dest_filename, e
+    if passthrough and filename.lower().endswith('.txt'):
+        src_path = os.path.join(transcription_folder, filename)
+        if not os.path.isfile(src_path):
+            log_callback(f"【錯誤】讀取檔案內容失敗 {filename}: 檔案不存在")
+            return COPY_READ_FAILED, filename, dest_filename, None
+        try:
+            copy_file_fast(src_path, os.path.join(dest_folder, dest_filename), allow_hardlink)
+            return COPY_OK, filename, dest_filename, None
+        except Exception as e:
+            return COPY_WRITE_FAILED, filename, dest_filename, e
+    try:
+        content = read_source_content(filename, transcription_folder, log_callback, content_cache)
+        if content is None:
+            return COPY_READ_FAILED, filename, dest_filename, None
+        write_text_file(os.path.join(dest_folder, dest_filename), content)
+        return COPY_OK, filename, dest_filename, None
+    except Exception as e:
+        return COPY_WRITE_FAILED, filename, dest_filename, e
+
+def merge_pair_files(file1, file2, output_queue_folder, transcription_folder, log_callback, content_cache=None):
+    """
+    讀取兩個來源轉錄稿並合併寫入 "檔名1+檔名2.txt" (供執行緒池呼叫)。
+
+    Returns:
+        tuple: (file1, file2, 檔案1是否讀取成功, 檔案2是否讀取成功, 輸出檔名, 寫入例外或 None)；任一讀取失敗時不寫檔。
+    """
+    content1 = read_source_content(file1, transcription_folder, log_callback, content_cache)
+    content2 = read_source_content(file2, transcription_folder, log_callback, content_cache)
+    merged_filename = f"{os.path.splitext(file1)[0]}+{os.path.splitext(file2)[0]}.txt"
+    read_ok1, read_ok2 = content1 is not None, content2 is not None
+    if not (read_ok1 and read_ok2):
+        return file1, file2, read_ok1, read_ok2, merged_filename, None
+
+    header = f"來源檔案：{file1}, {file2}\n\n"
+    try:
+        write_text_file(os.path.join(output_queue_folder, merged_filename), header + content1 + PAIR_SEPARATOR + content2)
+        return file1, file2, read_ok1, read_ok2, merged_filename, None
+    except Exception as e:
+        return file1, file2, read_ok1, read_ok2, merged_filename, e
+
+def stream_merge_category(category, filenames, dest_path, transcription_folder, log_callback, content_cache=None):
+    """
+    將同一分類的轉錄稿依序串流寫入合併檔 (供執行緒池呼叫)。
+
+    讀到一份就立即寫出標頭與內容，記憶體中同時只保留一份轉錄稿；輸出與
+    "\\n".join([標題, 標頭+內容, ...]) 相同。先寫入同目錄的暫存檔，完成後才取代正式檔名，
+    所有檔案都讀取失敗時不產生合併檔。
+
+    Returns:
+        tuple: (已合併的檔名 list, 讀取失敗的檔名 list)。
+
+    Raises:
+        OSError: 寫入合併檔失敗。
+    """
+    merged_files = []
+    failed_files = []
+    directory = os.path.dirname(os.path.abspath(dest_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(dest_path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as out_f:
+            out_f.write(f"===== 合併分類: {category} =====")
+            for filename in filenames:
+                content = read_source_content(filename, transcription_folder, log_callback, content_cache)
+                if content is None:
+                    failed_files.append(filename)
+                    continue
+                out_f.write(f"\n\n\n----- 來源檔案: {filename} -----\n")
+                out_f.write(content)
+                merged_files.append(filename)
+                del content # 寫出後即釋放，不保留整個分類的內容
+        if merged_files:
+            replace_file(temp_path, dest_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return merged_files, failed_files
+
+# 合併檔名 (不含副檔名) 的長度上限，避免超過檔案系統限制 (多數為 255)
+MAX_GROUP_NAME_LENGTH = 150
+PAIR_SEPARATOR = "\n\n===== 分割線 =====\n\n"
+
+def plan_token_groups(filenames_by_category, token_counts, target_tokens):
+    """
+    依 token 預算將檔案分組：只在同一分類內、依排序後的順序把相鄰檔案裝進同一組。
+
+    依序裝箱，放得下就加入目前這組，放不下就開新的一組；在不能打亂順序的前提下，
+    這樣得到的組數最少。單一檔案本身就超過預算時自成一組。
+
+    Args:
+        filenames_by_category (dict): {分類: [檔名, ...]}。
+        token_counts (dict): {檔名: 估計 token 數}。
+        target_tokens (int): 每組的目標 token 上限。
+
+    Returns:
+        list: [(分類, [檔名, ...]), ...]，依分類與檔名排序。
+    """
+    groups = []
+    for category in sorted(filenames_by_category):
+        current, current_tokens = [], 0
+        for filename in sorted(filenames_by_category[category]):
+            tokens = token_counts[filename]
+            if current and current_tokens + tokens > target_tokens:
+                groups.append((category, current))
+                current, current_tokens = [], 0
+            current.append(filename)
+            current_tokens += tokens
+        if current:
+            groups.append((category, current))
+    return groups
+
+def group_output_filename(filenames):
+    """
+    組成合併輸出檔名：各來源檔名以 '+' 連接 (Step4 以每一段尋找影片)。
+    過長時改用來源清單的雜湊 (分組_<雜湊>_共N檔)；各來源仍記錄在合併清單中，Step4 依清單尋找每支影片。
+    """
+    base_names = [os.path.splitext(f)[0] for f in filenames]
+    name = "+".join(base_names)
+    if len(name) > MAX_GROUP_NAME_LENGTH:
+        name = f"分組_{text_sha256(name)[:12]}_共{len(base_names)}檔"
+    return f"{name}.txt"
+
+def stream_merge_group(filenames, dest_path, transcription_folder, log_callback, content_cache=None):
+    """
+    將一組轉錄稿以兩兩配對相同的格式 (來源標頭 + 分割線) 串流寫入合併檔 (供執行緒池呼叫)。
+
+    Raises:
+        OSError: 讀取來源或寫入合併檔失敗 (不會留下不完整的輸出檔)。
+    """
+    directory = os.path.dirname(os.path.abspath(dest_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(dest_path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as out_f:
+            out_f.write(f"來源檔案：{', '.join(filenames)}\n\n")
+            for index, filename in enumerate(filenames):
+                content = read_source_content(filename, transcription_folder, log_callback, content_cache)
+                if content is None:
+                    raise OSError(f"讀取來源檔案 {filename} 失敗")
+                if index:
+                    out_f.write(PAIR_SEPARATOR)
+                out_f.write(content)
+                del content
+        replace_file(temp_path, dest_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def estimate_source_tokens(filename, transcription_folder, log_callback, content_cache=None):
+    """估計單一來源轉錄稿的 token 數，讀取失敗時回傳 None (供執行緒池呼叫)"""
+    content = read_source_content(filename, transcription_folder, log_callback, content_cache)
+    return None if content is None else estimate_tokens(content)
+
 # --- Main Merging Function ---
-def perform_merging(labels_dict, transcription_folder, output_queue_folder, unpaired_folder, merging_strategy, log_callback=print):
+def perform_merging(labels_dict, transcription_folder, output_queue_folder, unpaired_folder, merging_strategy, log_callback=print,
+                    content_cache=None, io_workers=8, target_group_tokens=8000, incremental=True,
+                    passthrough=True, allow_hardlink=False, content_hashes=None):
     """
     根據分類結果和合併策略執行檔案合併。
 
@@ -59,6 +265,13 @@ def perform_merging(labels_dict, transcription_folder, output_queue_folder, unpa
         unpaired_folder (str): 儲存 \"兩兩配對\" 模式下漏單檔案的資料夾。
         merging_strategy (str): 合併策略選項。
         log_callback (callable): 日誌回呼函數。
+        content_cache (ContentCache): Step2 讀取過的檔案內容快取 (可選)，避免同一檔案重複讀取。
+        io_workers (int): 並行讀寫檔案的執行緒數上限 (雲端同步資料夾的延遲較高，並行可明顯加速)。
+        target_group_tokens (int): "依 Token 預算分組" 每組的目標 token 上限 (應小於 Step4 模型可處理的輸入長度)。
+        incremental (bool): 依輸出佇列中的合併清單，只重建來源或組成有變動的輸出，未變動的輸出不重寫 (保留修改時間)。
+        passthrough (bool): 單一 .txt 來源的輸出直接以檔案層級複製，不讀成字串再寫回。
+        allow_hardlink (bool): passthrough 時允許以硬連結代替複製 (輸出與來源共用資料，修改輸出會影響來源)。
+        content_hashes (dict): Step2 本次計算的 {檔名: 內容雜湊} (可選)，合併清單直接使用，不再讀取來源計算。
 
     Returns:
         bool: True 如果處理過程沒有發生嚴重錯誤，False 如果有。
@@ -80,195 +293,254 @@ def perform_merging(labels_dict, transcription_folder, output_queue_folder, unpa
         return True # 沒有錯誤，只是沒事做
 
     success = True # 追蹤是否有錯誤發生
+    manifest = MergeManifest.load(output_queue_folder, transcription_folder, incremental, content_hashes)
+    io_workers = max(1, int(io_workers or 1))
+    copy_job = partial(copy_source_as_txt, passthrough=passthrough, allow_hardlink=allow_hardlink)
+    log_callback(f"【日誌】檔案讀寫並行數: {io_workers}")
 
     # --- 根據策略執行 ---
-    if merging_strategy == "不合併":
-        log_callback("【日誌】策略為 '不合併'，將直接複製所有檔案至輸出佇列...")
-        copied_count = 0
-        error_count = 0
-        for filename in labels_dict.keys(): # 遍歷所有被分類的檔案
-            src_path = os.path.join(transcription_folder, filename)
-            base_name = os.path.splitext(filename)[0]
-            dest_filename = f"{base_name}.txt" # 統一輸出為 txt
-            dest_path = os.path.join(output_queue_folder, dest_filename)
-
-            try:
-                content = read_file_content(src_path, log_callback)
-                if content is not None:
-                    with open(dest_path, 'w', encoding='utf-8') as f:
-                        f.write(content)
+    # 讀寫工作交給有上限的執行緒池並行處理；結果依提交順序取回，輸出檔名與內容都與逐一處理時相同
+    with ThreadPoolExecutor(max_workers=io_workers) as pool:
+        if merging_strategy == "不合併":
+            log_callback("【日誌】策略為 '不合併'，將直接複製所有檔案至輸出佇列...")
+            copied_count = 0
+            error_count = 0
+            futures = []
+            for filename in labels_dict.keys(): # 遍歷所有被分類的檔案
+                dest_path = txt_output_path(output_queue_folder, filename)
+                if manifest.is_current(dest_path, [filename], "copy"):
+                    continue
+                futures.append((dest_path, pool.submit(
+                    copy_job, filename, output_queue_folder, transcription_folder, log_callback, content_cache)))
+            for dest_path, future in futures:
+                status, filename, dest_filename, error = future.result()
+                if status == COPY_OK:
+                    manifest.record(dest_path)
                     copied_count += 1
+                elif status == COPY_READ_FAILED:
+                    error_count += 1 # 讀取失敗
                 else:
-                     error_count += 1 # 讀取失敗
-            except Exception as e:
-                log_callback(f"【錯誤】複製/寫入檔案失敗 {filename} -> {dest_filename}: {e}")
-                error_count += 1
-                success = False
-        log_callback(f"【日誌】'不合併' 處理完成。成功複製: {copied_count}, 失敗: {error_count}")
-
-    elif merging_strategy == "依據分類合併":
-        log_callback("【日誌】策略為 '依據分類合併'...")
-        # 按分類標籤將檔案分組
-        files_by_category = defaultdict(list)
-        for filename, category in labels_dict.items():
-            files_by_category[category].append(filename)
-
-        merged_count = 0
-        error_count = 0
-        log_callback(f"【日誌】共找到 {len(files_by_category)} 個分類標籤進行合併。")
-
-        for category, filenames in files_by_category.items():
-            if not filenames: continue
-
-            # 清理分類名稱作為檔名
-            safe_category_name = sanitize_filename(category)
-            merged_filename = f"合併_{safe_category_name}.txt"
-            dest_path = os.path.join(output_queue_folder, merged_filename)
-            log_callback(f"--- 合併分類: '{category}' (共 {len(filenames)} 個檔案) -> {merged_filename} ---")
-
-            merged_content_parts = [f"===== 合併分類: {category} ====="]
-            files_processed_in_group = 0
-
-            filenames.sort() # 在合併前排序檔案
-            for filename in filenames:
-                src_path = os.path.join(transcription_folder, filename)
-                content = read_file_content(src_path, log_callback)
-                if content is not None:
-                    header = f"\n\n----- 來源檔案: {filename} -----\n"
-                    merged_content_parts.append(header + content)
-                    files_processed_in_group += 1
-                else:
-                    log_callback(f"【警告】讀取檔案 {filename} 失敗，將從合併中排除。")
-                    success = False # 標記有非嚴重錯誤
-
-            # 將所有部分合併並寫入檔案
-            if len(merged_content_parts) > 1: # 如果至少有一個檔案讀取成功 (除了標題)
+                    log_callback(f"【錯誤】複製/寫入檔案失敗 {filename} -> {dest_filename}: {error}")
+                    error_count += 1
+                    success = False
+            log_callback(f"【日誌】'不合併' 處理完成。成功複製: {copied_count}, 失敗: {error_count}")
+
+        elif merging_strategy == "依據分類合併":
+            log_callback("【日誌】策略為 '依據分類合併'...")
+            # 按分類標籤將檔案分組
+            files_by_category = defaultdict(list)
+            for filename, category in labels_dict.items():
+                files_by_category[category].append(filename)
+
+            merged_count = 0
+            error_count = 0
+            log_callback(f"【日誌】共找到 {len(files_by_category)} 個分類標籤進行合併。")
+
+            # 每個分類交給一個串流寫入工作，不同分類並行處理
+            category_jobs = [] # (category, dest_path, future)
+            for category, filenames in files_by_category.items():
+                if not filenames: continue
+
+                # 清理分類名稱作為檔名
+                safe_category_name = sanitize_filename(category)
+                merged_filename = f"合併_{safe_category_name}.txt"
+                dest_path = os.path.join(output_queue_folder, merged_filename)
+                log_callback(f"--- 合併分類: '{category}' (共 {len(filenames)} 個檔案) -> {merged_filename} ---")
+
+                filenames.sort() # 在合併前排序檔案
+                if manifest.is_current(dest_path, filenames, f"category:{category}"):
+                    log_callback(f"【日誌】分類 '{category}' 的來源檔案未變更，保留既有合併檔。")
+                    continue
+                category_jobs.append((category, dest_path, pool.submit(
+                    stream_merge_category, category, filenames, dest_path, transcription_folder, log_callback, content_cache)))
+
+            for category, dest_path, future in category_jobs:
+                merged_filename = os.path.basename(dest_path)
                 try:
-                    with open(dest_path, 'w', encoding='utf-8') as f:
-                        f.write("\n".join(merged_content_parts))
-                    log_callback(f"【日誌】分類 '{category}' 已合併並儲存。")
-                    merged_count += 1
+                    merged_files, failed_files = future.result()
                 except Exception as e:
                     log_callback(f"【錯誤】寫入合併檔案 {merged_filename} 失敗: {e}")
                     error_count += 1
                     success = False
-            else:
-                 log_callback(f"【警告】分類 '{category}' 中的所有檔案都讀取失敗，未生成合併檔案。")
-                 error_count += 1 # 雖然沒寫檔，但視為錯誤
-                 success = False
-
-        log_callback(f"【日誌】'依據分類合併' 處理完成。成功合併: {merged_count} 個分類, 發生錯誤/警告: {error_count} 次。")
-
-
-    elif merging_strategy == "兩兩配對 (僅適用原始分類)":
-        log_callback("【日誌】策略為 '兩兩配對 (僅適用原始分類)'...")
-        # --- 沿用您原始 Step 3 的邏輯 ---
-        independent_files = []
-        paired_files = []
-        for filename, classification in labels_dict.items():
-            # 假設原始分類2是獨立的
-            if classification.strip().startswith("分類2:"):
-                 independent_files.append(filename)
-            else:
-                paired_files.append(filename)
-
-        independent_files.sort()
-        paired_files.sort()
-
-        log_callback(f"【日誌】獨立使用檔案數量: {len(independent_files)}")
-        log_callback(f"【日誌】需要配對檔案數量: {len(paired_files)}")
-
-        processed_count = 0
-        error_count = 0
-
-        # 1. 處理獨立檔案
-        for filename in independent_files:
-            src_path = os.path.join(transcription_folder, filename)
-            base_name = os.path.splitext(filename)[0]
-            txt_filename = f"{base_name}.txt"
-            dest_path = os.path.join(output_queue_folder, txt_filename)
-            try:
-                content = read_file_content(src_path, log_callback)
-                if content is not None:
-                    with open(dest_path, 'w', encoding='utf-8') as f:
-                        f.write(content)
+                    continue
+
+                for filename in failed_files:
+                    log_callback(f"【警告】讀取檔案 {filename} 失敗，將從合併中排除。")
+                    success = False # 標記有非嚴重錯誤
+
+                if merged_files:
+                    manifest.record(dest_path, merged_files)
+                    log_callback(f"【日誌】分類 '{category}' 已合併並儲存 ({len(merged_files)} 個檔案)。")
+                    merged_count += 1
+                else:
+                     log_callback(f"【警告】分類 '{category}' 中的所有檔案都讀取失敗，未生成合併檔案。")
+                     error_count += 1 # 雖然沒寫檔，但視為錯誤
+                     success = False
+
+            log_callback(f"【日誌】'依據分類合併' 處理完成。成功合併: {merged_count} 個分類, 發生錯誤/警告: {error_count} 次。")
+
+
+        elif merging_strategy == "兩兩配對 (僅適用原始分類)":
+            log_callback("【日誌】策略為 '兩兩配對 (僅適用原始分類)'...")
+            # --- 沿用您原始 Step 3 的邏輯 ---
+            independent_files = []
+            paired_files = []
+            for filename, classification in labels_dict.items():
+                # 假設原始分類2是獨立的
+                if classification.strip().startswith("分類2:"):
+                     independent_files.append(filename)
+                else:
+                    paired_files.append(filename)
+
+            independent_files.sort()
+            paired_files.sort()
+
+            log_callback(f"【日誌】獨立使用檔案數量: {len(independent_files)}")
+            log_callback(f"【日誌】需要配對檔案數量: {len(paired_files)}")
+
+            processed_count = 0
+            error_count = 0
+
+            # 先提交所有工作 (獨立檔案、配對、漏單)，再依序取回結果
+            # (來源或組成未變更的輸出不重新提交)
+            independent_futures = []
+            for filename in independent_files:
+                dest_path = txt_output_path(output_queue_folder, filename)
+                if not manifest.is_current(dest_path, [filename], "copy"):
+                    independent_futures.append((dest_path, pool.submit(
+                        copy_job, filename, output_queue_folder, transcription_folder, log_callback, content_cache)))
+            pair_futures = []
+            for i in range(0, len(paired_files) - 1, 2):
+                file1, file2 = paired_files[i], paired_files[i+1]
+                dest_path = os.path.join(output_queue_folder, f"{os.path.splitext(file1)[0]}+{os.path.splitext(file2)[0]}.txt")
+                if not manifest.is_current(dest_path, [file1, file2], "pair"):
+                    pair_futures.append((dest_path, pool.submit(
+                        merge_pair_files, file1, file2, output_queue_folder, transcription_folder, log_callback, content_cache)))
+            leftover_future = None
+            if len(paired_files) % 2 == 1:
+                leftover_path = txt_output_path(unpaired_folder, paired_files[-1])
+                if not manifest.is_current(leftover_path, [paired_files[-1]], "copy"):
+                    leftover_future = pool.submit(copy_job, paired_files[-1], unpaired_folder,
+                                                  transcription_folder, log_callback, content_cache)
+
+            # 1. 處理獨立檔案
+            for dest_path, future in independent_futures:
+                status, filename, txt_filename, error = future.result()
+                if status == COPY_OK:
+                    manifest.record(dest_path)
                     log_callback(f"【日誌】處理獨立檔案並儲存為 txt：{filename} -> {txt_filename}")
                     processed_count += 1
-                else:
+                elif status == COPY_READ_FAILED:
                      error_count += 1; success = False
-            except Exception as e:
-                log_callback(f"【錯誤】處理獨立檔案 {filename} 失敗: {e}")
-                error_count += 1; success = False
-
-        # 2. 處理需配對檔案
-        separator = "\n\n===== 分割線 =====\n\n"
-        num_paired = len(paired_files)
-        i = 0
-        while i < num_paired:
+                else:
+                    log_callback(f"【錯誤】處理獨立檔案 {filename} 失敗: {error}")
+                    error_count += 1; success = False
+
+            # 2. 處理需配對檔案
+            for dest_path, future in pair_futures:
+                file1, file2, read_ok1, read_ok2, merged_filename, error = future.result()
+                if not (read_ok1 and read_ok2):
+                    log_callback(f"【警告】讀取配對檔案 {file1} 或 {file2} 內容失敗，跳過此配對。")
+                    error_count += (0 if read_ok1 else 1) + (0 if read_ok2 else 1)
+                    success = False
+                elif error is not None:
+                    log_callback(f"【錯誤】寫入合併檔案 {merged_filename} 失敗: {error}")
+                    error_count += 1; success = False
+                else:
+                    manifest.record(dest_path)
+                    log_callback(f"【日誌】成功合併檔案：{merged_filename}")
+                    processed_count += 1 # 合併算一次成功
+
             # 漏單處理
-            if i == num_paired - 1:
-                leftover_filename = paired_files[i]
-                src_path = os.path.join(transcription_folder, leftover_filename)
-                base_name = os.path.splitext(leftover_filename)[0]
-                txt_filename = f"{base_name}.txt"
-                dest_path = os.path.join(unpaired_folder, txt_filename)
+            if leftover_future is not None:
+                status, leftover_filename, txt_filename, error = leftover_future.result()
+                if status == COPY_OK:
+                    manifest.record(leftover_path)
+                    log_callback(f"【日誌】將漏單檔案處理並儲存為 txt 至漏單資料夾：{leftover_filename} -> {txt_filename}")
+                    processed_count += 1 # 也算處理成功
+                elif status == COPY_READ_FAILED:
+                    error_count += 1; success = False
+                else:
+                    log_callback(f"【錯誤】處理漏單檔案 {leftover_filename} 失敗: {error}")
+                    error_count += 1; success = False
+            log_callback(f"【日誌】'兩兩配對' 處理完成。成功處理/合併: {processed_count} 次, 發生錯誤/警告: {error_count} 次。")
+
+
+        elif merging_strategy == "依 Token 預算分組":
+            log_callback(f"【日誌】策略為 '依 Token 預算分組' (每組目標 {target_group_tokens} tokens)...")
+            # 先估計每個檔案的 token 數：內容未變更的沿用清單中的記錄，其餘並行讀取
+            # (讀到的內容會留在內容快取，寫入時不必再讀磁碟)
+            filenames = sorted(labels_dict.keys())
+            token_counts = {}
+            for filename in filenames:
+                tokens = manifest.cached_token_count(filename)
+                if tokens is not None:
+                    token_counts[filename] = tokens
+            to_estimate = [f for f in filenames if f not in token_counts]
+            token_results = pool.map(
+                lambda name: estimate_source_tokens(name, transcription_folder, log_callback, content_cache), to_estimate)
+            files_by_category = defaultdict(list)
+            error_count = 0
+            for filename, tokens in zip(to_estimate, token_results):
+                if tokens is None:
+                    log_callback(f"【警告】讀取檔案 {filename} 失敗，將從分組中排除。")
+                    error_count += 1; success = False
+                    continue
+                token_counts[filename] = tokens
+                manifest.remember_token_count(filename, tokens)
+            for filename in filenames:
+                if filename in token_counts:
+                    files_by_category[labels_dict[filename]].append(filename)
+
+            groups = plan_token_groups(files_by_category, token_counts, target_group_tokens)
+            log_callback(f"【日誌】{len(token_counts)} 個檔案分成 {len(groups)} 組 (共 {len(files_by_category)} 個分類)。")
+
+            group_jobs = [] # (分類, 檔名 list, 輸出路徑, 預估 tokens, future)
+            for category, group in groups:
+                group_tokens = sum(token_counts[f] for f in group)
+                if len(group) == 1:
+                    # 單獨成組的檔案直接輸出，與兩兩配對的獨立檔案相同
+                    dest_path = txt_output_path(output_queue_folder, group[0])
+                    if manifest.is_current(dest_path, group, "copy"):
+                        continue
+                    future = pool.submit(copy_job, group[0], output_queue_folder,
+                                         transcription_folder, log_callback, content_cache)
+                    group_jobs.append((category, group, dest_path, group_tokens, future))
+                    continue
+                dest_path = os.path.join(output_queue_folder, group_output_filename(group))
+                if manifest.is_current(dest_path, group, "group"):
+                    continue
+                future = pool.submit(stream_merge_group, group, dest_path,
+                                     transcription_folder, log_callback, content_cache)
+                group_jobs.append((category, group, dest_path, group_tokens, future))
+
+            processed_count = 0
+            for category, group, dest_path, group_tokens, future in group_jobs:
+                output_filename = os.path.basename(dest_path)
                 try:
-                    content = read_file_content(src_path, log_callback)
-                    if content is not None:
-                        with open(dest_path, 'w', encoding='utf-8') as f:
-                            f.write(content)
-                        log_callback(f"【日誌】將漏單檔案處理並儲存為 txt 至漏單資料夾：{leftover_filename} -> {txt_filename}")
-                        processed_count += 1 # 也算處理成功
-                    else:
-                        error_count += 1; success = False
+                    result = future.result()
+                    if len(group) == 1:
+                        status, _, _, error = result
+                        if status != COPY_OK:
+                            raise error or OSError(f"讀取來源檔案 {group[0]} 失敗")
+                    manifest.record(dest_path)
+                    log_callback(f"【日誌】分類 '{category}': {len(group)} 個檔案 (約 {group_tokens} tokens) -> {output_filename}")
+                    processed_count += 1
                 except Exception as e:
-                    log_callback(f"【錯誤】處理漏單檔案 {leftover_filename} 失敗: {e}")
+                    log_callback(f"【錯誤】寫入分組檔案 {output_filename} 失敗: {e}")
                     error_count += 1; success = False
-                break # 結束 while 循環
-
-            # 配對處理
-            file1 = paired_files[i]
-            file2 = paired_files[i+1]
-            src_path1 = os.path.join(transcription_folder, file1)
-            src_path2 = os.path.join(transcription_folder, file2)
-            content1, content2 = None, None
-            try:
-                content1 = read_file_content(src_path1, log_callback)
-                content2 = read_file_content(src_path2, log_callback)
-            except Exception as e: # 這裡其實 read_file_content 內部會處理，但多一層保險
-                 log_callback(f"【錯誤】讀取配對檔案失敗: {file1} 或 {file2}: {e}")
-                 error_count += 2; success = False
-                 i += 2
-                 continue
-
-            if content1 is None or content2 is None:
-                log_callback(f"【警告】讀取配對檔案 {file1} 或 {file2} 內容失敗，跳過此配對。")
-                error_count += (1 if content1 is None else 0) + (1 if content2 is None else 0)
-                success = False
-                i += 2
-                continue
-
-            header = f"來源檔案：{file1}, {file2}\n\n"
-            merged_content = header + content1 + separator + content2
-            base1 = os.path.splitext(file1)[0]
-            base2 = os.path.splitext(file2)[0]
-            merged_filename = f"{base1}+{base2}.txt"
-            dest_path = os.path.join(output_queue_folder, merged_filename)
-            try:
-                with open(dest_path, 'w', encoding='utf-8') as out_f:
-                    out_f.write(merged_content)
-                log_callback(f"【日誌】成功合併檔案：{merged_filename}")
-                processed_count += 1 # 合併算一次成功
-            except Exception as e:
-                log_callback(f"【錯誤】寫入合併檔案 {merged_filename} 失敗: {e}")
-                error_count += 1; success = False
-            i += 2
-        log_callback(f"【日誌】'兩兩配對' 處理完成。成功處理/合併: {processed_count} 次, 發生錯誤/警告: {error_count} 次。")
+            log_callback(f"【日誌】'依 Token 預算分組' 處理完成。成功輸出: {processed_count} 組, 發生錯誤/警告: {error_count} 次。")
 
 
-    else:
-        log_callback(f"【錯誤】未知的合併策略: {merging_strategy}")
-        success = False
+        else:
+            log_callback(f"【錯誤】未知的合併策略: {merging_strategy}")
+            success = False
+            manifest = None # 未產生任何輸出，保留原本的清單與檔案
+
+    if manifest is not None:
+        manifest.remove_stale(log_callback)
+        manifest.save(log_callback)
+        log_callback(f"【日誌】增量合併：{manifest.stats_text()}")
 
     log_callback(f"--- 合併處理完成 ---")
     return success
@@ -1,16 +1,66 @@
 import os
 import json
+import html
 import requests
 import traceback # 用於打印詳細錯誤
 import importlib.util # 用於檢查模組是否已安裝
+from concurrent.futures import ThreadPoolExecutor
+from api_retry import post_with_retry, is_transient_exception, mark_transient_failure # 429/5xx 重試與斷路器
+from template_renderer import compile_template, extract_title, TemplateSyntaxError
+from gemini_stream import (stream_generate_content, StreamError, partial_path, discard_partials,
+                           remove_empty_partial_folder)
+from markdown_email import markdown_to_email_html, format_inline, open_tag
+from file_utils import file_sha256, text_sha256, atomic_write_json
+from step4_journal import Step4Journal
+from video_index import VideoUrlIndex
+from merge_manifest import load_group_members
+from html_minifier import minify_files, DEFAULT_SIZE_BUDGET_KB
+from map_reduce import condense_long_content, ChunkCache, CACHE_FOLDER_NAME
+from token_utils import estimate_tokens
+from model_router import ModelRouter
 
 # Gemini API Endpoint (可以與 Step2 分開設定不同模型)
 GEMINI_API_ENDPOINT_STEP4 = "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent?key={api_key}" # 使用 gemini-pro
 HEADERS = {"Content-Type": "application/json"}
+# REST API 的基底網址 (可用環境變數 GEMINI_API_BASE 改成代理伺服器或本地測試服務)
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
 
 # 嘗試導入 google.genai 庫，如果不存在則退回到傳統 API 調用
 has_genai = importlib.util.find_spec("google.genai") is not None
 
+# HTML 整合方式：auto = 模板有 body 區塊時在本地填入，否則交給 AI；local = 只在本地填入；ai = 一律交給 AI；
+# structured = 一次 API 呼叫取得結構化文章 (標題、段落、摘要) 後在本地填入
+RENDER_MODES = ("auto", "local", "ai", "structured")
+
+# 結構化輸出：附加在 Prompt 之後的格式說明，以及 REST API 的 responseSchema
+STRUCTURED_OUTPUT_INSTRUCTIONS = """
+
+# 輸出格式 (務必遵守)：
+只回傳一個 JSON 物件，不要包含 ```json 標記或任何說明文字，格式如下：
+{"title": "電子報主標題", "summary": "一到兩句的摘要", "sections": [{"heading": "小標題", "paragraphs": ["段落一", "段落二"]}]}
+- sections 依文章順序排列；沒有小標題的段落 heading 請填空字串。
+- 段落內不要使用 Markdown 或 HTML 標記。
+"""
+STRUCTURED_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "title": {"type": "STRING"},
+        "summary": {"type": "STRING"},
+        "sections": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "heading": {"type": "STRING"},
+                    "paragraphs": {"type": "ARRAY", "items": {"type": "STRING"}},
+                },
+                "required": ["heading", "paragraphs"],
+            },
+        },
+    },
+    "required": ["title", "summary", "sections"],
+}
+
 # 設定輸入與輸出資料夾路徑 -- 移除硬編碼
 # input_folder = 'G:\我的雲端硬碟\自動化生成文案\待轉文案'
 # output_folder = 'G:\我的雲端硬碟\自動化生成文案\文案生成完成'
@@ -48,8 +98,67 @@ def read_file_content(filepath, log_callback):
         log_callback(f"【錯誤】Step 4: 讀取檔案失敗 {os.path.basename(filepath)}: {e}")
         return None
 
-def call_gemini_api_step4(api_key, prompt_text, log_callback, model_name="gemini-2.0-flash"):
-    """呼叫 Gemini API (用於 Step 4 生成內文) 並處理回應"""
+def gemini_endpoint(model_name, api_key, stream=False):
+    """generateContent (或串流的 streamGenerateContent，以 SSE 回傳) 的完整網址"""
+    if stream:
+        return f"{GEMINI_API_BASE}/models/{model_name}:streamGenerateContent?alt=sse&key={api_key}"
+    return f"{GEMINI_API_BASE}/models/{model_name}:generateContent?key={api_key}"
+
+def _stream_text(endpoint, payload, part_path, log_callback, commit_path=None, timeout=300):
+    """以串流方式取得生成文字 (進度寫入日誌)；失敗時記錄錯誤並回傳 None"""
+    try:
+        generated_text, usage = stream_generate_content(endpoint, payload, part_path, log_callback,
+                                                        commit_path=commit_path, timeout=timeout, headers=HEADERS)
+    except StreamError as e:
+        log_callback(f"【錯誤】Step 4: 串流生成失敗：{e}")
+        if e.partial_path:
+            log_callback(f"【提示】已生成的部分內容保留在: {e.partial_path}")
+        return None
+    prompt_tokens = usage.get("promptTokenCount", "N/A")
+    candidate_tokens = usage.get("candidatesTokenCount", "N/A")
+    log_callback(f"【日誌】Step 4: API 使用量 - 提示 tokens: {prompt_tokens}, 回應 tokens: {candidate_tokens}")
+    return generated_text
+
+def parse_structured_article(text):
+    """
+    解析結構化輸出的 JSON 文字。
+
+    Returns:
+        dict: {"title": str, "summary": str, "sections": [{"heading": str, "paragraphs": [str, ...]}, ...]}；
+        格式不符時回傳 None。
+    """
+    text = text.strip()
+    if text.startswith("```"): # 模型偶爾仍會包上程式碼區塊標記
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        text = text.rsplit("```", 1)[0]
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get("sections"), list):
+        return None
+    sections = []
+    for section in data["sections"]:
+        if not isinstance(section, dict):
+            return None
+        paragraphs = section.get("paragraphs", [])
+        if isinstance(paragraphs, str):
+            paragraphs = [paragraphs]
+        sections.append({"heading": str(section.get("heading") or "").strip(),
+                         "paragraphs": [str(p).strip() for p in paragraphs if str(p).strip()]})
+    return {"title": str(data.get("title") or "").strip(), "summary": str(data.get("summary") or "").strip(),
+            "sections": sections}
+
+def call_gemini_api_step4(api_key, prompt_text, log_callback, model_name="gemini-2.0-flash", convert_html=True,
+                          structured=False, stream_part_path=None):
+    """
+    呼叫 Gemini API (用於 Step 4 生成內文) 並處理回應
+
+    convert_html 為 False 時回傳未轉換的純文字 (本地模板渲染會先取出標題再轉換)。
+    structured 為 True 時要求 JSON 輸出並回傳 parse_structured_article 的結果 (dict)，解析失敗時回傳 None。
+    stream_part_path 有值時 (僅傳統 API 方式) 改用串流端點，收到的內容即時寫入此暫存檔，完成後刪除；
+    中途失敗時暫存檔會保留。
+    """
     global has_genai  # 聲明使用全域變數
     
     if not api_key:
@@ -68,16 +177,20 @@ def call_gemini_api_step4(api_key, prompt_text, log_callback, model_name="gemini
             
             # 生成內容
             model = genai.GenerativeModel(model_name)
-            response = model.generate_content(prompt_text)
+            if structured:
+                response = model.generate_content(prompt_text,
+                                                  generation_config={"response_mime_type": "application/json"})
+            else:
+                response = model.generate_content(prompt_text)
             
             if hasattr(response, 'text'):
                 generated_text = response.text.strip()
                 log_callback("【日誌】Step 4: 已成功從 API 獲取生成內文。")
+                if structured:
+                    return _parse_structured_response(generated_text, log_callback)
                 
-                # 將 Markdown 常見格式稍微轉成 HTML (基本轉換)
-                generated_text = generated_text.replace('\n\n', '<br><br>')
-                generated_text = generated_text.replace('\n', '<br>')     # 換行
-                return generated_text
+                # 將 Markdown 轉成電子郵件安全的 HTML (標題、粗體、清單、連結等)
+                return markdown_to_email_html(generated_text) if convert_html else generated_text
             else:
                 log_callback(f"【錯誤】Step 4: API 響應缺少文本內容: {response}")
                 return None
@@ -89,13 +202,15 @@ def call_gemini_api_step4(api_key, prompt_text, log_callback, model_name="gemini
         except Exception as e:
             log_callback(f"【錯誤】Step 4: 使用 genai 庫調用 API 時發生錯誤: {e}")
             log_callback(traceback.format_exc())
+            if is_transient_exception(e):
+                mark_transient_failure() # 429/5xx/逾時：模型路由可改用備援模型
             return None
 
     # 傳統 API 調用方法 (舊方法)
     if not has_genai:
         try:
             # 更新 endpoint 以使用自訂模型
-            endpoint = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key}"
+            endpoint = gemini_endpoint(model_name, api_key, stream=stream_part_path is not None)
             
             # 增加 safetySettings 範例 (可選，根據需要調整)
             payload = {
@@ -113,8 +228,21 @@ def call_gemini_api_step4(api_key, prompt_text, log_callback, model_name="gemini
                     # "maxOutputTokens": 8192, # 根據模型限制和需求設定
                 }
             }
+            if structured:
+                payload["generationConfig"]["responseMimeType"] = "application/json"
+                payload["generationConfig"]["responseSchema"] = STRUCTURED_RESPONSE_SCHEMA
+
+            if stream_part_path is not None:
+                generated_text = _stream_text(endpoint, payload, stream_part_path, log_callback)
+                if generated_text is None:
+                    return None
+                generated_text = generated_text.strip()
+                log_callback("【日誌】Step 4: 已成功從 API 獲取生成內文。")
+                if structured:
+                    return _parse_structured_response(generated_text, log_callback)
+                return markdown_to_email_html(generated_text) if convert_html else generated_text
 
-            response = requests.post(endpoint, headers=HEADERS, data=json.dumps(payload), timeout=120) # 生成可能需要更長超時
+            response = post_with_retry(endpoint, payload, log_callback, timeout=120, headers=HEADERS) # 生成可能需要更長超時
 
             if response.status_code == 403:
                  log_callback("【錯誤】Step 4: Gemini API 金鑰無效或權限不足。")
@@ -149,11 +277,10 @@ def call_gemini_api_step4(api_key, prompt_text, log_callback, model_name="gemini
 
             generated_text = parts[0].get("text", "").strip()
             log_callback("【日誌】Step 4: 已成功從 API 獲取生成內文。")
-            # 將 Markdown 常見格式稍微轉成 HTML (基本轉換)
-            generated_text = generated_text.replace('\n\n', '<br><br>')
-            generated_text = generated_text.replace('\n', '<br>')     # 換行
-            # 可以加入更多 Markdown 轉換規則 (e.g., **, lists)
-            return generated_text
+            if structured:
+                return _parse_structured_response(generated_text, log_callback)
+            # 將 Markdown 轉成電子郵件安全的 HTML (標題、粗體、清單、連結等)
+            return markdown_to_email_html(generated_text) if convert_html else generated_text
 
         except requests.exceptions.RequestException as e:
             log_callback(f"【錯誤】Step 4: 呼叫 API 時網路連線錯誤：{e}")
@@ -164,6 +291,13 @@ def call_gemini_api_step4(api_key, prompt_text, log_callback, model_name="gemini
             return None
 
 
+def _parse_structured_response(generated_text, log_callback):
+    article = parse_structured_article(generated_text)
+    if article is None or not article["sections"]:
+        log_callback(f"【錯誤】Step 4: API 回傳的結構化內容格式不符: {generated_text[:200]}")
+        return None
+    return article
+
 def load_video_urls(url_config_path, log_callback):
     """載入 video_urls.json 檔案"""
     if not os.path.exists(url_config_path):
@@ -179,13 +313,14 @@ def load_video_urls(url_config_path, log_callback):
         return {}
 
 def save_video_urls(video_urls, url_config_path, log_callback):
-     """儲存更新後的 video_urls.json 檔案 (標記 processed)"""
+     """儲存更新後的 video_urls.json 檔案 (標記 processed)；以原子寫入避免中斷時留下損壞的設定檔。成功時回傳 True"""
      try:
-         with open(url_config_path, 'w', encoding='utf-8') as f:
-             json.dump(video_urls, f, ensure_ascii=False, indent=2)
+         atomic_write_json(url_config_path, video_urls)
          log_callback(f"【日誌】已更新 URL 設定檔 (標記完成狀態)。")
+         return True
      except Exception as e:
          log_callback(f"【錯誤】儲存更新後的 URL 設定檔失敗: {e}")
+         return False
 
 
 def generate_video_embed(video_name, video_urls_data, log_callback):
@@ -235,9 +370,31 @@ def generate_video_embed(video_name, video_urls_data, log_callback):
     </div>
     """
 
+def generate_video_embeds(base_name, video_names, video_urls_data, log_callback):
+    """
+    合併檔案中所有影片的嵌入代碼 (依來源順序排列)。
+
+    Args:
+        video_names (list): VideoUrlIndex.videos_for 找到的影片鍵。
+    """
+    names_with_url = [name for name in video_names if video_urls_data[name].get("url")]
+    if not names_with_url:
+        # 沒有任何可用連結時沿用單一影片的提示區塊
+        return generate_video_embed(video_names[0] if video_names else base_name, video_urls_data, log_callback)
+    if len(names_with_url) > 1:
+        log_callback(f"【日誌】此檔案包含 {len(names_with_url)} 部影片，將依序嵌入。")
+    spacer = '\n<div style="height:16px; line-height:16px; font-size:0;">&nbsp;</div>\n'
+    return spacer.join(generate_video_embed(name, video_urls_data, log_callback) for name in names_with_url)
+
 # --- 新增：與AI協作生成HTML的函數 ---
-def generate_html_with_ai(api_key, original_content, video_embed_html, template_content, template_customizations, log_callback, model_name="gemini-2.0-flash", include_video=True): # <-- 新增 template_customizations
-    """讓AI將內容整合到HTML模板中，並應用自訂設定"""
+def generate_html_with_ai(api_key, original_content, video_embed_html, template_content, template_customizations, log_callback, model_name="gemini-2.0-flash", include_video=True, # <-- 新增 template_customizations
+                          stream_output_path=None):
+    """
+    讓AI將內容整合到HTML模板中，並應用自訂設定
+
+    stream_output_path 有值時 (僅傳統 API 方式) 改用串流端點：HTML 邊收邊寫入輸出資料夾 _partial 子資料夾中的 .part 暫存檔，
+    完整收到後才原子地改名為 stream_output_path (呼叫端不需再寫入檔案)。
+    """
     global has_genai  # 聲明使用全域變數
     
     # 根據include_video選項調整prompt
@@ -328,11 +485,13 @@ def generate_html_with_ai(api_key, original_content, video_embed_html, template_
         except Exception as e:
             log_callback(f"【錯誤】Step 4: 使用 genai 庫調用 API 時發生錯誤: {e}")
             log_callback(traceback.format_exc())
+            if is_transient_exception(e):
+                mark_transient_failure() # 429/5xx/逾時：模型路由可改用備援模型
             return None
 
     # 傳統 API 調用方法 (舊方法)
     try:
-        endpoint = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key}"
+        endpoint = gemini_endpoint(model_name, api_key, stream=stream_output_path is not None)
         headers = {"Content-Type": "application/json"}
         
         log_callback(f"【日誌】Step 4: 使用 API 整合內容到 HTML 模板中 (使用模型: {model_name})...")
@@ -348,8 +507,14 @@ def generate_html_with_ai(api_key, original_content, video_embed_html, template_
                 "maxOutputTokens": 60192  # 增加輸出長度限制，以容納完整HTML
             }
         }
+
+        if stream_output_path is not None:
+            return _stream_text(endpoint, request_data,
+                                partial_path(os.path.dirname(stream_output_path), os.path.basename(stream_output_path)),
+                                log_callback,
+                                commit_path=stream_output_path)
         
-        response = requests.post(endpoint, headers=headers, json=request_data)
+        response = post_with_retry(endpoint, request_data, log_callback, timeout=300, headers=headers)
         response.raise_for_status()  # 如果HTTP響應狀態不在200-299之間，則拋出異常
         
         response_json = response.json()
@@ -371,6 +536,213 @@ def generate_html_with_ai(api_key, original_content, video_embed_html, template_
         log_callback(traceback.format_exc())
         return None
 
+def render_html_locally(compiled_template, content, fallback_title, video_embed_html, template_customizations,
+                        include_video=True):
+    """
+    不呼叫 AI，直接把內容填入已解析模板的具名區塊 (結果每次相同)。
+
+    Args:
+        compiled_template: template_renderer.compile_template 的結果 (需有 body 區塊)。
+        content (str): 改寫後 (或原始) 的純文字內容；第一行若是標題會放入 title 區塊。
+        fallback_title (str): 內容沒有標題時使用的標題 (檔名)。
+        video_embed_html (str): 影片嵌入代碼，找不到影片時為 None。
+    """
+    title, body = extract_title(content, fallback_title)
+    return _render_slots(compiled_template, title, markdown_to_email_html(body), None, video_embed_html,
+                         template_customizations, include_video)
+
+def structured_article_to_html(article, include_summary=True):
+    """將結構化文章的段落轉成 HTML (小標題為 <h2>，段落為 <p>，套用與 Markdown 轉換相同的 inline style)"""
+    parts = []
+    if include_summary and article["summary"]:
+        parts.append(f"{open_tag('p')}<strong>{format_inline(article['summary'])}</strong></p>")
+    for section in article["sections"]:
+        if section["heading"]:
+            parts.append(f"{open_tag('h2')}{format_inline(section['heading'])}</h2>")
+        for paragraph in section["paragraphs"]:
+            parts.append(f"{open_tag('p')}{format_inline(paragraph)}</p>")
+    return "\n".join(parts)
+
+def render_structured_locally(compiled_template, article, fallback_title, video_embed_html, template_customizations,
+                              include_video=True):
+    """
+    將結構化文章填入模板區塊。摘要放在 summary 區塊；模板沒有 summary 區塊時放在內文開頭。
+    """
+    has_summary_slot = compiled_template.has_slot("summary")
+    body_html = structured_article_to_html(article, include_summary=not has_summary_slot)
+    summary_html = f"{open_tag('p')}{format_inline(article['summary'])}</p>" if article["summary"] else ""
+    return _render_slots(compiled_template, article["title"] or fallback_title, body_html,
+                         summary_html if has_summary_slot else None, video_embed_html,
+                         template_customizations, include_video)
+
+def _render_slots(compiled_template, title, body_html, summary_html, video_embed_html, template_customizations,
+                  include_video):
+    if not include_video:
+        video_html = "" # 移除影片區塊
+    elif video_embed_html:
+        video_html = video_embed_html
+    else:
+        video_html = '<p style="text-align:center;color:#888888;">(未在URL設定檔中找到此影片的連結)</p>'
+    fields = dict(template_customizations)
+    fields["title"] = title
+    return compiled_template.render(
+        slots={"title": html.escape(title), "body": body_html, "summary": summary_html, "video": video_html},
+        fields=fields)
+
+def _prefixed_logger(log_callback, filename):
+    """並行處理時在每則日誌前加上檔名，方便分辨交錯的訊息 (開頭的空行保留在檔名之前)"""
+    def file_log(message):
+        text = message.lstrip("\n")
+        log_callback(f"{message[:len(message) - len(text)]}[{filename}] {text}")
+    return file_log
+
+def process_newsletter_file(filename, index, total_files, input_folder, output_folder, html_template_content,
+                            video_urls_data, api_key, prompt_template_name, prompt_template_content, log_callback,
+                            api_model="gemini-2.0-flash", include_video=True, template_customizations={},
+                            compiled_template=None, structured_output=False, stream_output=False,
+                            video_index=None, map_reduce_chunk_tokens=0, map_workers=4, model_router=None):
+    """
+    處理單一檔案：改寫內文、整合進 HTML 模板並儲存 (可在執行緒池中執行)。
+
+    video_urls_data 在此只讀取，不修改；處理狀態由呼叫端在全部完成後統一標記。
+    video_index 為 video_urls_data 的 VideoUrlIndex (可由呼叫端建立一次後共用)。
+    compiled_template 不為 None 時在本地填入模板區塊，不再呼叫 AI 整合 HTML。
+    structured_output 為 True 時 (需搭配 compiled_template) 只呼叫一次 API 取得結構化文章。
+    stream_output 為 True 時 API 以串流方式回傳，生成中的內容寫入輸出資料夾 _partial 子資料夾的 .part 暫存檔。
+    map_reduce_chunk_tokens 大於 0 且內容估計超過此 token 數時，先依來源檔案分段並行整理 (最多 map_workers 段同時進行)，
+    再以整理結果套用 Prompt 生成最終內文。
+    model_router (ModelRouter) 不為 None 時，每次 API 呼叫依任務 (rewrite/map/html) 與輸入大小選擇模型，
+    因暫時性錯誤失敗時改用備援模型。
+
+    Returns:
+        tuple: (是否已儲存 HTML, 是否發生錯誤, 要標記為已處理的影片名稱 list)。
+    """
+    log_callback(f"\n--- 處理檔案 {index}/{total_files}: {filename} ---")
+    file_path = os.path.join(input_folder, filename)
+    had_error = False
+
+    # 讀取檔案內容
+    original_content = read_file_content(file_path, log_callback)
+    if original_content is None:
+        log_callback(f"【跳過】讀取檔案失敗: {filename}")
+        return False, True, []
+
+    # 取得不含副檔名的檔名
+    base_name = os.path.splitext(filename)[0]
+    output_filename = f"{base_name}.html"
+    output_path = os.path.join(output_folder, output_filename)
+    html_saved = False # 串流模式下 AI 生成的 HTML 已直接寫入輸出檔
+
+    def call_model(task, input_text, call):
+        # call(model_name) -> 結果或 None；沒有路由表時一律使用 api_model
+        if model_router is None:
+            return call(api_model)
+        return model_router.call(task, input_text, call, log_callback)
+
+    # --- Step 1: 使用選定的 Prompt 處理內容 ---
+    article = None # 結構化輸出的結果
+    if prompt_template_name == "僅填入原文":
+        log_callback("【日誌】使用 '僅填入原文' 策略，直接使用檔案內容。")
+        # 不經過API，直接使用原始內容
+        processed_content = original_content
+    else:
+        # 需要呼叫 API 進行內容處理
+        log_callback(f"【日誌】使用 '{prompt_template_name}' Prompt 處理內容...")
+        prompt_content = original_content
+        if map_reduce_chunk_tokens and map_reduce_chunk_tokens > 0:
+            # 長篇內容先分段整理 (各段結果快取在輸出資料夾)，最後一次呼叫仍使用原本的 Prompt
+            def map_chunk(prompt):
+                # 回傳實際回應的模型 (路由選擇或備援)，快取依此記錄
+                used_models = []
+
+                def call_with_model(model):
+                    used_models.append(model)
+                    return call_gemini_api_step4(api_key, prompt, log_callback, model, convert_html=False)
+
+                result = call_model("map", prompt, call_with_model)
+                return result, used_models[-1] if used_models else api_model
+
+            def map_model(prompt):
+                if model_router is None:
+                    return api_model
+                return model_router.choose("map", estimate_tokens(prompt))[1]
+
+            chunk_cache = ChunkCache(os.path.join(output_folder, CACHE_FOLDER_NAME))
+            condensed = condense_long_content(original_content, map_chunk, map_reduce_chunk_tokens, chunk_cache,
+                                              log_callback, map_workers, resolve_model=map_model)
+            if condensed is None:
+                log_callback("【警告】分段整理失敗，改為一次送出完整內容。")
+                had_error = True
+            else:
+                prompt_content = condensed
+        final_prompt = prompt_template_content.format(original_content=prompt_content)
+        if structured_output:
+            final_prompt += STRUCTURED_OUTPUT_INSTRUCTIONS
+        rewrite_part_path = partial_path(output_folder, f"{base_name}.rewrite") if stream_output else None
+        api_result = call_model("rewrite", final_prompt, lambda model: call_gemini_api_step4(
+            api_key, final_prompt, log_callback, model, convert_html=compiled_template is None,
+            structured=structured_output, stream_part_path=rewrite_part_path))
+        if api_result is not None and structured_output:
+            article = api_result
+            processed_content = None
+            log_callback(f"【日誌】內容處理成功 (結構化輸出：{len(article['sections'])} 個段落區塊)。")
+        elif api_result is not None:
+            processed_content = api_result
+            log_callback("【日誌】內容處理成功。")
+        else:
+            log_callback("【錯誤】從 API 獲取生成內文失敗，將使用原始內容作為備用。")
+            processed_content = original_content
+            had_error = True
+
+    # --- Step 2: 提取影片嵌入代碼 (合併檔名以 '+' 連接的每一段都尋找對應影片) ---
+    if video_index is None:
+        video_index = VideoUrlIndex(video_urls_data)
+    video_names = video_index.videos_for(base_name)
+    video_embed_html = generate_video_embeds(base_name, video_names, video_urls_data, log_callback)
+
+    # --- Step 3: 將內容整合進HTML模板 (本地填入區塊，或交給AI) ---
+    if article is not None:
+        log_callback("【日誌】在本地將結構化內容填入HTML模板區塊...")
+        final_html = render_structured_locally(compiled_template, article, base_name, video_embed_html,
+                                               template_customizations, include_video)
+    elif compiled_template is not None:
+        log_callback("【日誌】在本地將處理後的內容填入HTML模板區塊...")
+        final_html = render_html_locally(compiled_template, processed_content, base_name, video_embed_html,
+                                         template_customizations, include_video)
+    else:
+        log_callback("【日誌】使用AI將處理後的內容整合到HTML模板...")
+        stream_html = stream_output and not has_genai # genai 庫的呼叫方式不支援串流寫檔
+        final_html = call_model("html", processed_content + html_template_content, lambda model: generate_html_with_ai(
+            api_key=api_key,
+            original_content=processed_content,  # 已處理過的內容
+            video_embed_html=video_embed_html,   # 影片嵌入代碼
+            template_content=html_template_content,  # 原始HTML模板
+            template_customizations=template_customizations, # <-- 傳遞自訂設定
+            log_callback=log_callback, # <-- 確保 log_callback 在正確位置
+            model_name=model,
+            include_video=include_video,  # 傳遞是否包含影片區域的設定
+            stream_output_path=output_path if stream_html else None
+        ))
+        html_saved = stream_html and final_html is not None
+
+    if final_html is None:
+        log_callback("【錯誤】無法生成最終HTML，跳過此檔案。")
+        return False, True, []
+
+    # --- 儲存最終HTML ---
+    if html_saved:
+        log_callback(f"【成功】已生成並儲存HTML電子報: {output_filename}")
+        return True, had_error, video_names
+
+    try:
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(final_html)
+        log_callback(f"【成功】已生成並儲存HTML電子報: {output_filename}")
+        return True, had_error, video_names
+    except Exception as e:
+        log_callback(f"【錯誤】儲存HTML檔案失敗: {e}")
+        return False, True, []
+
 # --- 修改主要處理函數 ---
 def generate_newsletter(
     input_folder,
@@ -383,7 +755,18 @@ def generate_newsletter(
     log_callback=print,
     api_model="gemini-2.0-flash", # 新增：自訂模型參數
     include_video=True, # 新增：是否包含影片連結區域
-    template_customizations={} # <-- 新增：模板自訂設定字典
+    template_customizations={}, # <-- 新增：模板自訂設定字典
+    max_concurrent_files=1, # 同時處理的檔案數上限 (1 = 逐一處理)
+    render_mode="auto", # HTML 整合方式 (見 RENDER_MODES)
+    stream_output=False, # 以串流方式接收 API 回應 (即時顯示進度，內容先寫入 .part 暫存檔)
+    resume=True, # 略過進度日誌中已完成且輸入與設定都未變更的檔案
+    minify_output=False, # 完成後壓縮本次生成的 HTML 並檢查大小
+    size_budget_kb=DEFAULT_SIZE_BUDGET_KB, # 每封電子報的大小上限 (KB)
+    map_reduce_chunk_tokens=0, # 內容超過此估計 token 數時分段整理後再彙整 (0 = 停用)
+    map_workers=4, # 每個檔案同時整理的段落數上限
+    model_routes=None, # 模型路由表 (依任務與輸入 token 數選擇模型，見 model_router.py)
+    fallback_model=None, # 呼叫因暫時性錯誤 (重試用盡的 429/5xx、網路錯誤) 失敗時改用的備援模型
+    route_stats_path=None # 模型路由統計的累計檔案 (JSON)，None 表示只寫入日誌
 ):
     """
     遍歷輸入資料夾的 txt 檔案，生成 HTML 電子報。
@@ -391,6 +774,26 @@ def generate_newsletter(
     Args:
         ... (其他參數)
         template_customizations (dict): 包含模板自訂內容的字典。
+        max_concurrent_files (int): 同時處理的檔案數上限；大於 1 時各檔案的 API 呼叫並行進行，
+            影片處理狀態在全部完成後統一更新並只儲存一次。
+        render_mode (str): "auto" 在模板宣告了 body 區塊 (<!-- slot:body -->) 時於本地填入模板，
+            否則交給 AI 整合；"local" 只在本地填入 (模板沒有 body 區塊時視為錯誤)；"ai" 一律交給 AI；
+            "structured" 與 local 相同，但改寫時要求 API 回傳結構化文章 (每個檔案只呼叫一次 API，
+            Prompt 中不含模板)。
+        stream_output (bool): 使用 streamGenerateContent 串流端點，日誌即時顯示已接收的大小與 token 數；
+            生成中的內容寫入輸出資料夾 _partial 子資料夾的 .part 暫存檔，完整收到後才提交，逾時或中斷時已生成的部分會保留
+            (該檔案之後重新生成成功時刪除)。已安裝 google-genai 時改用 genai 庫呼叫，不使用串流。
+        resume (bool): 每個檔案完成時立即記錄到輸出資料夾的進度日誌 (_step4_journal.jsonl)；
+            為 True 時略過輸入內容、模型、Prompt 與設定都與記錄相同且輸出檔仍在的檔案。
+            video_urls.json 的 processed 標記在結束時寫入 (含先前中斷的執行中已完成的檔案)。
+        minify_output (bool): 全部完成後壓縮本次生成的 HTML (保留影片區/內容區標記，先前執行留下的檔案不重寫)，
+            並逐檔回報壓縮後大小，超過 size_budget_kb 時發出警告。
+        map_reduce_chunk_tokens (int): 大於 0 時，估計超過此 token 數的內容會在來源檔案邊界 (----- 來源檔案: ... -----)
+            切成多段，每段不超過此大小，並行整理重點後再以選定的 Prompt 彙整成一篇；各段結果快取在輸出資料夾的
+            _step4_map_cache，重新執行時相同段落不再呼叫 API。
+        model_routes (list): 依序比對的路由，例如 [{"task": "rewrite", "max_tokens": 8000, "model": "gemini-2.0-flash-lite"}]；
+            task 為 rewrite (改寫內文)、map (分段整理)、html (AI 整合 HTML) 或 "*"，都不符合時使用 api_model。
+            各路由的呼叫數、失敗數、延遲與估計 token 數在結束時寫入日誌，並累加到 route_stats_path。
     """
     log_callback(f"--- 開始執行 Step 4：生成電子報 ---")
     log_callback(f"讀取處理後文字稿來源: {input_folder}")
@@ -408,6 +811,9 @@ def generate_newsletter(
     if not html_template_path or not os.path.exists(html_template_path):
          log_callback(f"【錯誤】Step 4: HTML 模板檔案不存在或未指定: {html_template_path}")
          return False
+    if render_mode not in RENDER_MODES:
+        log_callback(f"【警告】未知的 HTML 整合方式 '{render_mode}'，將使用 auto。")
+        render_mode = "auto"
     if prompt_template_name != "僅填入原文" and not api_key:
         log_callback("【錯誤】Step 4: 選擇的 Prompt 需要 API 金鑰，但未提供。")
         return False
@@ -421,8 +827,37 @@ def generate_newsletter(
         log_callback(f"【錯誤】讀取 HTML 模板失敗: {e}")
         return False
 
+    # --- 解析模板區塊 (只解析一次，所有檔案共用) ---
+    compiled_template = None
+    if render_mode != "ai":
+        try:
+            compiled_template = compile_template(html_template_content)
+        except TemplateSyntaxError as e:
+            log_callback(f"【錯誤】HTML 模板區塊標記有誤: {e}")
+            if render_mode in ("local", "structured"):
+                return False
+        if compiled_template is not None and not compiled_template.has_slot("body"):
+            if render_mode in ("local", "structured"):
+                log_callback("【錯誤】HTML 模板沒有 <!-- slot:body --> 區塊，無法在本地填入內容。")
+                return False
+            compiled_template = None
+    if compiled_template is not None:
+        log_callback(f"【日誌】模板宣告了區塊 ({', '.join(sorted(compiled_template.slots))})，將在本地填入內容，不呼叫 AI 整合 HTML。")
+    else:
+        log_callback("【日誌】將使用 AI 將內容整合到 HTML 模板。")
+        if not api_key:
+            log_callback("【錯誤】Step 4: 使用 AI 整合 HTML 需要 API 金鑰，但未提供。")
+            return False
+    if stream_output and has_genai:
+        # genai 庫的呼叫方式沒有串流寫檔，改為一次取得完整回應
+        log_callback("【提示】已安裝 google-genai，API 改由 genai 庫呼叫，本次不使用串流輸出 (不會顯示生成進度)。")
+        stream_output = False
+
     # --- 讀取URL配置 ---
     video_urls_data = load_video_urls(url_config_path, log_callback)
+    # 只建立一次，所有檔案共用；Step3 的合併清單提供分組檔 (檔名可能是雜湊) 的來源清單
+    video_index = VideoUrlIndex(video_urls_data, load_group_members(input_folder))
+    model_router = ModelRouter(model_routes, api_model, fallback_model, log_callback) # 所有檔案共用 (統計一併累計)
     
     # --- 處理每個輸入檔案 ---
     processed_count = 0
@@ -442,90 +877,109 @@ def generate_newsletter(
     log_callback(f"【日誌】總共找到 {total_files} 個 .txt 檔案等待處理。")
     
     overall_success = True # 用於追蹤全局處理狀態
-    
-    for index, filename in enumerate(input_files, 1):
-        log_callback(f"\n--- 處理檔案 {index}/{total_files}: {filename} ---")
-        file_path = os.path.join(input_folder, filename)
-        
-        # 讀取檔案內容
-        original_content = read_file_content(file_path, log_callback)
-        if original_content is None:
-            log_callback(f"【跳過】讀取檔案失敗: {filename}")
-            error_count += 1
-            overall_success = False
-            continue
-        
-        # 取得不含副檔名的檔名
+
+    # --- 進度日誌：記錄每個完成的檔案，中斷後重新執行時可略過 ---
+    journal = Step4Journal.load(output_folder, log_callback)
+    prompt_hash = text_sha256(f"{prompt_template_name}\n{prompt_template_content}")
+    settings_hash = text_sha256(json.dumps({
+        "template": text_sha256(html_template_content), "customizations": template_customizations,
+        "include_video": include_video, "render_mode": render_mode, "map_reduce_chunk_tokens": map_reduce_chunk_tokens,
+        "model_routes": model_router.signature(),
+    }, ensure_ascii=False, sort_keys=True))
+    skipped_count = 0
+
+    def file_settings_hash(filename):
+        # 影片連結會寫進 HTML，連結變更時也要重新生成
+        video_urls = [video_urls_data[name].get("url") for name in video_index.videos_for(os.path.splitext(filename)[0])]
+        return text_sha256(f"{settings_hash}\n{json.dumps(video_urls)}")
+
+    def process_and_record(filename, input_hash, *args):
+        result = process_newsletter_file(filename, *args)
+        saved, had_error, video_names = result
         base_name = os.path.splitext(filename)[0]
-        
-        # --- Step 1: 使用選定的 Prompt 處理內容 ---
-        if prompt_template_name == "僅填入原文":
-            log_callback("【日誌】使用 '僅填入原文' 策略，直接使用檔案內容。")
-            # 不經過API，直接使用原始內容
-            processed_content = original_content
-        else:
-            # 需要呼叫 API 進行內容處理
-            log_callback(f"【日誌】使用 '{prompt_template_name}' Prompt 處理內容...")
-            final_prompt = prompt_template_content.format(original_content=original_content)
-            api_result = call_gemini_api_step4(api_key, final_prompt, log_callback, api_model)
-            if api_result is not None:
-                processed_content = api_result
-                log_callback("【日誌】內容處理成功。")
-            else:
-                log_callback("【錯誤】從 API 獲取生成內文失敗，將使用原始內容作為備用。")
-                processed_content = original_content
+        if saved and not had_error:
+            discard_partials(output_folder, [f"{base_name}.rewrite", f"{base_name}.html"]) # 先前中斷留下的暫存檔
+        # 以原始內容備用生成的檔案不記錄，下次重新處理
+        if saved and not had_error and input_hash is not None:
+            try:
+                journal.record(filename, input_hash,
+                               os.path.join(output_folder, f"{base_name}.html"),
+                               api_model, prompt_hash, file_settings_hash(filename), video_names)
+            except OSError as e:
+                log_callback(f"【警告】寫入 Step4 進度日誌失敗 ({filename}): {e}")
+        return result
+    
+    max_workers = max(1, int(max_concurrent_files or 1))
+    if max_workers > 1:
+        log_callback(f"【日誌】同時處理最多 {max_workers} 個檔案 (日誌前綴為檔名)。")
+
+    # 各檔案的 API 呼叫鏈交給有上限的執行緒池並行執行；結果依提交順序取回
+    videos_to_mark = [] # 成功生成的影片名稱，全部完成後才統一標記並儲存
+    generated_html_paths = [] # 本次生成的 HTML (只壓縮這些檔案，先前執行留下的檔案不重寫)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = []
+        for index, filename in enumerate(input_files, 1):
+            try:
+                input_hash = file_sha256(os.path.join(input_folder, filename))
+            except OSError:
+                input_hash = None # 讀取失敗由處理流程回報
+            if resume and input_hash is not None and journal.is_done(filename, input_hash, api_model, prompt_hash,
+                                                                     file_settings_hash(filename)):
+                log_callback(f"【日誌】略過 {filename}：進度日誌顯示已完成且內容與設定未變更。")
+                skipped_count += 1
+                continue
+            file_log = log_callback if max_workers == 1 else _prefixed_logger(log_callback, filename)
+            futures.append((filename, pool.submit(
+                process_and_record, filename, input_hash, index, total_files, input_folder, output_folder,
+                html_template_content, video_urls_data, api_key, prompt_template_name, prompt_template_content,
+                file_log, api_model, include_video, template_customizations, compiled_template,
+                render_mode == "structured", stream_output, video_index, map_reduce_chunk_tokens, map_workers,
+                model_router)))
+
+        for filename, future in futures:
+            try:
+                saved, had_error, video_names = future.result()
+            except Exception as e:
+                log_callback(f"【錯誤】處理檔案 {filename} 時發生未預期錯誤: {e}")
+                log_callback(traceback.format_exc())
+                saved, had_error, video_names = False, True, []
+            if saved:
+                processed_count += 1
+                videos_to_mark.extend(video_names)
+                generated_html_paths.append(os.path.join(output_folder, f"{os.path.splitext(filename)[0]}.html"))
+            if had_error:
                 error_count += 1
                 overall_success = False
-        
-        # --- Step 2: 提取影片嵌入代碼 ---
-        # 嘗試從 base_name 推斷原始影片名稱 (如果包含 '+', 取第一部分)
-        original_video_name_guess = base_name.split('+')[0]
-        video_embed_html = generate_video_embed(original_video_name_guess, video_urls_data, log_callback)
-        
-        # --- Step 3: 使用AI將內容整合進HTML模板 ---
-        log_callback("【日誌】使用AI將處理後的內容整合到HTML模板...")
-        final_html = generate_html_with_ai(
-            api_key=api_key,
-            original_content=processed_content,  # 已處理過的內容
-            video_embed_html=video_embed_html,   # 影片嵌入代碼
-            template_content=html_template_content,  # 原始HTML模板
-            template_customizations=template_customizations, # <-- 傳遞自訂設定
-            log_callback=log_callback, # <-- 確保 log_callback 在正確位置
-            model_name=api_model,
-            include_video=include_video  # 傳遞是否包含影片區域的設定
-        )
-        
-        if final_html is None:
-            log_callback("【錯誤】無法生成最終HTML，跳過此檔案。")
-            error_count += 1
-            overall_success = False
-            continue
-        
-        # --- 儲存最終HTML ---
-        output_filename = f"{base_name}.html"
-        output_path = os.path.join(output_folder, output_filename)
-        
-        try:
-            with open(output_path, "w", encoding="utf-8") as f:
-                f.write(final_html)
-            log_callback(f"【成功】已生成並儲存HTML電子報: {output_filename}")
-            processed_count += 1
-            
-            # 更新影片URL設定檔中的處理狀態
-            if original_video_name_guess in video_urls_data:
-                video_urls_data[original_video_name_guess]["processed"] = True
-        except Exception as e:
-            log_callback(f"【錯誤】儲存HTML檔案失敗: {e}")
-            error_count += 1
-            overall_success = False
-    
-    # --- 儲存更新後的 URL 設定檔 ---
-    save_video_urls(video_urls_data, url_config_path, log_callback)
+
+    # 更新影片URL設定檔中的處理狀態 (所有工作已結束，只在主執行緒修改)；
+    # 先前中斷 (尚未寫入 URL 設定檔) 的執行在日誌中完成的檔案一併標記，已寫入過的記錄不再重複標記，
+    # 使用者清除 processed 標記後不會被日誌蓋回
+    for video_name in set(videos_to_mark) | journal.completed_videos():
+        if video_name in video_urls_data:
+            video_urls_data[video_name]["processed"] = True
+
+    remove_empty_partial_folder(output_folder, log_callback)
+
+    # --- 儲存更新後的 URL 設定檔，並整理進度日誌 ---
+    urls_saved = save_video_urls(video_urls_data, url_config_path, log_callback)
+    journal.compact(log_callback, mark_applied=urls_saved)
+
+    # --- 壓縮輸出 HTML 並檢查大小 ---
+    # 此函數通常在 GUI 的背景執行緒中執行，main_gui.py 無法安全地被行程池重新匯入，因此改用執行緒池
+    if minify_output and generated_html_paths:
+        minify_files(generated_html_paths, size_budget_kb, log_callback, use_processes=False)
+
+    # --- 模型路由統計 (用於調整路由門檻) ---
+    model_router.report(log_callback)
+    if route_stats_path:
+        model_router.save_stats(route_stats_path, log_callback)
     
     # --- 處理完成報告 ---
     log_callback(f"\n--- Step 4 處理完成 ---")
     log_callback(f"總共處理: {total_files} 個檔案")
     log_callback(f"成功生成: {processed_count} 個電子報")
+    if skipped_count:
+        log_callback(f"已完成而略過: {skipped_count} 個檔案")
     log_callback(f"處理失敗: {error_count} 個檔案")
     
     # 返回整體成功狀態
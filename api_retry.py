@@ -0,0 +1,184 @@
+# api_retry.py
+# Gemini REST 呼叫共用的重試策略 (指數退避 + 抖動、Retry-After) 與斷路器
+import json
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import requests
+
+# 只有這些狀態碼視為暫時性錯誤，值得重試 (403/400 等重試也不會成功)
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# google-generativeai 庫拋出的暫時性錯誤 (google.api_core.exceptions 的類別名稱)
+TRANSIENT_EXCEPTION_NAMES = {"TooManyRequests", "ResourceExhausted", "InternalServerError", "ServiceUnavailable",
+                             "DeadlineExceeded", "GatewayTimeout"}
+
+# 目前執行緒最近一次呼叫是否因暫時性錯誤失敗 (重試用盡的 429/5xx、網路錯誤、串流中斷)；
+# 模型路由只在這種情況改用備援模型，400/403 等請求本身的錯誤換模型也不會成功
+_call_state = threading.local()
+
+
+def parse_retry_after(value):
+    """解析 Retry-After 標頭 (秒數或 HTTP 日期)，回傳秒數或 None"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+class RetryPolicy:
+    """指數退避重試策略 (full jitter)，並遵守伺服器回傳的 Retry-After"""
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=60.0,
+                 max_retry_after=300.0, retryable_status_codes=RETRYABLE_STATUS_CODES):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after # 避免伺服器要求等待過久而卡住整個流程
+        self.retryable_status_codes = set(retryable_status_codes)
+
+    def is_retryable_status(self, status_code):
+        return status_code in self.retryable_status_codes
+
+    def compute_delay(self, attempt, retry_after=None):
+        """計算第 attempt 次失敗後要等待的秒數 (attempt 從 1 開始)"""
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        delay = random.uniform(0, ceiling)
+        if retry_after is not None:
+            # 伺服器明確指定時，至少等到它要求的時間
+            delay = max(delay, min(retry_after, self.max_retry_after))
+        return delay
+
+
+class CircuitBreaker:
+    """
+    依近期錯誤率開關的斷路器。
+
+    錯誤率超過門檻時進入「斷開」狀態，所有共用此斷路器的工作執行緒都會
+    暫停到冷卻時間結束，避免在 API 大量出錯時繼續送出請求。
+    """
+
+    def __init__(self, window_size=20, min_calls=5, error_rate_threshold=0.5, cooldown_seconds=30.0):
+        self.window_size = window_size
+        self.min_calls = min_calls
+        self.error_rate_threshold = error_rate_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._outcomes = deque(maxlen=window_size)
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    def wait_if_open(self, log_callback, sleep=time.sleep):
+        """如果斷路器斷開，暫停直到冷卻結束，回傳實際等待的秒數"""
+        with self._lock:
+            remaining = self._open_until - time.time()
+        if remaining <= 0:
+            return 0.0
+        log_callback(f"【警告】API 錯誤率過高，斷路器已斷開，暫停 {remaining:.1f} 秒後再繼續...")
+        sleep(remaining)
+        return remaining
+
+    def record(self, success, log_callback):
+        """記錄一次呼叫結果，必要時斷開斷路器"""
+        with self._lock:
+            self._outcomes.append(bool(success))
+            if len(self._outcomes) < self.min_calls:
+                return
+            failures = self._outcomes.count(False)
+            error_rate = failures / len(self._outcomes)
+            if error_rate >= self.error_rate_threshold and self._open_until <= time.time():
+                self._open_until = time.time() + self.cooldown_seconds
+                self._outcomes.clear() # 冷卻後重新統計 (半開狀態)
+                log_callback(f"【警告】近期 API 錯誤率 {error_rate:.0%}，斷路器斷開 {self.cooldown_seconds:.0f} 秒。")
+
+
+def clear_transient_failure():
+    """開始一次新的呼叫前清除目前執行緒的暫時性失敗標記"""
+    _call_state.transient_failure = False
+
+
+def mark_transient_failure():
+    """記錄目前執行緒的呼叫因暫時性錯誤失敗 (呼叫端回傳 None 前使用)"""
+    _call_state.transient_failure = True
+
+
+def had_transient_failure():
+    """目前執行緒自上次 clear_transient_failure 後是否發生過暫時性失敗"""
+    return getattr(_call_state, "transient_failure", False)
+
+
+def is_transient_exception(error):
+    """例外是否屬於暫時性錯誤 (網路連線/逾時，或 genai 庫的 429/5xx/逾時例外)"""
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    return type(error).__name__ in TRANSIENT_EXCEPTION_NAMES
+
+
+# 模組層級的預設實例：同一個行程中的所有 API 呼叫共用同一個斷路器
+DEFAULT_RETRY_POLICY = RetryPolicy()
+DEFAULT_CIRCUIT_BREAKER = CircuitBreaker()
+
+
+def post_with_retry(endpoint, payload, log_callback, timeout=60, headers=None,
+                    policy=None, breaker=None, sleep=time.sleep, stream=False):
+    """
+    以重試策略送出 POST 請求。
+
+    stream 為 True 時不預先下載回應內容 (串流端點)；只有取得回應之前的錯誤會重試。
+
+    Returns:
+        requests.Response: 最後一次取得的回應 (可能仍是錯誤狀態碼，由呼叫端處理)。
+
+    Raises:
+        requests.exceptions.RequestException: 所有嘗試都發生網路錯誤時，拋出最後一次的例外。
+    """
+    policy = policy or DEFAULT_RETRY_POLICY
+    breaker = breaker or DEFAULT_CIRCUIT_BREAKER
+    headers = headers or {"Content-Type": "application/json"}
+    data = json.dumps(payload)
+
+    total_backoff = 0.0
+    attempt = 0
+    while True:
+        attempt += 1
+        total_backoff += breaker.wait_if_open(log_callback, sleep)
+
+        retry_after = None
+        try:
+            response = requests.post(endpoint, headers=headers, data=data, timeout=timeout, stream=stream)
+        except requests.exceptions.RequestException as e:
+            breaker.record(False, log_callback)
+            if attempt >= policy.max_attempts:
+                log_callback(f"【日誌】API 呼叫失敗：嘗試 {attempt} 次，總退避 {total_backoff:.1f} 秒。")
+                mark_transient_failure()
+                raise
+            reason = f"網路錯誤 {e}"
+        else:
+            if not policy.is_retryable_status(response.status_code):
+                # 成功或不可重試的錯誤 (例如 403 金鑰無效) 都直接交給呼叫端；
+                # 後者是請求本身的問題而非服務異常，不計入斷路器 (也不算成功，以免壓低實際錯誤率)
+                if response.status_code < 400:
+                    breaker.record(True, log_callback)
+                log_callback(f"【日誌】API 呼叫結束：嘗試 {attempt} 次，總退避 {total_backoff:.1f} 秒。")
+                return response
+            breaker.record(False, log_callback)
+            if attempt >= policy.max_attempts:
+                log_callback(f"【日誌】API 呼叫重試用盡：嘗試 {attempt} 次，總退避 {total_backoff:.1f} 秒。")
+                mark_transient_failure()
+                return response
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            reason = f"狀態碼 {response.status_code}"
+
+        delay = policy.compute_delay(attempt, retry_after)
+        log_callback(f"【警告】API 呼叫失敗 ({reason})，{delay:.1f} 秒後進行第 {attempt + 1}/{policy.max_attempts} 次嘗試...")
+        sleep(delay)
+        total_backoff += delay
@@ -0,0 +1,114 @@
+# content_cache.py
+# Step2 -> Step3 的檔案內容快取：有記憶體上限，超過時把最久未使用的內容暫存到磁碟
+import os
+import sys
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class ContentCache:
+    """
+    以檔名為鍵的文字內容快取 (執行緒安全)。
+
+    記憶體中的內容總量超過 max_memory_bytes 時，最久未使用的項目會寫到本機暫存資料夾，
+    之後取用時再從暫存檔讀回，避免再次從 (可能是雲端同步的) 原始資料夾讀取。
+    """
+
+    def __init__(self, max_memory_bytes=256 * 1024 * 1024, spill_dir=None):
+        self.max_memory_bytes = max_memory_bytes
+        self._spill_root = spill_dir
+        self._spill_dir = None
+        self._memory = OrderedDict() # filename -> content
+        self._memory_bytes = 0
+        self._spilled = {} # filename -> 暫存檔路徑
+        self._spill_counter = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def _size_of(content):
+        return sys.getsizeof(content)
+
+    def put(self, filename, content):
+        """放入內容；若已存在則覆蓋"""
+        if content is None:
+            return
+        with self._lock:
+            self._discard(filename)
+            self._memory[filename] = content
+            self._memory_bytes += self._size_of(content)
+            self._evict_if_needed()
+
+    def get(self, filename):
+        """取得內容，不在快取中時回傳 None"""
+        with self._lock:
+            if filename in self._memory:
+                self._memory.move_to_end(filename)
+                self.hits += 1
+                return self._memory[filename]
+            spill_path = self._spilled.get(filename)
+        if spill_path is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            with open(spill_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return content
+
+    def __contains__(self, filename):
+        with self._lock:
+            return filename in self._memory or filename in self._spilled
+
+    def _discard(self, filename):
+        if filename in self._memory:
+            self._memory_bytes -= self._size_of(self._memory.pop(filename))
+        spill_path = self._spilled.pop(filename, None)
+        if spill_path and os.path.exists(spill_path):
+            os.remove(spill_path)
+
+    def _evict_if_needed(self):
+        while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+            filename, content = self._memory.popitem(last=False)
+            self._memory_bytes -= self._size_of(content)
+            try:
+                if self._spill_dir is None:
+                    self._spill_dir = tempfile.mkdtemp(prefix="content_cache_", dir=self._spill_root)
+                self._spill_counter += 1
+                spill_path = os.path.join(self._spill_dir, f"{self._spill_counter}.txt")
+                with open(spill_path, 'w', encoding='utf-8') as f:
+                    f.write(content)
+                self._spilled[filename] = spill_path
+            except OSError:
+                pass # 暫存失敗就直接丟棄，之後會改從原始檔案讀取
+
+    def stats_text(self):
+        """回傳快取使用狀況的說明文字 (用於日誌)"""
+        with self._lock:
+            return (f"命中 {self.hits} 次、未命中 {self.misses} 次，記憶體 {len(self._memory)} 筆"
+                    f" ({self._memory_bytes / 1024 / 1024:.1f} MB)，磁碟暫存 {len(self._spilled)} 筆")
+
+    def close(self):
+        """清除快取與暫存資料夾"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            self._spilled.clear()
+            if self._spill_dir and os.path.isdir(self._spill_dir):
+                shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
@@ -0,0 +1,151 @@
+# docx_text.py
+# 輕量 DOCX 文字擷取：直接串流解析 zip 內的 word/document.xml，並以檔案雜湊快取擷取結果
+import os
+import zipfile
+import threading
+import xml.etree.ElementTree as ET
+
+from file_utils import file_sha256, text_sha256, atomic_write_text
+
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+W_P = W_NS + "p"
+W_R = W_NS + "r"
+W_HYPERLINK = W_NS + "hyperlink"
+W_T = W_NS + "t"
+W_TAB = W_NS + "tab"
+W_PTAB = W_NS + "ptab"
+W_BR = W_NS + "br"
+W_CR = W_NS + "cr"
+W_NO_BREAK_HYPHEN = W_NS + "noBreakHyphen"
+W_TYPE = W_NS + "type"
+
+# 擷取結果快取放在本機的使用者快取資料夾 (轉錄稿資料夾常是雲端同步/共用資料夾，不寫入其中)，Step2 與 Step3 共用；
+# 每個來源資料夾一個子資料夾，才能依資料夾內現有的檔案清除過期的快取
+DOCX_TEXT_CACHE_ROOT = os.path.join(
+    os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "media-to-newsletter", "docx_text_cache")
+
+# 本次執行讀取過的快取檔名 (擷取快取資料夾 -> set)，清除過期快取時不必重新計算雜湊
+_used_cache_names = {}
+_used_lock = threading.Lock()
+
+# document > body > p：只取 body 的直接子段落，與 python-docx 的 doc.paragraphs 相同
+_BODY_PARAGRAPH_DEPTH = 3
+
+
+def _run_item_text(elem):
+    """單一 run 子元素對應的文字 (規則與 python-docx 的 Run.text 相同)"""
+    tag = elem.tag
+    if tag == W_T:
+        return elem.text or ""
+    if tag in (W_TAB, W_PTAB):
+        return "\t"
+    if tag == W_CR:
+        return "\n"
+    if tag == W_BR:
+        # 只有一般換行 (textWrapping) 算換行，分頁/分欄不輸出文字
+        return "\n" if elem.get(W_TYPE, "textWrapping") == "textWrapping" else ""
+    if tag == W_NO_BREAK_HYPHEN:
+        return "-"
+    return ""
+
+
+def extract_docx_text(filepath):
+    """
+    以串流方式擷取 DOCX 的段落文字，段落間以換行連接。
+
+    輸出與 '\\n'.join(p.text for p in docx.Document(filepath).paragraphs) 相同，
+    但不建立完整的文件物件模型，且解析過的元素會立即釋放。
+
+    Raises:
+        zipfile.BadZipFile, KeyError, xml.etree.ElementTree.ParseError: 檔案不是有效的 DOCX。
+    """
+    paragraphs = []
+    with zipfile.ZipFile(filepath) as archive:
+        with archive.open("word/document.xml") as xml_file:
+            path = [] # 目前所在段落內的標籤路徑 (p 之下)
+            depth = 0
+            current = None
+            for event, elem in ET.iterparse(xml_file, events=("start", "end")):
+                if event == "start":
+                    depth += 1
+                    if current is not None:
+                        path.append(elem.tag)
+                    elif depth == _BODY_PARAGRAPH_DEPTH and elem.tag == W_P:
+                        current = []
+                    continue
+
+                if current is not None and path:
+                    # run 直接位於段落下，或位於段落內的超連結下
+                    if len(path) == 2 and path[0] == W_R:
+                        current.append(_run_item_text(elem))
+                    elif len(path) == 3 and path[0] == W_HYPERLINK and path[1] == W_R:
+                        current.append(_run_item_text(elem))
+                    path.pop()
+                elif current is not None and depth == _BODY_PARAGRAPH_DEPTH:
+                    paragraphs.append("".join(current))
+                    current = None
+
+                if depth == _BODY_PARAGRAPH_DEPTH:
+                    elem.clear() # 釋放已處理的 body 子元素
+                depth -= 1
+    return "\n".join(paragraphs)
+
+
+def docx_text_cache_dir(folder):
+    """來源資料夾對應的擷取快取資料夾"""
+    return os.path.join(DOCX_TEXT_CACHE_ROOT, text_sha256(os.path.normcase(os.path.abspath(folder)))[:16])
+
+
+def read_docx_text(filepath):
+    """
+    讀取 DOCX 文字，優先使用以檔案內容雜湊為鍵的擷取快取。
+
+    同一份檔案在 Step2 與 Step3 (或下一次執行) 只需解析一次；檔案內容改變時雜湊不同，自然不會命中舊快取。
+    """
+    cache_dir = docx_text_cache_dir(os.path.dirname(os.path.abspath(filepath)))
+    cache_name = file_sha256(filepath) + ".txt"
+    with _used_lock:
+        _used_cache_names.setdefault(cache_dir, set()).add(cache_name)
+    cache_path = os.path.join(cache_dir, cache_name)
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except OSError:
+        pass
+
+    text = extract_docx_text(filepath)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        atomic_write_text(cache_path, text)
+    except OSError:
+        pass # 快取寫入失敗 (例如唯讀資料夾) 不影響結果
+    return text
+
+
+def prune_docx_text_cache(folder, log_callback=print, content_hashes=()):
+    """
+    清除來源資料夾已不存在 (或內容已改變) 的 DOCX 所留下的擷取快取。
+
+    只保留本次執行擷取時用到的快取，以及 content_hashes (本次已計算的來源內容雜湊，例如 Step2 的結果) 對應的快取；
+    不重新讀取資料夾中的 DOCX 計算雜湊。
+
+    Returns:
+        int: 刪除的快取檔案數。
+    """
+    cache_dir = docx_text_cache_dir(folder)
+    with _used_lock:
+        current = _used_cache_names.pop(cache_dir, set())
+    current.update(f"{content_hash}.txt" for content_hash in content_hashes if content_hash)
+    removed = 0
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            if name not in current:
+                try:
+                    os.remove(os.path.join(cache_dir, name))
+                    removed += 1
+                except OSError:
+                    pass
+    if removed:
+        log_callback(f"【日誌】已清除 {removed} 個過期的 DOCX 擷取快取。")
+    return removed
@@ -0,0 +1,142 @@
+# file_utils.py
+# 各步驟共用的檔案工具：內容雜湊、原子寫入與快速複製
+import os
+import json
+import stat
+import shutil
+import hashlib
+import tempfile
+import importlib.util # 用於檢查模組是否可用
+
+# fcntl 只存在於 POSIX 系統，Windows 上不使用 reflink
+has_fcntl = importlib.util.find_spec("fcntl") is not None
+if has_fcntl:
+    import fcntl
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Linux ioctl FICLONE：在支援的檔案系統 (Btrfs、XFS 等) 上建立共用資料區塊的複本 (reflink)
+FICLONE = 0x40049409
+
+# 行程的 umask (os.umask 只能以設定的方式讀取，匯入時讀一次再還原)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def file_sha256(filepath):
+    """計算檔案內容 (原始位元組) 的 SHA-256，用於判斷檔案是否變更"""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_text_with_sha256(filepath):
+    """
+    讀取 UTF-8 文字檔，並同時計算原始位元組的 SHA-256 (與 file_sha256 相同)，檔案只開啟一次。
+
+    換行與 open(filepath, 'r') 相同，\r\n 與 \r 都轉為 \n。
+
+    Returns:
+        tuple: (文字內容, SHA-256)。
+    """
+    with open(filepath, 'rb') as f:
+        raw = f.read()
+    text = raw.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+    return text, hashlib.sha256(raw).hexdigest()
+
+
+def text_sha256(text):
+    """計算文字內容 (UTF-8) 的 SHA-256"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def replace_file(temp_path, dest_path):
+    """
+    以暫存檔原子地取代 dest_path。
+
+    mkstemp 建立的暫存檔權限為 0600，取代前改為原檔的權限 (新檔案則與 open(..., 'w') 相同，依 umask)，
+    避免輸出檔變成只有擁有者可讀。
+    """
+    try:
+        mode = stat.S_IMODE(os.stat(dest_path).st_mode)
+    except OSError:
+        mode = 0o666 & ~_UMASK
+    os.chmod(temp_path, mode)
+    os.replace(temp_path, dest_path)
+
+
+def atomic_write_text(filepath, text):
+    """先寫入同目錄的暫存檔再取代，避免中途中斷留下半個檔案"""
+    directory = os.path.dirname(os.path.abspath(filepath))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(filepath) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        replace_file(temp_path, filepath)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def atomic_write_json(filepath, data, indent=2):
+    """以原子寫入方式儲存 JSON"""
+    atomic_write_text(filepath, json.dumps(data, ensure_ascii=False, indent=indent))
+
+
+def load_json(filepath, default=None):
+    """讀取 JSON 檔案；檔案不存在或格式錯誤時回傳 default"""
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as src_f, open(dst, 'wb') as dst_f:
+        fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+
+
+def copy_file_fast(src, dst, allow_hardlink=False):
+    """
+    以最省的方式將檔案原封不動複製到 dst (位元組完全相同，先寫暫存檔再取代)。
+
+    依序嘗試：硬連結 (需 allow_hardlink，且同一檔案系統)、reflink (Linux FICLONE)，
+    最後使用 shutil.copyfile (會自動使用 sendfile/copy_file_range 等系統呼叫，不支援時改為緩衝複製)。
+    注意硬連結與來源共用同一份資料，就地修改輸出檔會連帶修改來源。
+
+    Returns:
+        str: 使用的方式，"hardlink"、"reflink" 或 "copy"。
+    """
+    directory = os.path.dirname(os.path.abspath(dst))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(dst) + ".", suffix=".tmp")
+    os.close(fd)
+    try:
+        method = None
+        if allow_hardlink:
+            try:
+                os.remove(temp_path)
+                os.link(src, temp_path)
+                method = "hardlink"
+            except OSError:
+                pass # 跨檔案系統或不支援硬連結
+        if method is None and has_fcntl:
+            try:
+                _reflink(src, temp_path)
+                method = "reflink"
+            except OSError:
+                pass # 檔案系統不支援 reflink
+        if method is None:
+            shutil.copyfile(src, temp_path)
+            method = "copy"
+        if method == "hardlink":
+            os.replace(temp_path, dst) # 與來源共用 inode，不能修改權限
+        else:
+            replace_file(temp_path, dst)
+        return method
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
@@ -0,0 +1,182 @@
+# gemini_stream.py
+# Gemini streamGenerateContent (SSE) 串流接收：邊收邊寫入 .part 暫存檔並回報進度，完成後才原子提交
+import os
+import json
+import time
+
+import requests
+
+from api_retry import post_with_retry, mark_transient_failure
+from token_utils import estimate_tokens
+
+# 每隔幾秒回報一次進度 (避免串流片段很多時洗版)
+PROGRESS_INTERVAL_SECONDS = 2.0
+PART_SUFFIX = ".part"
+# 暫存檔放在輸出資料夾下的子資料夾，掃描輸出資料夾的後續步驟 (壓縮、Step5) 不會讀到中斷留下的檔案
+PARTIAL_FOLDER_NAME = "_partial"
+
+
+class StreamError(Exception):
+    """串流中斷或回應內容不正確；partial_path 為已收到內容的暫存檔 (沒有時為 None)"""
+
+    def __init__(self, message, partial_path=None):
+        super().__init__(message)
+        self.partial_path = partial_path
+
+
+def iter_sse_events(lines):
+    """
+    解析 server-sent events，逐一回傳每個事件 data 欄位的 JSON 物件。
+
+    Args:
+        lines: 文字行 (str 或 UTF-8 bytes，例如 response.iter_lines())。
+    """
+    data_lines = []
+    for line in lines:
+        if line is None:
+            continue
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.rstrip("\r")
+        if not line: # 空行代表一個事件結束
+            if data_lines:
+                yield json.loads("\n".join(data_lines))
+                data_lines = []
+            continue
+        if line.startswith(":"):
+            continue # 註解 (keep-alive)
+        field, _, value = line.partition(":")
+        if field == "data":
+            data_lines.append(value[1:] if value.startswith(" ") else value)
+    if data_lines:
+        yield json.loads("\n".join(data_lines))
+
+
+def _chunk_text(event):
+    """取出一個串流片段中的文字；被封鎖時拋出 StreamError"""
+    block_reason = event.get("promptFeedback", {}).get("blockReason")
+    if block_reason:
+        raise StreamError(f"API 回應缺少內容，原因: {block_reason}")
+    candidates = event.get("candidates", [])
+    if not candidates:
+        return ""
+    parts = candidates[0].get("content", {}).get("parts", [])
+    return "".join(part.get("text", "") for part in parts)
+
+
+def partial_path(output_folder, name):
+    """output_folder 中 name 對應的串流暫存檔路徑 (位於 PARTIAL_FOLDER_NAME 子資料夾，必要時建立)"""
+    folder = os.path.join(output_folder, PARTIAL_FOLDER_NAME)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, name + PART_SUFFIX)
+
+
+def discard_partials(output_folder, names):
+    """刪除這些名稱先前中斷時留下的暫存檔 (已重新生成成功)"""
+    for name in names:
+        try:
+            os.remove(os.path.join(output_folder, PARTIAL_FOLDER_NAME, name + PART_SUFFIX))
+        except OSError:
+            pass
+
+
+def remove_empty_partial_folder(output_folder, log_callback=print):
+    """暫存資料夾沒有檔案時移除；仍有中斷保留的內容時提示數量"""
+    folder = os.path.join(output_folder, PARTIAL_FOLDER_NAME)
+    try:
+        remaining = os.listdir(folder)
+        if not remaining:
+            os.rmdir(folder)
+    except OSError:
+        return
+    if remaining:
+        log_callback(f"【提示】{folder} 中保留了 {len(remaining)} 個中斷的生成內容 (重新執行成功後會自動刪除)。")
+
+
+def _keep_partial(part_path, chunks):
+    """失敗時的暫存檔處理：有收到內容就保留並回傳路徑，否則刪除並回傳 None"""
+    if chunks:
+        return part_path
+    try:
+        os.remove(part_path)
+    except OSError:
+        pass
+    return None
+
+
+def stream_generate_content(endpoint, payload, part_path, log_callback, commit_path=None, timeout=300,
+                            headers=None, progress_interval=PROGRESS_INTERVAL_SECONDS, clock=time.monotonic):
+    """
+    呼叫 streamGenerateContent (?alt=sse) 並把收到的文字依序寫入 part_path。
+
+    串流完整結束後：有指定 commit_path 時以 os.replace 原子地改名為 commit_path，否則刪除暫存檔。
+    中途失敗時保留 part_path (已生成的內容不會遺失) 並拋出 StreamError。
+
+    Returns:
+        tuple: (完整文字, usageMetadata dict)。
+
+    Raises:
+        StreamError: 狀態碼錯誤、連線中斷或回應格式錯誤。
+    """
+    try:
+        response = post_with_retry(endpoint, payload, log_callback, timeout=timeout, headers=headers, stream=True)
+    except requests.exceptions.RequestException as e:
+        raise StreamError(f"呼叫 API 時網路連線錯誤：{e}")
+    if response.status_code != 200:
+        raise StreamError(f"API 回傳狀態碼 {response.status_code}: {response.text}")
+
+    chunks = []
+    received_bytes = 0
+    estimated_tokens = 0 # 累計估計值 (每個片段只估計一次，避免每次回報都重新計算全部內容)
+    usage = {}
+    finish_reason = None
+    started = clock()
+    last_report = started
+    try:
+        with response, open(part_path, 'w', encoding='utf-8') as part_file:
+            # 自行以 UTF-8 解碼 (text/event-stream 未標示 charset 時 requests 會誤用 ISO-8859-1)
+            for event in iter_sse_events(response.iter_lines()):
+                text = _chunk_text(event)
+                usage = event.get("usageMetadata", usage)
+                candidates = event.get("candidates", [])
+                if candidates and candidates[0].get("finishReason"):
+                    finish_reason = candidates[0]["finishReason"]
+                if text:
+                    part_file.write(text)
+                    part_file.flush()
+                    chunks.append(text)
+                    received_bytes += len(text.encode('utf-8'))
+                    estimated_tokens += estimate_tokens(text)
+                now = clock()
+                if now - last_report >= progress_interval:
+                    last_report = now
+                    tokens = usage.get("candidatesTokenCount") or estimated_tokens
+                    log_callback(f"【日誌】串流生成中：已接收 {received_bytes / 1024:.1f} KB，約 {tokens} tokens "
+                                 f"({now - started:.0f} 秒)...")
+    except (requests.exceptions.RequestException, ValueError, OSError) as e:
+        if isinstance(e, requests.exceptions.RequestException):
+            mark_transient_failure() # 連線中斷，換模型 (或重新執行) 可能成功
+        raise StreamError(f"串流中斷：{e}", partial_path=_keep_partial(part_path, chunks))
+    except StreamError as e:
+        e.partial_path = _keep_partial(part_path, chunks)
+        raise
+
+    full_text = "".join(chunks)
+    if finish_reason is None:
+        # 最後一個片段一定帶有 finishReason；沒有收到表示連線提前結束
+        mark_transient_failure()
+        raise StreamError("串流未正常結束 (未收到完成原因)", partial_path=_keep_partial(part_path, chunks))
+    if not full_text.strip():
+        _keep_partial(part_path, [])
+        raise StreamError(f"API 回傳生成的內容為空。完成原因: {finish_reason}")
+    if finish_reason != "STOP":
+        log_callback(f"【警告】串流結束原因為 {finish_reason}，內容可能不完整。")
+
+    if commit_path:
+        os.replace(part_path, commit_path)
+    else:
+        os.remove(part_path)
+    tokens = usage.get("candidatesTokenCount") or estimate_tokens(full_text)
+    log_callback(f"【日誌】串流生成完成：共 {received_bytes / 1024:.1f} KB，約 {tokens} tokens "
+                 f"({clock() - started:.1f} 秒)。")
+    return full_text, usage
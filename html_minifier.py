@@ -0,0 +1,180 @@
+# html_minifier.py
+# 電子報 HTML 壓縮與大小檢查：合併空白、移除註解、精簡 inline style，並依大小上限回報 (Gmail 超過約 102 KB 會截斷郵件)
+import os
+import re
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from file_utils import atomic_write_text
+
+# Gmail 會截斷超過約 102 KB 的郵件
+DEFAULT_SIZE_BUDGET_KB = 102
+
+# 必須保留的註解：Step5 以這兩個標記定位影片區；Outlook 條件式註解也不能移除
+PRESERVED_COMMENTS = {"<!-- 影片區 -->", "<!-- 內容區 -->"}
+_CONDITIONAL_COMMENT_PATTERN = re.compile(r"^<!--\[if|<!\[endif\]-->$", re.I)
+
+# 依序切出：註解、內容不可更動的區塊、標籤；其餘為文字
+_TOKEN_PATTERN = re.compile(
+    r"(<!--.*?-->|<(pre|textarea|script)\b.*?</\2\s*>|<style\b.*?</style\s*>|<[^>]+>)", re.S | re.I)
+_STYLE_ATTRIBUTE_PATTERN = re.compile(r"""\sstyle\s*=\s*(["'])(.*?)\1""", re.S | re.I)
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+_CSS_PUNCTUATION_PATTERN = re.compile(r"\s*([{};,])\s*")
+_CSS_DECLARATION_PATTERN = re.compile(r"\s*:\s*")
+
+# 區塊層級的標籤：前後的空白不影響排版，可以直接移除
+_BLOCK_TAGS = {
+    "html", "head", "body", "meta", "link", "title", "style", "table", "thead", "tbody", "tfoot", "tr", "td", "th",
+    "div", "p", "h1", "h2", "h3", "h4", "h5", "h6", "ul", "ol", "li", "blockquote", "hr", "br", "center",
+    "section", "header", "footer", "article", "main", "nav", "iframe", "!doctype",
+}
+_TAG_NAME_PATTERN = re.compile(r"^</?\s*(!?[a-zA-Z][\w-]*)")
+
+
+def _minify_style_value(style):
+    """精簡 inline style：合併空白、去掉冒號/分號前後的空白與結尾分號"""
+    style = _WHITESPACE_PATTERN.sub(" ", style).strip()
+    declarations = [d.strip() for d in style.split(";") if d.strip()]
+    return ";".join(_CSS_DECLARATION_PATTERN.sub(":", d, count=1) for d in declarations)
+
+
+def _minify_tag(tag):
+    tag = _STYLE_ATTRIBUTE_PATTERN.sub(
+        lambda m: f" style={m.group(1)}{_minify_style_value(m.group(2))}{m.group(1)}", tag)
+    return _WHITESPACE_PATTERN.sub(" ", tag).replace(" >", ">").replace(" />", "/>")
+
+
+def _is_block_boundary(token):
+    """註解與區塊層級標籤前後的空白可以移除"""
+    if token.startswith("<!--"):
+        return True
+    match = _TAG_NAME_PATTERN.match(token)
+    return bool(match) and match.group(1).lower() in _BLOCK_TAGS
+
+
+def minify_html(html_text):
+    """
+    壓縮 HTML 字串。
+
+    - 移除一般註解 (保留 PRESERVED_COMMENTS 與 Outlook 條件式註解)。
+    - 文字中的連續空白合併為一個空白；區塊層級標籤前後的空白直接移除。
+    - 標籤內的空白合併，style 屬性精簡。
+    - <pre>、<textarea>、<script> 內容原樣保留；<style> 只做安全的空白精簡。
+    """
+    tokens = []
+    position = 0
+    for match in _TOKEN_PATTERN.finditer(html_text):
+        if match.start() > position:
+            tokens.append(("text", html_text[position:match.start()]))
+        token = match.group(1)
+        lowered = token[:10].lower()
+        if token.startswith("<!--"):
+            if token.strip() in PRESERVED_COMMENTS or _CONDITIONAL_COMMENT_PATTERN.search(token):
+                tokens.append(("tag", token))
+        elif lowered.startswith(("<pre", "<textarea", "<script")):
+            tokens.append(("raw", token))
+        elif lowered.startswith("<style"):
+            open_end = token.index(">") + 1
+            close_start = token.lower().rindex("</style")
+            css = _CSS_PUNCTUATION_PATTERN.sub(r"\1", _WHITESPACE_PATTERN.sub(" ", token[open_end:close_start]))
+            tokens.append(("tag", f"{_minify_tag(token[:open_end])}{css.strip()}</style>"))
+        else:
+            tokens.append(("tag", _minify_tag(token)))
+        position = match.end()
+    if position < len(html_text):
+        tokens.append(("text", html_text[position:]))
+
+    output = []
+    for index, (kind, token) in enumerate(tokens):
+        if kind != "text":
+            output.append(token)
+            continue
+        text = _WHITESPACE_PATTERN.sub(" ", token)
+        previous_token = tokens[index - 1][1] if index > 0 else None
+        next_token = tokens[index + 1][1] if index + 1 < len(tokens) else None
+        if previous_token is None or _is_block_boundary(previous_token):
+            text = text.lstrip(" ")
+        if next_token is None or _is_block_boundary(next_token):
+            text = text.rstrip(" ")
+        if text:
+            output.append(text)
+    return "".join(output)
+
+
+def minify_file(html_path, budget_bytes):
+    """
+    壓縮單一 HTML 檔案 (內容有變才以原子寫入覆蓋)；供行程池呼叫，因此不使用 log_callback。
+
+    Returns:
+        tuple: (檔名, 原始位元組數, 壓縮後位元組數, 是否超過上限, 錯誤訊息或 None)。
+    """
+    filename = os.path.basename(html_path)
+    try:
+        with open(html_path, 'r', encoding='utf-8') as f:
+            original = f.read()
+        minified = minify_html(original)
+        if minified != original:
+            atomic_write_text(html_path, minified)
+    except (OSError, UnicodeDecodeError, ValueError) as e:
+        return filename, 0, 0, False, str(e)
+    before = len(original.encode('utf-8'))
+    after = len(minified.encode('utf-8'))
+    return filename, before, after, after > budget_bytes, None
+
+
+def minify_folder(output_folder, size_budget_kb=DEFAULT_SIZE_BUDGET_KB, log_callback=print, max_workers=None,
+                  use_processes=True):
+    """壓縮資料夾內所有 .html 檔案並回報每個檔案的大小 (命令列使用；Step4 只壓縮本次生成的檔案，見 minify_files)"""
+    html_files = [os.path.join(output_folder, f) for f in os.listdir(output_folder) if f.lower().endswith(".html")]
+    return minify_files(html_files, size_budget_kb, log_callback, max_workers, use_processes)
+
+
+def minify_files(html_files, size_budget_kb=DEFAULT_SIZE_BUDGET_KB, log_callback=print, max_workers=None,
+                 use_processes=True):
+    """
+    壓縮指定的 HTML 檔案並回報每個檔案的大小。
+
+    Args:
+        html_files (list): HTML 檔案路徑。
+        size_budget_kb (float): 每封電子報的大小上限 (KB)，超過時發出警告。
+        use_processes (bool): 以行程池並行處理 (CPU 密集)。在 GUI 的背景執行緒中呼叫時請設為 False 改用執行緒池：
+            Windows 的行程池會重新匯入主程式，而 main_gui.py 沒有 __main__ 保護。
+
+    Returns:
+        list: 每個檔案的 minify_file 結果 (依檔名排序)。
+    """
+    html_files = sorted(html_files)
+    if not html_files:
+        return []
+    budget_bytes = size_budget_kb * 1024
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=max_workers) as pool:
+        results = list(pool.map(minify_file, html_files, [budget_bytes] * len(html_files)))
+
+    total_before = total_after = over_budget = 0
+    for filename, before, after, is_over, error in results:
+        if error:
+            log_callback(f"【警告】壓縮 HTML 失敗 {filename}: {error}")
+            continue
+        total_before += before
+        total_after += after
+        saved = (1 - after / before) * 100 if before else 0
+        line = f"{filename}: {before / 1024:.1f} KB -> {after / 1024:.1f} KB (-{saved:.0f}%)"
+        if is_over:
+            over_budget += 1
+            log_callback(f"【警告】{line}，超過大小上限 {size_budget_kb} KB，郵件可能被截斷。")
+        else:
+            log_callback(f"【日誌】{line}")
+    log_callback(f"【日誌】HTML 壓縮完成：{len(html_files)} 個檔案，共 {total_before / 1024:.1f} KB -> "
+                 f"{total_after / 1024:.1f} KB，超過大小上限 {over_budget} 個。")
+    return results
+
+
+# --- 命令列：壓縮整個輸出資料夾 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="壓縮電子報 HTML 並檢查大小上限")
+    parser.add_argument("folder", help="HTML 輸出資料夾 (Step4 的輸出)")
+    parser.add_argument("--budget-kb", type=float, default=DEFAULT_SIZE_BUDGET_KB, help="每封電子報的大小上限 (KB)")
+    parser.add_argument("--workers", type=int, default=None, help="行程數 (預設為 CPU 核心數)")
+    args = parser.parse_args()
+    minify_folder(args.folder, args.budget_kb, max_workers=args.workers)
@@ -0,0 +1,153 @@
+# label_canonicalizer.py
+# 主題標籤正規化：把 API 回傳的自由格式主題標籤中幾乎相同的合併成同一個，讓 Step3 分組更少、更完整
+import os
+import re
+import json
+import unicodedata
+from collections import Counter
+
+from file_utils import atomic_write_json
+
+# 不參與正規化的標籤 (分類失敗的檔案維持原狀)
+PRESERVED_LABELS = {"分類失敗", "長度未知"}
+
+# 與 labels.json 放在同一資料夾：正規化後的標籤與原始 -> 標準標籤對照 (labels.json 與 video_urls.json 保留原始標籤)
+CANONICAL_LABELS_FILENAME = "labels_canonical.json"
+
+# 模型偶爾會加上的前綴，例如 "主題：銷售技巧"
+_PREFIX_PATTERN = re.compile(r"^(主題標籤|主題|標籤)\s*[:：]\s*")
+# 比對時忽略空白、標點與引號括號
+_IGNORED_CHARS_PATTERN = re.compile(r"[\s\W_]+")
+# 含數字的英數片段 (型號、集數、年份等)，不同就不是同一個主題，例如 "X1型號" 與 "X2型號"
+_NUMBERED_TOKEN_PATTERN = re.compile(r"[a-z]*\d+[a-z\d]*")
+
+
+def normalize_label(label):
+    """標籤的比對用形式：NFKC (全形轉半形)、英文小寫、去除前綴、空白與標點"""
+    text = unicodedata.normalize("NFKC", label).strip().lower()
+    text = _PREFIX_PATTERN.sub("", text)
+    return _IGNORED_CHARS_PATTERN.sub("", text)
+
+
+def char_ngrams(text, n=2):
+    """字元 n-gram 集合；比 n 短的文字以整段文字作為唯一的 n-gram"""
+    if len(text) < n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def label_similarity(a, b):
+    """兩個正規化標籤的字元二元組 Dice 相似度 (0 ~ 1)；含數字的片段不同時視為不相似"""
+    if set(_NUMBERED_TOKEN_PATTERN.findall(a)) != set(_NUMBERED_TOKEN_PATTERN.findall(b)):
+        return 0.0
+    grams_a, grams_b = char_ngrams(a), char_ngrams(b)
+    if not grams_a or not grams_b:
+        return 1.0 if a == b else 0.0
+    return 2 * len(grams_a & grams_b) / (len(grams_a) + len(grams_b))
+
+
+def load_synonym_map(path, log_callback=print):
+    """
+    讀取同義詞對照檔 (JSON)：{"標準標籤": ["同義標籤1", "同義標籤2", ...], ...}。
+
+    Returns:
+        dict: {正規化後的同義標籤: 標準標籤}；檔案不存在或格式錯誤時回傳空字典。
+    """
+    if not path:
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except Exception as e:
+        log_callback(f"【警告】讀取標籤同義詞檔失敗 {path}: {e}，將不使用同義詞對照。")
+        return {}
+
+    synonyms = {}
+    for canonical, variants in data.items():
+        synonyms[normalize_label(canonical)] = canonical
+        for variant in variants:
+            synonyms[normalize_label(variant)] = canonical
+    return synonyms
+
+
+def canonicalize_labels(labels_dict, threshold=0.7, synonyms=None):
+    """
+    合併幾乎相同的主題標籤。
+
+    1. 先套用同義詞對照 (以正規化後的形式比對)。
+    2. 正規化形式相同的標籤直接視為同一個。
+    3. 其餘依出現次數由多到少逐一處理：與某個既有群組所有成員的平均相似度達到門檻就加入該群組，
+       否則自成新群組。每個群組以出現最多次 (相同時取最短) 的原始標籤作為標準標籤。
+
+    Args:
+        labels_dict (dict): {檔名: 標籤}。
+        threshold (float): 字元二元組 Dice 相似度門檻 (0 ~ 1)，越高越保守。
+        synonyms (dict): load_synonym_map 的結果 (可選)。
+
+    Returns:
+        tuple: (新的 {檔名: 標準標籤}, {原始標籤: 標準標籤} 只包含有變更的標籤)。
+    """
+    synonyms = synonyms or {}
+    counts = Counter(label for label in labels_dict.values() if label not in PRESERVED_LABELS)
+
+    # 同義詞對照與正規化形式相同的標籤先歸到同一個鍵
+    key_of = {}
+    key_counts = Counter()
+    key_members = {}
+    for label, count in counts.items():
+        normalized = normalize_label(label)
+        key = normalize_label(synonyms[normalized]) if normalized in synonyms else normalized
+        key_of[label] = key
+        key_counts[key] += count
+        key_members.setdefault(key, []).append(label)
+
+    # 依出現次數 (多 -> 少)、長度 (短 -> 長) 排序後貪婪分群
+    clusters = [] # [[key, ...], ...]
+    for key in sorted(key_counts, key=lambda k: (-key_counts[k], len(k), k)):
+        best_cluster, best_score = None, threshold
+        for cluster in clusters:
+            score = sum(label_similarity(key, member) for member in cluster) / len(cluster)
+            if score >= best_score:
+                best_cluster, best_score = cluster, score
+        if best_cluster is None:
+            clusters.append([key])
+        else:
+            best_cluster.append(key)
+
+    canonical_of_key = {}
+    for cluster in clusters:
+        members = [label for key in cluster for label in key_members[key]]
+        synonym_targets = [synonyms[key] for key in cluster if key in synonyms]
+        if synonym_targets:
+            canonical = synonym_targets[0] # 同義詞檔指定的標準標籤優先
+        else:
+            canonical = min(members, key=lambda label: (-counts[label], len(label), label))
+        for key in cluster:
+            canonical_of_key[key] = canonical
+
+    mapping = {label: canonical_of_key[key_of[label]] for label in counts
+               if canonical_of_key[key_of[label]] != label}
+    new_labels = {filename: mapping.get(label, label) for filename, label in labels_dict.items()}
+    return new_labels, mapping
+
+
+def save_canonical_labels(label_folder, labels_dict, mapping, log_callback=print):
+    """
+    將正規化結果寫入標籤資料夾的 labels_canonical.json：{"labels": {檔名: 標準標籤}, "mapping": {原始標籤: 標準標籤}}。
+
+    Step3 依標準標籤合併，labels.json 與 video_urls.json 則保留原始標籤，可依此檔對照兩者。
+    labels_dict 為 None 時 (本次未正規化) 移除上次留下的檔案，避免與目前的合併結果不符。
+    """
+    path = os.path.join(label_folder, CANONICAL_LABELS_FILENAME)
+    if labels_dict is None:
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError as e:
+                log_callback(f"【警告】移除過期的標籤正規化結果失敗 {path}: {e}")
+        return
+    try:
+        atomic_write_json(path, {"labels": labels_dict, "mapping": mapping})
+        log_callback(f"【日誌】已將正規化後的標籤與對照儲存至：{path}")
+    except OSError as e:
+        log_callback(f"【警告】儲存標籤正規化結果失敗 {path}: {e}")
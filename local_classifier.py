@@ -0,0 +1,277 @@
+# local_classifier.py
+# 以歷史 labels.json 訓練的本地文字分類器 (字元 n-gram TF-IDF + 線性模型，僅需 CPU)
+#
+# 用法 (先評估，準確率達標後再於設定中啟用)：
+#   python local_classifier.py evaluate --criteria "教學/示範 & 長度 (需 API)" --history 標籤/labels.json=轉錄文字
+#   python local_classifier.py train    --criteria "教學/示範 & 長度 (需 API)" --history 標籤/labels.json=轉錄文字 --output 標籤/local_classifier.pkl
+#
+# 兩種教學/示範條件只學習「是否教學」一維 (模型可互通)，長度由 Step2 依實際影片長度組合成四分類標籤
+import os
+import json
+import time
+import pickle
+import argparse
+import importlib.util # 用於檢查模組是否已安裝
+from collections import Counter
+
+from token_utils import excerpt_transcript
+
+# scikit-learn 為選用依賴，未安裝時本地分類器停用，一律改用 API
+has_sklearn = importlib.util.find_spec("sklearn") is not None
+
+# 不可當作訓練資料的標籤 (分類失敗或無法判斷)
+IGNORED_LABELS = {"分類失敗", "長度未知"}
+
+# 特徵只取轉錄稿的節錄，訓練與預測都更快，且與分類 Prompt 看到的內容一致
+FEATURE_EXCERPT_TOKENS = 3000
+
+# 這兩種條件的模型只預測「是否教學」(True/False)；其餘條件 (主要內容主題) 直接預測標籤
+TEACHING_CRITERIA = ("教學/示範 & 長度 (需 API)", "教學/示範 (長度本地判斷，需 API)")
+TEACHING_TARGET = "is_teaching"
+# 原始四分類中屬於「有教學」/「示範/播放輔助」的分類號碼 (見 Step2 的 ORIGINAL_LABELS)
+_TEACHING_CATEGORIES = {"分類1": True, "分類2": True, "分類3": False, "分類4": False}
+
+
+def model_target(criteria):
+    """分類條件對應的模型預測目標：教學/示範條件為 TEACHING_TARGET，其餘為條件本身"""
+    return TEACHING_TARGET if criteria in TEACHING_CRITERIA else criteria
+
+
+def teaching_from_label(label):
+    """從原始四分類標籤 (例如 "分類2: ...") 取出是否教學；不是四分類標籤時回傳 None"""
+    return _TEACHING_CATEGORIES.get(label.split(":", 1)[0].strip())
+
+
+def build_features_text(content):
+    """將轉錄稿轉成分類器輸入文字 (長度不在特徵中，由 Step2 依實際影片長度處理)"""
+    return excerpt_transcript(content, FEATURE_EXCERPT_TOKENS, "head_middle_tail")
+
+
+def collect_training_samples(history, criteria, log_callback=print):
+    """
+    從歷史 labels.json 收集訓練樣本。
+
+    Args:
+        history (list): [(labels_json_path, transcription_folder), ...]。
+        criteria (str): 模型要使用的分類條件；教學/示範條件只取四分類標籤中的「是否教學」作為目標。
+        log_callback (callable): 日誌回呼函數。
+
+    Returns:
+        tuple: (texts, labels) 兩個等長的 list。
+    """
+    from Step2分類 import read_file_content # 延遲匯入，避免與 Step2 循環匯入
+
+    target = model_target(criteria)
+    texts, labels = [], []
+    seen_files = set()
+    for labels_path, transcription_folder in history:
+        try:
+            with open(labels_path, 'r', encoding='utf-8') as f:
+                labels_dict = json.load(f)
+        except Exception as e:
+            log_callback(f"【警告】讀取歷史標籤檔失敗，將跳過 {labels_path}: {e}")
+            continue
+
+        used = 0
+        for filename, label in labels_dict.items():
+            file_path = os.path.join(transcription_folder, filename)
+            if label in IGNORED_LABELS or file_path in seen_files or not os.path.exists(file_path):
+                continue
+            if target == TEACHING_TARGET:
+                label = teaching_from_label(label)
+                if label is None:
+                    continue # 不是教學/示範四分類的標籤
+            else:
+                label = label.strip()
+            content = read_file_content(file_path, log_callback)
+            if not content:
+                continue
+            seen_files.add(file_path)
+            texts.append(build_features_text(content))
+            labels.append(label)
+            used += 1
+        log_callback(f"【日誌】從 {labels_path} 取得 {used} 筆訓練樣本。")
+    return texts, labels
+
+
+def _build_pipeline():
+    from sklearn.pipeline import Pipeline
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+
+    return Pipeline([
+        ("tfidf", TfidfVectorizer(analyzer="char_wb", ngram_range=(2, 4), min_df=2,
+                                  max_features=200000, sublinear_tf=True)),
+        ("clf", LogisticRegression(max_iter=2000, class_weight="balanced")),
+    ])
+
+
+def evaluate_classifier(texts, labels, confidence_threshold=0.8, test_size=0.2, log_callback=print):
+    """
+    以保留的歷史資料評估分類器。
+
+    Returns:
+        dict: {"accuracy", "confident_accuracy", "coverage", "n_train", "n_test"}；資料不足時回傳 None。
+    """
+    from sklearn.model_selection import train_test_split
+
+    label_counts = Counter(labels)
+    if len(label_counts) < 2 or len(labels) < 10:
+        log_callback(f"【錯誤】訓練資料不足 (樣本 {len(labels)} 筆、分類 {len(label_counts)} 種)，無法評估。")
+        return None
+
+    # 每個分類都至少有 2 筆時才能分層抽樣
+    stratify = labels if min(label_counts.values()) >= 2 else None
+    x_train, x_test, y_train, y_test = train_test_split(
+        texts, labels, test_size=test_size, random_state=42, stratify=stratify)
+
+    pipeline = _build_pipeline()
+    pipeline.fit(x_train, y_train)
+    probabilities = pipeline.predict_proba(x_test)
+    classes = pipeline.classes_
+
+    correct = 0
+    confident_total = 0
+    confident_correct = 0
+    for row, expected in zip(probabilities, y_test):
+        best = row.argmax()
+        is_correct = classes[best] == expected
+        correct += is_correct
+        if row[best] >= confidence_threshold:
+            confident_total += 1
+            confident_correct += is_correct
+
+    report = {
+        "accuracy": correct / len(y_test),
+        "confident_accuracy": confident_correct / confident_total if confident_total else 0.0,
+        "coverage": confident_total / len(y_test),
+        "n_train": len(x_train),
+        "n_test": len(x_test),
+    }
+    log_callback(f"【日誌】保留資料評估：整體準確率 {report['accuracy']:.1%} (測試 {report['n_test']} 筆)")
+    log_callback(f"【日誌】信心度 >= {confidence_threshold:.2f} 的檔案佔 {report['coverage']:.1%}，"
+                 f"其準確率 {report['confident_accuracy']:.1%} (其餘會送 API 分類)")
+    return report
+
+
+def train_classifier(texts, labels, criteria, output_path, confidence_threshold=0.8, log_callback=print):
+    """評估後以全部資料訓練並儲存模型，回傳評估報告 (失敗時回傳 None)"""
+    report = evaluate_classifier(texts, labels, confidence_threshold, log_callback=log_callback)
+    if report is None:
+        return None
+
+    pipeline = _build_pipeline()
+    pipeline.fit(texts, labels)
+    model_data = {
+        "pipeline": pipeline,
+        "criteria": criteria,
+        "target": model_target(criteria),
+        "confidence_threshold": confidence_threshold,
+        "evaluation": report,
+        "n_samples": len(labels),
+        "trained_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    try:
+        with open(output_path, 'wb') as f:
+            pickle.dump(model_data, f)
+        log_callback(f"【日誌】本地分類器已儲存至 {output_path} (共 {len(labels)} 筆樣本)")
+    except Exception as e:
+        log_callback(f"【錯誤】儲存本地分類器失敗: {e}")
+        return None
+    return report
+
+
+class LocalClassifier:
+    """
+    載入已訓練的本地分類器，只對高信心度的檔案給出結果。
+
+    target 為 TEACHING_TARGET 時 predict 回傳是否教學 (bool)，由呼叫端依影片長度組合標籤；否則回傳標籤本身。
+    """
+
+    def __init__(self, model_data, confidence_threshold):
+        self.pipeline = model_data["pipeline"]
+        self.criteria = model_data["criteria"]
+        self.target = model_data["target"]
+        self.confidence_threshold = confidence_threshold
+
+    @classmethod
+    def load(cls, model_path, criteria, min_accuracy=0.9, confidence_threshold=None, log_callback=print):
+        """
+        載入模型；若未安裝 scikit-learn、分類條件不符或保留資料準確率未達門檻，則回傳 None。
+        confidence_threshold 只能等於或高於訓練時的門檻 (min_accuracy 的檢查是在該門檻下量測的)。
+        """
+        if not has_sklearn:
+            log_callback("【警告】未安裝 scikit-learn，本地分類器停用，將全部使用 API 分類。")
+            return None
+        try:
+            with open(model_path, 'rb') as f:
+                model_data = pickle.load(f)
+        except Exception as e:
+            log_callback(f"【警告】載入本地分類器失敗 {model_path}: {e}，將全部使用 API 分類。")
+            return None
+
+        if "target" not in model_data:
+            log_callback("【警告】本地分類器是以舊版格式訓練的 (特徵包含長度)，請重新執行 local_classifier.py train，"
+                         "將全部使用 API 分類。")
+            return None
+        if model_data["target"] != model_target(criteria):
+            log_callback(f"【警告】本地分類器是以 '{model_data.get('criteria')}' 訓練的，與目前條件不符，將不使用。")
+            return None
+        accuracy = model_data.get("evaluation", {}).get("confident_accuracy", 0.0)
+        if accuracy < min_accuracy:
+            log_callback(f"【警告】本地分類器保留資料準確率 {accuracy:.1%} 未達啟用門檻 {min_accuracy:.1%}，將不使用。")
+            return None
+
+        # 準確率是在訓練時的信心門檻下量測的；較低的門檻會讓未經驗證的檔案也在本地分類，因此不接受
+        trained_threshold = model_data.get("confidence_threshold", 0.8)
+        threshold = trained_threshold
+        if confidence_threshold is not None:
+            if confidence_threshold < trained_threshold:
+                log_callback(f"【警告】信心門檻 {confidence_threshold:.2f} 低於訓練評估時的 {trained_threshold:.2f}，"
+                             f"該門檻下的準確率未經驗證，將使用 {trained_threshold:.2f}。")
+            else:
+                threshold = confidence_threshold
+        log_callback(f"【日誌】已載入本地分類器 (訓練於 {model_data.get('trained_at')}，準確率 {accuracy:.1%}，信心門檻 {threshold:.2f})")
+        return cls(model_data, threshold)
+
+    def predict(self, content):
+        """回傳 (標籤或是否教學, 信心度)；信心度低於門檻時結果為 None"""
+        probabilities = self.pipeline.predict_proba([build_features_text(content)])[0]
+        best = probabilities.argmax()
+        confidence = float(probabilities[best])
+        if confidence < self.confidence_threshold:
+            return None, confidence
+        predicted = self.pipeline.classes_[best]
+        return (bool(predicted) if self.target == TEACHING_TARGET else str(predicted)), confidence
+
+
+def _parse_history(values):
+    history = []
+    for value in values:
+        labels_path, sep, transcription_folder = value.partition("=")
+        if not sep:
+            # 未指定時假設轉錄稿與 labels.json 位於同一資料夾
+            transcription_folder = os.path.dirname(labels_path)
+        history.append((labels_path, transcription_folder))
+    return history
+
+
+# --- 命令列：訓練/評估 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="以歷史 labels.json 訓練/評估本地分類器")
+    parser.add_argument("command", choices=["train", "evaluate"])
+    parser.add_argument("--criteria", required=True, help="產生這些標籤時使用的分類條件，例如 \"主要內容主題 (需 API)\"")
+    parser.add_argument("--history", nargs="+", required=True, help="labels.json=轉錄稿資料夾 (可指定多組)")
+    parser.add_argument("--output", default="local_classifier.pkl", help="模型輸出路徑 (train 使用)")
+    parser.add_argument("--confidence", type=float, default=0.8, help="信心度門檻，低於此值的檔案會送 API")
+    args = parser.parse_args()
+
+    if not has_sklearn:
+        print("【錯誤】需要先安裝 scikit-learn：pip install scikit-learn")
+    else:
+        sample_texts, sample_labels = collect_training_samples(_parse_history(args.history), args.criteria)
+        print(f"共 {len(sample_labels)} 筆樣本，分類分布: {dict(Counter(sample_labels))}")
+        if args.command == "evaluate":
+            evaluate_classifier(sample_texts, sample_labels, args.confidence)
+        else:
+            train_classifier(sample_texts, sample_labels, args.criteria, args.output, args.confidence)
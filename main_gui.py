@@ -42,6 +42,8 @@ if not os.path.exists(templates_folder):
 
 # 設定檔路徑
 CONFIG_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app_settings.json")
+# 模型路由統計 (各路由的呼叫數、延遲與 token 數，跨次執行累計)
+MODEL_ROUTE_STATS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_route_stats.json")
 
 # --- 獲取預設輸出資料夾 ---
 def get_default_output_folder():
@@ -133,6 +135,30 @@ def load_settings():
                     **default_paths,
                     "api_key": "",
                     "api_model": "gemini-2.0-flash",
+                    "classification_excerpt_tokens": 3000, # 分類 Prompt 節錄上限 (0 = 送出全文)
+                    "classification_excerpt_strategy": "head_middle_tail",
+                    "local_classifier_path": "", # 本地分類器模型 (local_classifier.py train 產生)，留空表示停用
+                    "local_classifier_min_accuracy": 0.9,
+                    "incremental_classification": True, # 只對新增或變更的轉錄稿重新分類，並只重建有變動的合併輸出
+                    "content_cache_mb": 256, # Step2 -> Step3 內容快取的記憶體上限，超過時暫存到磁碟
+                    "merge_io_workers": 8, # Step3 並行讀寫檔案的執行緒數
+                    "merge_target_group_tokens": 8000, # "依 Token 預算分組" 每組的目標 token 數
+                    "merge_passthrough": True, # 單一 .txt 來源直接以檔案層級複製
+                    "merge_allow_hardlink": False, # 允許以硬連結代替複製 (輸出與來源共用資料)
+                    "label_canonicalization": False, # 合併幾乎相同的主題標籤 (僅主要內容主題；結果另存於 labels_canonical.json)
+                    "label_similarity_threshold": 0.7,
+                    "label_synonyms_path": "", # 標籤同義詞對照檔 (JSON)，留空表示不使用
+                    "near_duplicate_detection": False, # 分類前偵測近似重複的轉錄稿 (重複檔案沿用代表檔案的分類)
+                    "near_duplicate_threshold": 0.8, # 近似重複的相似度門檻 (估計 Jaccard，0 ~ 1)
+                    "step4_max_concurrent_files": 1, # Step4 同時處理的檔案數 (1 = 逐一處理)
+                    "step4_render_mode": "auto", # Step4 HTML 整合方式 (auto/local/ai/structured)
+                    "step4_stream_output": False, # Step4 以串流方式接收 API 回應 (日誌即時顯示進度)
+                    "step4_resume": True, # Step4 略過進度日誌中已完成且未變更的檔案
+                    "step4_minify_html": False, # Step4 完成後壓縮輸出 HTML
+                    "step4_html_size_budget_kb": 102, # 每封電子報的大小上限 (KB)，超過時警告 (Gmail 約 102 KB 截斷)
+                    "step4_map_reduce_chunk_tokens": 0, # Step4 內容超過此估計 token 數時分段整理後再彙整 (0 = 停用)
+                    "model_routes": [], # 依任務與輸入大小選擇模型，例如 {"task": "classify", "max_tokens": 8000, "model": "gemini-2.0-flash-lite"} (見 model_router.py；空 = 一律使用各步驟的模型)
+                    "fallback_model": "", # 呼叫因暫時性錯誤 (429/5xx 重試用盡、網路錯誤) 失敗時改用的備援模型 (空字串 = 不改用)
                     "template_customizations": default_template_customizations # 加入預設模板設定
                 }
                 settings.update(saved_settings)
@@ -148,6 +174,30 @@ def load_settings():
     settings = {
         "api_key": "",
         "api_model": "gemini-2.0-flash",
+        "classification_excerpt_tokens": 3000, # 分類 Prompt 節錄上限 (0 = 送出全文)
+        "classification_excerpt_strategy": "head_middle_tail",
+        "local_classifier_path": "", # 本地分類器模型 (local_classifier.py train 產生)，留空表示停用
+        "local_classifier_min_accuracy": 0.9,
+        "incremental_classification": True, # 只對新增或變更的轉錄稿重新分類，並只重建有變動的合併輸出
+        "content_cache_mb": 256, # Step2 -> Step3 內容快取的記憶體上限，超過時暫存到磁碟
+        "merge_io_workers": 8, # Step3 並行讀寫檔案的執行緒數
+        "merge_target_group_tokens": 8000, # "依 Token 預算分組" 每組的目標 token 數
+        "merge_passthrough": True, # 單一 .txt 來源直接以檔案層級複製
+        "merge_allow_hardlink": False, # 允許以硬連結代替複製 (輸出與來源共用資料)
+        "label_canonicalization": False, # 合併幾乎相同的主題標籤 (僅主要內容主題；結果另存於 labels_canonical.json)
+        "label_similarity_threshold": 0.7,
+        "label_synonyms_path": "", # 標籤同義詞對照檔 (JSON)，留空表示不使用
+        "near_duplicate_detection": False, # 分類前偵測近似重複的轉錄稿 (重複檔案沿用代表檔案的分類)
+        "near_duplicate_threshold": 0.8, # 近似重複的相似度門檻 (估計 Jaccard，0 ~ 1)
+        "step4_max_concurrent_files": 1, # Step4 同時處理的檔案數 (1 = 逐一處理)
+        "step4_render_mode": "auto", # Step4 HTML 整合方式 (auto/local/ai/structured)
+        "step4_stream_output": False, # Step4 以串流方式接收 API 回應 (日誌即時顯示進度)
+        "step4_resume": True, # Step4 略過進度日誌中已完成且未變更的檔案
+        "step4_minify_html": False, # Step4 完成後壓縮輸出 HTML
+        "step4_html_size_budget_kb": 102, # 每封電子報的大小上限 (KB)，超過時警告 (Gmail 約 102 KB 截斷)
+        "step4_map_reduce_chunk_tokens": 0, # Step4 內容超過此估計 token 數時分段整理後再彙整 (0 = 停用)
+        "model_routes": [], # 依任務與輸入大小選擇模型，例如 {"task": "classify", "max_tokens": 8000, "model": "gemini-2.0-flash-lite"} (見 model_router.py；空 = 一律使用各步驟的模型)
+        "fallback_model": "", # 呼叫因暫時性錯誤 (429/5xx 重試用盡、網路錯誤) 失敗時改用的備援模型 (空字串 = 不改用)
         **default_paths,
         "template_customizations": default_template_customizations # 加入預設模板設定
     }
@@ -179,12 +229,14 @@ app.title("電子報文章生成工具")
 # 分類與合併選項
 classification_options = [
     "教學/示範 & 長度 (需 API)",
+    "教學/示範 (長度本地判斷，需 API)",
     "主要內容主題 (需 API)",
     "影片長度 (無需 API)"
 ]
 merging_options = [
     "兩兩配對 (僅適用原始分類)",
     "依據分類合併",
+    "依 Token 預算分組",
     "不合併"
 ]
 # 用於儲存下拉選單的變數
@@ -353,6 +405,12 @@ def run_step2_3_thread():
         queue_output_path = app_settings.get("queue_output", "")
         unpaired_output_path = app_settings.get("unpaired_output", "")
         api_key_value = app_settings.get("api_key", "")
+        excerpt_tokens = app_settings.get("classification_excerpt_tokens", 3000)
+        excerpt_strategy = app_settings.get("classification_excerpt_strategy", "head_middle_tail")
+        local_model_path = app_settings.get("local_classifier_path", "")
+        if local_model_path and not os.path.exists(local_model_path):
+            log_message(f"【警告】找不到本地分類器模型: {local_model_path}，將全部使用 API 分類。")
+            local_model_path = ""
 
         # --- 基本驗證 ---
         if not transcription_input_path or not os.path.isdir(transcription_input_path):
@@ -377,7 +435,7 @@ def run_step2_3_thread():
             log_message(f"【錯誤】Step 2/3: URL 設定檔所在目錄不存在: {url_config_dir}")
             return
 
-        needs_api = selected_classification in ["教學/示範 & 長度 (需 API)", "主要內容主題 (需 API)"]
+        needs_api = selected_classification in ["教學/示範 & 長度 (需 API)", "教學/示範 (長度本地判斷，需 API)", "主要內容主題 (需 API)"]
         if needs_api and not api_key_value:
             log_message("【錯誤】選擇的分類條件需要 API 金鑰，但未在設定中提供。")
             return
@@ -392,7 +450,25 @@ def run_step2_3_thread():
             api_key=api_key_value,
             classification_criteria=selected_classification,
             merging_strategy=selected_merging,
-            log_callback=log_message
+            log_callback=log_message,
+            excerpt_max_tokens=excerpt_tokens,
+            excerpt_strategy=excerpt_strategy,
+            local_model_path=local_model_path or None,
+            local_min_accuracy=app_settings.get("local_classifier_min_accuracy", 0.9),
+            incremental=app_settings.get("incremental_classification", True),
+            content_cache_mb=app_settings.get("content_cache_mb", 256),
+            merge_io_workers=app_settings.get("merge_io_workers", 8),
+            merge_target_group_tokens=app_settings.get("merge_target_group_tokens", 8000),
+            merge_passthrough=app_settings.get("merge_passthrough", True),
+            merge_allow_hardlink=app_settings.get("merge_allow_hardlink", False),
+            label_canonicalization=app_settings.get("label_canonicalization", False),
+            label_similarity_threshold=app_settings.get("label_similarity_threshold", 0.7),
+            label_synonyms_path=app_settings.get("label_synonyms_path", "") or None,
+            near_duplicate_detection=app_settings.get("near_duplicate_detection", False),
+            near_duplicate_threshold=app_settings.get("near_duplicate_threshold", 0.8),
+            model_routes=app_settings.get("model_routes", []),
+            fallback_model=app_settings.get("fallback_model", "") or None,
+            route_stats_path=MODEL_ROUTE_STATS_PATH
         )
 
         if success:
@@ -505,7 +581,17 @@ def run_step4_thread():
             log_callback=log_message,
             api_model=api_model,  # 傳遞自定義模型參數
             include_video=include_video,  # 傳遞是否包含影片連結設定
-            template_customizations=template_customizations # <-- 新增：傳遞模板自訂設定
+            template_customizations=template_customizations, # <-- 新增：傳遞模板自訂設定
+            max_concurrent_files=app_settings.get("step4_max_concurrent_files", 1),
+            render_mode=app_settings.get("step4_render_mode", "auto"),
+            stream_output=app_settings.get("step4_stream_output", False),
+            resume=app_settings.get("step4_resume", True),
+            minify_output=app_settings.get("step4_minify_html", False),
+            size_budget_kb=app_settings.get("step4_html_size_budget_kb", 102),
+            map_reduce_chunk_tokens=app_settings.get("step4_map_reduce_chunk_tokens", 0),
+            model_routes=app_settings.get("model_routes", []),
+            fallback_model=app_settings.get("fallback_model", "") or None,
+            route_stats_path=MODEL_ROUTE_STATS_PATH
         )
 
         if success:
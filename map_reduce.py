@@ -0,0 +1,143 @@
+# map_reduce.py
+# 長篇輸入的分段處理 (map-reduce)：依來源檔案邊界切段、各段並行整理重點 (結果逐段快取)，再交給原本的 Prompt 做最後彙整
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from file_utils import text_sha256, atomic_write_text
+from token_utils import estimate_tokens
+
+# Step3 合併檔中每個來源的開頭 (依據分類合併)，以及兩兩配對/依 Token 分組使用的分割線
+_SOURCE_BOUNDARY_PATTERN = re.compile(r"(?=^----- 來源檔案: .*? -----$)|(?<=\n===== 分割線 =====\n\n)", re.M)
+_PARAGRAPH_PATTERN = re.compile(r"(?<=\n\n)")
+
+# 分段結果的快取資料夾 (放在 HTML 輸出資料夾內)
+CACHE_FOLDER_NAME = "_step4_map_cache"
+# 最多重複整理幾輪 (整理後仍超過上限時再分段整理一次)
+MAX_REDUCE_LEVELS = 3
+
+MAP_PROMPT_TEMPLATE = """以下是一份較長內容的第 {index}/{total} 部分 (可能包含原始檔名、影片長度和轉錄文字)。
+這些整理結果之後會與其他部分合併，再用來撰寫一篇完整的電子報。
+請整理這一部分的內容：保留所有重要觀點、具體例子、數據、教學步驟與原本的小標題順序，刪除口語贅詞與重複內容，
+以小標題加條列或短段落輸出。不要加上開場白或結語，也不要提到「這是第幾部分」。
+
+內容：
+{chunk}
+
+整理結果：
+"""
+
+
+def split_sources(text):
+    """依來源檔案邊界把合併檔切成多段 (標頭行保留在各段開頭)；沒有邊界時回傳整份內容"""
+    return [segment for segment in _SOURCE_BOUNDARY_PATTERN.split(text) if segment.strip()]
+
+
+def _split_oversized(segment, max_tokens):
+    """單一來源就超過上限時，改在段落 (空行) 處切開；仍太長的段落依 token 密度硬切"""
+    pieces = []
+    for paragraph in _PARAGRAPH_PATTERN.split(segment):
+        tokens = estimate_tokens(paragraph)
+        if tokens <= max_tokens:
+            pieces.append(paragraph)
+            continue
+        chars_per_piece = max(1, int(len(paragraph) * max_tokens / tokens))
+        pieces.extend(paragraph[i:i + chars_per_piece] for i in range(0, len(paragraph), chars_per_piece))
+    return pieces
+
+
+def plan_chunks(text, max_chunk_tokens):
+    """
+    依估計 token 數把內容切成多段，每段不超過 max_chunk_tokens (依原順序貪婪裝箱，優先在來源檔案邊界切開)。
+
+    Returns:
+        list: 各段文字；內容未超過上限時只有一段。
+    """
+    chunks, current, current_tokens = [], [], 0
+    for segment in split_sources(text):
+        tokens = estimate_tokens(segment)
+        pieces = [segment] if tokens <= max_chunk_tokens else _split_oversized(segment, max_chunk_tokens)
+        for piece in pieces:
+            piece_tokens = tokens if len(pieces) == 1 else estimate_tokens(piece)
+            if current and current_tokens + piece_tokens > max_chunk_tokens:
+                chunks.append("".join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+
+class ChunkCache:
+    """
+    分段整理結果的快取：每段一個檔案，以 (實際使用的模型, 整理 Prompt 模板, 段落內容) 的雜湊為檔名。
+
+    段落的位置 ({index}/{total}) 只放在送出的請求中、不列入鍵值，增減其他來源時未變更的段落仍會命中。
+    """
+
+    def __init__(self, cache_folder):
+        self.cache_folder = cache_folder
+
+    def _path(self, model_name, chunk):
+        key = text_sha256(f"{model_name}\0{MAP_PROMPT_TEMPLATE}\0{chunk}")
+        return os.path.join(self.cache_folder, f"{key}.txt")
+
+    def get(self, model_name, chunk):
+        try:
+            with open(self._path(model_name, chunk), 'r', encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, model_name, chunk, result):
+        try:
+            os.makedirs(self.cache_folder, exist_ok=True)
+            atomic_write_text(self._path(model_name, chunk), result)
+        except OSError:
+            pass # 快取寫入失敗不影響本次結果
+
+
+def condense_long_content(content, call_api, max_chunk_tokens, cache, log_callback=print, max_workers=4,
+                          resolve_model=None):
+    """
+    內容超過 max_chunk_tokens 時分段並行整理重點 (map)，回傳合併後的整理結果，供原本的 Prompt 做最後彙整 (reduce)。
+
+    Args:
+        call_api (callable): call_api(prompt) -> (生成文字或 None, 實際使用的模型)。
+        cache (ChunkCache): 分段結果快取；相同段落以相同模型再次執行時不重新呼叫 API。
+        resolve_model (callable): resolve_model(prompt) -> 這段預計使用的模型 (查詢快取用)；None 表示一律為 ""。
+        max_workers (int): 同時整理的段落數上限。
+
+    Returns:
+        str: 整理後的內容 (未超過上限時原樣回傳)；任一段落失敗時回傳 None。
+    """
+    level = 0
+    while estimate_tokens(content) > max_chunk_tokens and level < MAX_REDUCE_LEVELS:
+        level += 1
+        chunks = plan_chunks(content, max_chunk_tokens)
+        if len(chunks) < 2:
+            break
+        prompts = [MAP_PROMPT_TEMPLATE.format(index=i, total=len(chunks), chunk=chunk)
+                   for i, chunk in enumerate(chunks, 1)]
+        models = [resolve_model(prompt) if resolve_model else "" for prompt in prompts]
+        results = [cache.get(model, chunk) for model, chunk in zip(models, chunks)]
+        missing = [i for i, result in enumerate(results) if result is None]
+        log_callback(f"【日誌】內容約 {estimate_tokens(content)} tokens，超過單次上限 {max_chunk_tokens}，"
+                     f"分成 {len(chunks)} 段整理 (第 {level} 輪，快取命中 {len(chunks) - len(missing)} 段)...")
+
+        if missing:
+            # 成功的段落先存入快取，重新執行時只需重跑失敗的段落
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(missing)))) as pool:
+                for i, (result, model) in zip(missing, pool.map(call_api, [prompts[i] for i in missing])):
+                    if result is None or not result.strip():
+                        log_callback(f"【錯誤】第 {i + 1}/{len(chunks)} 段整理失敗。")
+                        continue
+                    results[i] = result.strip()
+                    cache.put(model, chunks[i], results[i]) # 以實際回應的模型 (可能是備援模型) 記錄
+            if any(result is None for result in results):
+                return None
+
+        content = "\n\n".join(f"----- 來源檔案: 第 {i} 部分 -----\n{result}"
+                              for i, result in enumerate(results, 1))
+    return content
@@ -0,0 +1,148 @@
+# markdown_email.py
+# 輕量 Markdown -> 電子郵件安全 HTML 轉換 (不需額外套件)：標題、粗體/斜體、清單、連結、引用、分隔線
+#
+# 電子郵件客戶端多半會移除 <style>，因此所有樣式都寫在 inline style 上。
+# 原文中的 HTML 一律跳脫，連結只接受 http/https/mailto。
+import re
+import html
+
+# 各標籤的 inline style (可依模板風格調整)
+DEFAULT_STYLES = {
+    "h1": "margin:24px 0 12px;font-size:26px;line-height:1.3;font-weight:bold;color:#222222;",
+    "h2": "margin:22px 0 10px;font-size:22px;line-height:1.35;font-weight:bold;color:#222222;",
+    "h3": "margin:18px 0 8px;font-size:18px;line-height:1.4;font-weight:bold;color:#333333;",
+    "h4": "margin:16px 0 8px;font-size:16px;line-height:1.4;font-weight:bold;color:#333333;",
+    "h5": "margin:14px 0 6px;font-size:15px;line-height:1.4;font-weight:bold;color:#333333;",
+    "h6": "margin:14px 0 6px;font-size:14px;line-height:1.4;font-weight:bold;color:#555555;",
+    "p": "margin:0 0 16px;font-size:16px;line-height:1.7;color:#333333;",
+    "ul": "margin:0 0 16px;padding-left:24px;",
+    "ol": "margin:0 0 16px;padding-left:24px;",
+    "li": "margin:0 0 6px;font-size:16px;line-height:1.7;color:#333333;",
+    "blockquote": "margin:0 0 16px;padding:8px 16px;border-left:4px solid #dddddd;color:#555555;",
+    "hr": "border:0;border-top:1px solid #dddddd;margin:24px 0;",
+    "a": "color:#1a73e8;text-decoration:underline;",
+    "code": "font-family:Consolas,Menlo,monospace;background:#f4f4f4;padding:1px 4px;",
+}
+
+_HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_UNORDERED_ITEM_PATTERN = re.compile(r"^\s*[-*+]\s+(.*)$")
+_ORDERED_ITEM_PATTERN = re.compile(r"^\s*\d+[.)]\s+(.*)$")
+_QUOTE_PATTERN = re.compile(r"^\s*>\s?(.*)$")
+_RULE_PATTERN = re.compile(r"^\s*([-*_])(\s*\1){2,}\s*$")
+
+# 行內語法 (在 HTML 跳脫之後套用)
+_CODE_PATTERN = re.compile(r"`([^`]+)`")
+_LINK_PATTERN = re.compile(r"\[([^\]]+)\]\(\s*([^)\s]+)\s*\)")
+_BOLD_PATTERN = re.compile(r"\*\*(?=\S)(.+?)(?<=\S)\*\*|__(?=\S)(.+?)(?<=\S)__")
+_ITALIC_PATTERN = re.compile(r"(?<![\w*])\*(?=\S)(.+?)(?<=\S)\*(?![\w*])|(?<![\w_])_(?=\S)(.+?)(?<=\S)_(?![\w_])")
+_SAFE_URL_PATTERN = re.compile(r"^(https?://|mailto:)", re.I)
+
+
+def open_tag(tag, styles=None):
+    """帶 inline style 的開始標籤"""
+    style = (styles or DEFAULT_STYLES).get(tag)
+    return f'<{tag} style="{style}">' if style else f"<{tag}>"
+
+
+def format_inline(text, styles=None):
+    """跳脫 HTML 並轉換行內語法：`程式碼`、**粗體**、*斜體*、[文字](網址)"""
+    styles = styles or DEFAULT_STYLES
+    code_spans = []
+
+    def keep_code(match):
+        code_spans.append(f"{open_tag('code', styles)}{match.group(1)}</code>")
+        return f"\x00{len(code_spans) - 1}\x00"
+
+    def link(match):
+        label, url = match.group(1), html.unescape(match.group(2))
+        if not _SAFE_URL_PATTERN.match(url):
+            return match.group(0) # 不安全的網址 (例如 javascript:) 保留原文
+        return f'<a href="{html.escape(url)}" style="{styles.get("a", "")}">{label}</a>'
+
+    text = _CODE_PATTERN.sub(keep_code, html.escape(text, quote=False))
+    text = _LINK_PATTERN.sub(link, text)
+    text = _BOLD_PATTERN.sub(lambda m: f"<strong>{m.group(1) or m.group(2)}</strong>", text)
+    text = _ITALIC_PATTERN.sub(lambda m: f"<em>{m.group(1) or m.group(2)}</em>", text)
+    if code_spans:
+        text = re.sub(r"\x00(\d+)\x00", lambda m: code_spans[int(m.group(1))], text)
+    return text
+
+
+def markdown_to_email_html(text, styles=None):
+    """
+    將 Markdown 文字轉成電子郵件安全的 HTML 片段。
+
+    支援：# 標題、段落 (段落內的換行轉為 <br>)、- / 1. 清單、> 引用、--- 分隔線，以及 format_inline 的行內語法。
+    不支援巢狀清單與表格 (會當作一般段落或清單項目輸出)。
+    """
+    styles = styles or DEFAULT_STYLES
+    output = []
+    paragraph = [] # 目前段落的行
+    list_tag = None # 目前清單的類型 ("ul" / "ol")
+    quote = [] # 目前引用區塊的行
+
+    def flush_paragraph():
+        if paragraph:
+            output.append(f"{open_tag('p', styles)}{'<br>'.join(format_inline(l, styles) for l in paragraph)}</p>")
+            paragraph.clear()
+
+    def close_list():
+        nonlocal list_tag
+        if list_tag:
+            output.append(f"</{list_tag}>")
+            list_tag = None
+
+    def flush_quote():
+        if quote:
+            output.append(f"{open_tag('blockquote', styles)}{'<br>'.join(format_inline(l, styles) for l in quote)}"
+                          f"</blockquote>")
+            quote.clear()
+
+    for raw_line in text.replace("\r\n", "\n").split("\n"):
+        line = raw_line.strip()
+        if not line:
+            flush_paragraph()
+            close_list()
+            flush_quote()
+            continue
+
+        heading = _HEADING_PATTERN.match(line)
+        rule = _RULE_PATTERN.match(line)
+        quote_match = _QUOTE_PATTERN.match(line)
+        unordered = _UNORDERED_ITEM_PATTERN.match(line) if not rule else None
+        ordered = _ORDERED_ITEM_PATTERN.match(line)
+
+        if not quote_match:
+            flush_quote()
+        if heading or rule:
+            flush_paragraph()
+            close_list()
+            if heading:
+                tag = f"h{len(heading.group(1))}"
+                output.append(f"{open_tag(tag, styles)}{format_inline(heading.group(2), styles)}</{tag}>")
+            else:
+                output.append(f'<hr style="{styles.get("hr", "")}">')
+        elif quote_match:
+            flush_paragraph()
+            close_list()
+            quote.append(quote_match.group(1))
+        elif unordered or ordered:
+            flush_paragraph()
+            tag = "ul" if unordered else "ol"
+            if list_tag != tag:
+                close_list()
+                output.append(open_tag(tag, styles))
+                list_tag = tag
+            item = (unordered or ordered).group(1)
+            output.append(f"{open_tag('li', styles)}{format_inline(item, styles)}</li>")
+        elif list_tag and raw_line[:1] in (" ", "\t"):
+            # 縮排的續行併入上一個清單項目
+            output[-1] = output[-1][:-len("</li>")] + f"<br>{format_inline(line, styles)}</li>"
+        else:
+            close_list()
+            paragraph.append(line)
+
+    flush_paragraph()
+    close_list()
+    flush_quote()
+    return "\n".join(output)
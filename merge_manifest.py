@@ -0,0 +1,177 @@
+# merge_manifest.py
+# Step3 的輸出清單：記錄每個輸出檔由哪些來源檔 (及其內容雜湊) 組成，下次執行只重建有變動的輸出
+import os
+
+from file_utils import file_sha256, atomic_write_json, load_json
+from transcript_meta import load_transcript_meta
+
+# 清單存放在輸出佇列資料夾內 (Step4 只處理 .txt，不會當成輸入；只透過 load_group_members 讀取分組成員)
+MANIFEST_FILENAME = "_merge_manifest.json"
+MANIFEST_VERSION = 1
+
+
+def load_group_members(output_queue_folder):
+    """
+    讀取清單中每個分組輸出檔的來源 (供 Step4 尋找影片；分組檔名過長時改用雜湊，無法從檔名拆出來源)。
+
+    Returns:
+        dict: {輸出檔名 (不含副檔名): [來源檔名 (不含副檔名), ...]}；沒有清單時為空 dict。
+    """
+    data = load_json(os.path.join(output_queue_folder, MANIFEST_FILENAME))
+    if not isinstance(data, dict) or data.get("version") != MANIFEST_VERSION:
+        return {}
+    members = {}
+    for key, entry in data.get("outputs", {}).items():
+        if isinstance(entry, dict) and entry.get("recipe") == "group":
+            members[os.path.splitext(os.path.basename(key))[0]] = [os.path.splitext(f)[0] for f in entry.get("members", [])]
+    return members
+
+
+def source_content_hash(source_path):
+    """來源轉錄稿的內容雜湊：sidecar 有效時直接取用，否則計算檔案的 SHA-256"""
+    meta = load_transcript_meta(source_path)
+    if meta and meta.get("content_hash"):
+        return meta["content_hash"]
+    return file_sha256(source_path)
+
+
+class MergeManifest:
+    """
+    Step3 的增量合併清單 (只在主執行緒使用)。
+
+    每個輸出檔記錄：來源檔名 (依寫入順序)、各來源的內容雜湊，以及產生方式 (recipe，例如 "copy"、
+    "pair"、"category:分類名稱")。三者都與上次相同且輸出檔仍存在時即可略過，不重寫檔案，
+    輸出檔的修改時間因此保持不變，後續步驟可以據此判斷哪些檔案真的有變動。
+    """
+
+    def __init__(self, manifest_path, transcription_folder, incremental=True, known_hashes=None):
+        self.manifest_path = manifest_path
+        self.transcription_folder = transcription_folder
+        self.incremental = incremental
+        self._previous = {} # 輸出檔絕對路徑 -> 上次的記錄
+        self._current = {} # 本次確定的記錄 (略過或已成功寫入)
+        self._pending = {} # 已登記、等待寫入結果的記錄
+        self._planned = set() # 本次會產生的輸出檔
+        self._planned_members = set() # 本次會寫入某個輸出檔的來源
+        self._hashes = dict(known_hashes or {}) # 來源檔名 -> 內容雜湊 (Step2 已算過的直接沿用，其餘同一次執行只算一次)
+        self._previous_tokens = {} # 內容雜湊 -> 估計 token 數 (上次記錄)
+        self._tokens = {} # 本次用到的來源 token 數 (只保留仍存在的內容)
+        self.skipped = 0
+        self.rebuilt = 0
+        self.removed = 0
+
+    @classmethod
+    def load(cls, output_queue_folder, transcription_folder, incremental=True, known_hashes=None):
+        """
+        讀取輸出佇列資料夾中的清單；不存在或版本不符時視為沒有上次記錄。
+
+        known_hashes ({來源檔名: 內容雜湊}) 為本次 Step2 已計算的雜湊，這些來源不再讀取磁碟。
+        """
+        manifest_path = os.path.join(output_queue_folder, MANIFEST_FILENAME)
+        data = load_json(manifest_path)
+        manifest = cls(manifest_path, transcription_folder, incremental=incremental, known_hashes=known_hashes)
+        if isinstance(data, dict) and data.get("version") == MANIFEST_VERSION:
+            manifest._previous = data.get("outputs", {})
+            manifest._previous_tokens = data.get("token_counts", {})
+        return manifest
+
+    def _hash_of(self, filename):
+        """來源的內容雜湊；讀不到時為 None (這種記錄永遠不會與上次相同，下次一定重建)"""
+        if filename not in self._hashes:
+            try:
+                self._hashes[filename] = source_content_hash(os.path.join(self.transcription_folder, filename))
+            except OSError:
+                self._hashes[filename] = None
+        return self._hashes[filename]
+
+    def _build_entry(self, members, recipe):
+        return {"members": list(members), "hashes": {f: self._hash_of(f) for f in members}, "recipe": recipe}
+
+    def cached_token_count(self, filename):
+        """內容未變更的來源檔直接沿用上次估計的 token 數，不必讀取內容；沒有記錄時回傳 None"""
+        content_hash = self._hash_of(filename)
+        if not self.incremental or content_hash is None:
+            return None
+        tokens = self._previous_tokens.get(content_hash)
+        if tokens is not None:
+            self._tokens[content_hash] = tokens
+        return tokens
+
+    def remember_token_count(self, filename, tokens):
+        """記錄來源檔的估計 token 數 (以內容雜湊為鍵)"""
+        content_hash = self._hash_of(filename)
+        if content_hash is not None:
+            self._tokens[content_hash] = tokens
+
+    def is_current(self, dest_path, members, recipe):
+        """
+        登記本次要產生的輸出檔。
+
+        Returns:
+            bool: True 表示上次已以相同來源與做法產生且檔案仍在，不需重寫。
+        """
+        key = os.path.abspath(dest_path)
+        self._planned.add(key)
+        self._planned_members.update(members)
+        entry = self._build_entry(members, recipe)
+        self._pending[key] = entry
+        if None in entry["hashes"].values():
+            return False # 來源讀不到時照常處理，由合併流程回報錯誤
+        if self.incremental and self._previous.get(key) == entry and os.path.exists(key):
+            self._current[key] = self._pending.pop(key)
+            self.skipped += 1
+            return True
+        return False
+
+    def record(self, dest_path, members=None):
+        """
+        輸出檔寫入成功後呼叫。
+
+        Args:
+            members (list): 實際寫入的來源 (部分來源讀取失敗時與登記的不同)；None 表示與登記時相同。
+        """
+        key = os.path.abspath(dest_path)
+        entry = self._pending.pop(key, None)
+        if entry is None:
+            return
+        if members is not None and list(members) != entry["members"]:
+            entry = {"members": list(members), "hashes": {f: entry["hashes"][f] for f in members},
+                     "recipe": entry["recipe"]}
+        self._current[key] = entry
+        self.rebuilt += 1
+
+    def remove_stale(self, log_callback=print):
+        """
+        刪除上次清單中有、但本次不再產生的輸出檔 (只會刪除清單記錄過的檔案)。
+
+        只有在每個來源都已從轉錄稿資料夾移除，或已改寫入本次的其他輸出 (重新分類/分組) 時才刪除；
+        來源仍在卻沒有被規劃 (例如這次讀取或分類失敗) 的輸出會保留，記錄也一併保留。
+        """
+        for key, entry in self._previous.items():
+            if key in self._planned or not os.path.exists(key):
+                continue
+            orphaned = [f for f in entry.get("members", []) if f not in self._planned_members
+                        and os.path.exists(os.path.join(self.transcription_folder, f))]
+            if orphaned:
+                log_callback(f"【日誌】保留合併輸出 {os.path.basename(key)}：來源 {', '.join(orphaned)} 仍存在但本次未處理。")
+                self._current[key] = entry
+                continue
+            try:
+                os.remove(key)
+                self.removed += 1
+                log_callback(f"【日誌】移除過期的合併輸出: {os.path.basename(key)}")
+            except OSError as e:
+                log_callback(f"【警告】移除過期的合併輸出失敗 {os.path.basename(key)}: {e}")
+                self._current[key] = entry # 保留記錄，下次再嘗試移除
+
+    def save(self, log_callback=print):
+        """以原子寫入方式儲存本次的清單"""
+        try:
+            atomic_write_json(self.manifest_path, {"version": MANIFEST_VERSION, "outputs": self._current,
+                                                   "token_counts": self._tokens})
+        except OSError as e:
+            log_callback(f"【警告】儲存合併清單失敗 {self.manifest_path}: {e}")
+
+    def stats_text(self):
+        """回傳增量合併結果的說明文字 (用於日誌)"""
+        return f"未變更 {self.skipped} 個 (保留原檔)，重建 {self.rebuilt} 個，移除過期輸出 {self.removed} 個"
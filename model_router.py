@@ -0,0 +1,143 @@
+# model_router.py
+# 依任務與輸入大小 (估計 token 數) 選擇模型：短內容與分類不必使用處理長篇改寫的模型；失敗時改用備援模型，並記錄各路由的延遲與 token 統計
+import json
+import time
+import threading
+
+from api_retry import clear_transient_failure, had_transient_failure
+from file_utils import atomic_write_json, load_json
+from token_utils import estimate_tokens
+
+# 可設定路由的任務：Step2 分類、Step4 改寫內文、長篇分段整理、AI 整合 HTML ("*" 代表任何任務)
+TASKS = ("classify", "rewrite", "map", "html")
+
+# 各路由累計的統計欄位 (max_seconds 取最大值，其餘累加)
+_STAT_FIELDS = ("calls", "failures", "fallbacks", "total_seconds", "max_seconds", "input_tokens", "output_tokens")
+
+
+class ModelRouter:
+    """
+    模型路由表。
+
+    routes 為依序比對的 list，每筆格式為 {"task": "classify", "max_tokens": 8000, "model": "gemini-2.0-flash-lite"}：
+    task 相同 (或為 "*") 且輸入估計 token 數不超過 max_tokens (省略或 null 表示不限) 的第一筆生效；
+    都不符合時使用 default_model。呼叫因暫時性錯誤失敗 (重試用盡的 429/5xx、網路錯誤、串流中斷，
+    由 api_retry.mark_transient_failure 標記) 且設定了不同的 fallback_model 時，改用備援模型再試一次；
+    400/403 (金鑰無效、請求格式錯誤) 或內容被封鎖等失敗換模型也不會成功，不改用備援模型。
+    統計依「路由 -> 模型」分開記錄，可在多個執行緒中呼叫。
+    """
+
+    def __init__(self, routes, default_model, fallback_model=None, log_callback=print):
+        self.default_model = default_model
+        self.fallback_model = fallback_model or None
+        self.routes = []
+        for route in routes or []:
+            task = route.get("task") if isinstance(route, dict) else None
+            max_tokens = route.get("max_tokens") if isinstance(route, dict) else None
+            if (task not in TASKS + ("*",) or not route.get("model")
+                    or (max_tokens is not None and not isinstance(max_tokens, (int, float)))):
+                log_callback(f"【警告】模型路由設定無效，已略過: {route}")
+                continue
+            self.routes.append({"task": task, "max_tokens": max_tokens, "model": route["model"]})
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def signature(self):
+        """路由設定的字串表示 (放進快取/進度日誌的設定雜湊，路由變更時重新生成)"""
+        return json.dumps({"routes": self.routes, "default": self.default_model}, ensure_ascii=False, sort_keys=True)
+
+    def choose(self, task, input_tokens):
+        """
+        Returns:
+            tuple: (路由名稱, 模型名稱)。
+        """
+        for route in self.routes:
+            if route["task"] in (task, "*") and (route["max_tokens"] is None or input_tokens <= route["max_tokens"]):
+                limit = f"<={route['max_tokens']}" if route["max_tokens"] is not None else ""
+                return f"{task}{limit}", route["model"]
+        return f"{task}(預設)", self.default_model
+
+    def call(self, task, input_text, call_model, log_callback=print):
+        """
+        依路由選擇模型並呼叫 call_model(model_name)；因暫時性錯誤回傳 None 時改用備援模型。
+
+        Args:
+            input_text (str): 送出的內容 (用於估計 token 數以選擇路由)。
+            call_model (callable): call_model(model_name) -> 結果或 None。
+        """
+        input_tokens = estimate_tokens(input_text)
+        route_name, model = self.choose(task, input_tokens)
+        if model != self.default_model:
+            log_callback(f"【日誌】模型路由 {route_name} (約 {input_tokens} tokens)：使用 {model}")
+        result = self._timed_call(route_name, model, input_tokens, call_model)
+        if result is None and self.fallback_model and self.fallback_model != model:
+            if not had_transient_failure():
+                log_callback(f"【日誌】{model} 呼叫失敗的原因不是暫時性錯誤，不改用備援模型。")
+                return None
+            log_callback(f"【警告】{model} 呼叫失敗，改用備援模型 {self.fallback_model} 重試。")
+            self._add(f"{route_name} -> {model}", fallbacks=1)
+            result = self._timed_call(f"{route_name} (備援)", self.fallback_model, input_tokens, call_model)
+        return result
+
+    def _timed_call(self, route_name, model, input_tokens, call_model):
+        clear_transient_failure()
+        start = time.perf_counter()
+        try:
+            result = call_model(model)
+        finally:
+            elapsed = time.perf_counter() - start
+        output = result if isinstance(result, str) or result is None else json.dumps(result, ensure_ascii=False)
+        self._add(f"{route_name} -> {model}", calls=1, failures=int(result is None), total_seconds=elapsed,
+                  max_seconds=elapsed, input_tokens=input_tokens,
+                  output_tokens=estimate_tokens(output) if output else 0)
+        return result
+
+    def _add(self, key, **values):
+        with self._lock:
+            _merge_stats(self._stats.setdefault(key, dict.fromkeys(_STAT_FIELDS, 0)), values)
+
+    def stats(self):
+        """本次執行各路由的統計 (複本)"""
+        with self._lock:
+            return {key: dict(values) for key, values in self._stats.items()}
+
+    def report(self, log_callback=print):
+        """在日誌中列出本次各路由的呼叫數、失敗數、平均延遲與平均 token 數"""
+        stats = self.stats()
+        if not stats:
+            return
+        log_callback("\n【日誌】模型路由統計 (token 為估計值)：")
+        for key, s in sorted(stats.items()):
+            calls = s["calls"] or 1
+            log_callback(f"  {key}: {s['calls']} 次 (失敗 {s['failures']}，改用備援 {s['fallbacks']})，"
+                         f"平均 {s['total_seconds'] / calls:.1f} 秒 / 最長 {s['max_seconds']:.1f} 秒，"
+                         f"平均輸入約 {s['input_tokens'] // calls} tokens，輸出約 {s['output_tokens'] // calls} tokens")
+
+    def save_stats(self, stats_path, log_callback=print):
+        """把本次統計累加到 stats_path (JSON)，供調整路由門檻時參考"""
+        stats = self.stats()
+        if not stats:
+            return
+        totals = load_json(stats_path, {})
+        if not isinstance(totals, dict):
+            totals = {}
+        for key, values in stats.items():
+            entry = totals.get(key)
+            if not isinstance(entry, dict):
+                entry = totals[key] = dict.fromkeys(_STAT_FIELDS, 0)
+            _merge_stats(entry, values)
+            entry["total_seconds"] = round(entry["total_seconds"], 3)
+            entry["max_seconds"] = round(entry["max_seconds"], 3)
+            entry["updated_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            atomic_write_json(stats_path, totals)
+        except OSError as e:
+            log_callback(f"【警告】儲存模型路由統計失敗: {e}")
+
+
+def _merge_stats(entry, values):
+    for field, value in values.items():
+        if field == "max_seconds":
+            entry[field] = max(entry.get(field, 0), value)
+        else:
+            entry[field] = entry.get(field, 0) + value
@@ -0,0 +1,180 @@
+# near_duplicates.py
+# 近似重複轉錄稿偵測 (MinHash + LSH)：重新上傳或略為剪短的同一支影片只需分類一次 (合併與生成照常進行)
+import os
+import re
+import hashlib
+from collections import defaultdict
+
+from file_utils import atomic_write_json, load_json
+from token_utils import split_transcript_header
+from merge_manifest import source_content_hash
+
+# MinHash 簽章長度；使用 one-permutation hashing (每個 shingle 只雜湊一次，再分到各 bin 取最小值)
+NUM_BINS = 128
+# LSH 分帶：32 個 band × 每 band 4 個 bin，相似度約 0.5 以上的配對幾乎都會成為候選
+LSH_BANDS = 32
+# 以 5 個連續字元為一個 shingle (中文不需斷詞)
+SHINGLE_SIZE = 5
+
+SIGNATURE_CACHE_FILENAME = "near_duplicates_cache.json"
+REPORT_FILENAME = "near_duplicates.json"
+SIGNATURE_VERSION = 1
+
+_IGNORED_CHARS_PATTERN = re.compile(r"[\s\W_]+")
+_HASH_RANGE = 1 << 64
+
+
+def _shingle_hashes(text):
+    """內文 (去除空白與標點) 的 shingle 64 位元雜湊集合"""
+    normalized = _IGNORED_CHARS_PATTERN.sub("", text.lower())
+    if len(normalized) < SHINGLE_SIZE:
+        shingles = {normalized} if normalized else set()
+    else:
+        shingles = {normalized[i:i + SHINGLE_SIZE] for i in range(len(normalized) - SHINGLE_SIZE + 1)}
+    return {int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'big') for s in shingles}
+
+
+def minhash_signature(text):
+    """
+    計算 one-permutation MinHash 簽章 (長度 NUM_BINS 的整數 list)。
+
+    空的 bin 以下一個非空 bin 的值補上 (循環借用並加上位移)，避免短文字的空 bin 被誤判為相同。
+    """
+    bin_width = _HASH_RANGE // NUM_BINS
+    signature = [None] * NUM_BINS
+    for value in _shingle_hashes(text):
+        index = value // bin_width
+        offset = value % bin_width
+        if signature[index] is None or offset < signature[index]:
+            signature[index] = offset
+    if all(v is None for v in signature):
+        return [bin_width] * NUM_BINS # 沒有內容：所有 bin 都是空值
+    for index in range(NUM_BINS):
+        if signature[index] is None:
+            distance = 1
+            while signature[(index + distance) % NUM_BINS] is None:
+                distance += 1
+            signature[index] = signature[(index + distance) % NUM_BINS] + distance * bin_width
+    return signature
+
+
+def estimate_similarity(signature_a, signature_b):
+    """以相同 bin 的比例估計兩份內文的 Jaccard 相似度"""
+    return sum(a == b for a, b in zip(signature_a, signature_b)) / NUM_BINS
+
+
+def find_candidate_pairs(signatures):
+    """LSH：任一 band 完全相同的檔案成為候選配對 (之後再以完整簽章確認)"""
+    rows = NUM_BINS // LSH_BANDS
+    candidates = set()
+    for band in range(LSH_BANDS):
+        buckets = defaultdict(list)
+        for filename, signature in signatures.items():
+            buckets[tuple(signature[band * rows:(band + 1) * rows])].append(filename)
+        for members in buckets.values():
+            for i in range(len(members)):
+                for j in range(i + 1, len(members)):
+                    candidates.add(tuple(sorted((members[i], members[j]))))
+    return candidates
+
+
+def group_near_duplicates(signatures, lengths, threshold):
+    """
+    將相似度達門檻的檔案分組 (聯集-查找)，每組保留內文最長 (最完整) 的檔案作為代表。
+
+    Returns:
+        tuple: ({重複檔名: 代表檔名}, {(檔名1, 檔名2): 相似度} 達門檻的配對)。
+    """
+    parent = {filename: filename for filename in signatures}
+
+    def find(filename):
+        while parent[filename] != filename:
+            parent[filename] = parent[parent[filename]]
+            filename = parent[filename]
+        return filename
+
+    similar_pairs = {}
+    for file1, file2 in sorted(find_candidate_pairs(signatures)):
+        similarity = estimate_similarity(signatures[file1], signatures[file2])
+        if similarity >= threshold:
+            similar_pairs[(file1, file2)] = similarity
+            parent[find(file1)] = find(file2)
+
+    groups = defaultdict(list)
+    for filename in signatures:
+        groups[find(filename)].append(filename)
+
+    duplicate_of = {}
+    for members in groups.values():
+        if len(members) < 2:
+            continue
+        representative = min(members, key=lambda f: (-lengths[f], f))
+        for filename in members:
+            if filename != representative:
+                duplicate_of[filename] = representative
+    return duplicate_of, similar_pairs
+
+
+def find_near_duplicates(transcription_folder, label_folder, threshold=0.8, log_callback=print, content_cache=None):
+    """
+    偵測轉錄稿資料夾中的近似重複檔案 (在分類之前執行，不呼叫 API)。
+
+    只比對轉錄內文 (標頭的檔名、長度不同不影響)。簽章以內容雜湊快取在標籤資料夾，
+    未變更的檔案不必重新讀取；讀到的內容會放入 content_cache 供分類與合併使用。
+    結果另存為標籤資料夾中的 near_duplicates.json 報告。
+
+    Returns:
+        dict: {重複檔名: 代表檔名}；沒有重複時為空字典。
+    """
+    from Step2分類 import read_file_content # 延遲匯入，避免與 Step2 循環匯入
+
+    files = sorted(f for f in os.listdir(transcription_folder) if f.lower().endswith((".txt", ".docx")))
+    cache_path = os.path.join(label_folder, SIGNATURE_CACHE_FILENAME)
+    cache = load_json(cache_path, {})
+    previous = cache.get("signatures", {}) if cache.get("version") == SIGNATURE_VERSION else {}
+
+    signatures, lengths, new_cache = {}, {}, {}
+    computed = 0
+    for filename in files:
+        file_path = os.path.join(transcription_folder, filename)
+        try:
+            content_hash = source_content_hash(file_path)
+        except OSError as e:
+            log_callback(f"【警告】近似重複偵測無法讀取 {filename}: {e}，將略過此檔案。")
+            continue
+        entry = previous.get(content_hash)
+        if entry is None:
+            content = read_file_content(file_path, log_callback)
+            if content is None:
+                continue
+            if content_cache is not None:
+                content_cache.put(filename, content)
+            _, body = split_transcript_header(content)
+            entry = {"signature": minhash_signature(body), "length": len(body)}
+            computed += 1
+        new_cache[content_hash] = entry
+        signatures[filename] = entry["signature"]
+        lengths[filename] = entry["length"]
+
+    try:
+        atomic_write_json(cache_path, {"version": SIGNATURE_VERSION, "signatures": new_cache}, indent=None)
+    except OSError as e:
+        log_callback(f"【警告】儲存近似重複簽章快取失敗: {e}")
+
+    duplicate_of, similar_pairs = group_near_duplicates(signatures, lengths, threshold)
+    log_callback(f"【日誌】近似重複偵測：{len(signatures)} 個檔案 (重新計算簽章 {computed} 個)，"
+                 f"發現 {len(duplicate_of)} 個重複檔案 (相似度門檻 {threshold:.2f})。")
+
+    report = defaultdict(list)
+    for duplicate, representative in sorted(duplicate_of.items()):
+        pair = tuple(sorted((duplicate, representative)))
+        similarity = similar_pairs.get(pair)
+        report[representative].append({"file": duplicate, "similarity": similarity})
+        similarity_text = f"{similarity:.2f}" if similarity is not None else "同組"
+        log_callback(f"【日誌】近似重複：{duplicate} 與 {representative} 相似 ({similarity_text})，將沿用後者的分類標籤 (仍照常合併與生成)。")
+    try:
+        atomic_write_json(os.path.join(label_folder, REPORT_FILENAME),
+                          {"threshold": threshold, "groups": dict(report)})
+    except OSError as e:
+        log_callback(f"【警告】儲存近似重複報告失敗: {e}")
+    return duplicate_of
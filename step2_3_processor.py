@@ -1,6 +1,10 @@
 # step2_3_processor.py
 import os
 import re # 加在這裡以防 Step3 忘記匯入
+from content_cache import ContentCache # Step2 -> Step3 的檔案內容快取
+from label_canonicalizer import canonicalize_labels, load_synonym_map, save_canonical_labels # 主題標籤正規化
+from near_duplicates import find_near_duplicates # 近似重複轉錄稿偵測
+from docx_text import prune_docx_text_cache # DOCX 擷取快取 (存放在本機快取資料夾)
 
 # 匯入重構後的函數
 try:
@@ -27,7 +31,26 @@ def run_classification_and_merging(
     api_key,
     classification_criteria,
     merging_strategy,
-    log_callback=print
+    log_callback=print,
+    excerpt_max_tokens=None,
+    excerpt_strategy="head_middle_tail",
+    local_model_path=None,
+    local_confidence=None,
+    local_min_accuracy=0.9,
+    incremental=True,
+    content_cache_mb=256,
+    merge_io_workers=8,
+    merge_target_group_tokens=8000,
+    merge_passthrough=True,
+    merge_allow_hardlink=False,
+    label_canonicalization=False,
+    label_similarity_threshold=0.7,
+    label_synonyms_path=None,
+    near_duplicate_detection=False,
+    near_duplicate_threshold=0.8,
+    model_routes=None,
+    fallback_model=None,
+    route_stats_path=None
 ):
     """
     協調執行分類和合併步驟。
@@ -44,41 +67,90 @@ def run_classification_and_merging(
 
     log_callback("--- 開始 Step 2/3 處理流程 ---")
 
-    # 1. 執行分類
-    labels_dict = perform_classification(
-        transcription_folder=transcription_folder,
-        label_folder=label_folder,
-        url_config_path=url_config_path,
-        api_key=api_key,
-        classification_criteria=classification_criteria,
-        log_callback=log_callback
-    )
-
-    if labels_dict is None:
-        log_callback("【錯誤】分類步驟執行失敗，中止 Step 2/3 流程。")
-        return False
+    # 分類時讀到的內容與計算的雜湊交給合併步驟使用，每個檔案每次執行只讀一次
+    content_cache = ContentCache(max_memory_bytes=content_cache_mb * 1024 * 1024)
+    content_hashes = {}
+    try:
+        # 0. 近似重複偵測：重複的檔案沿用代表檔案的分類 (省下分類的 API 呼叫)；合併時仍與其他檔案一樣輸出，
+        #    影片處理狀態與合併清單都不受影響
+        duplicate_of = {}
+        if near_duplicate_detection and os.path.isdir(transcription_folder):
+            os.makedirs(label_folder, exist_ok=True)
+            duplicate_of = find_near_duplicates(transcription_folder, label_folder, near_duplicate_threshold,
+                                                log_callback, content_cache)
+
+        # 1. 執行分類
+        labels_dict = perform_classification(
+            transcription_folder=transcription_folder,
+            label_folder=label_folder,
+            url_config_path=url_config_path,
+            api_key=api_key,
+            classification_criteria=classification_criteria,
+            log_callback=log_callback,
+            excerpt_max_tokens=excerpt_max_tokens,
+            excerpt_strategy=excerpt_strategy,
+            local_model_path=local_model_path,
+            local_confidence=local_confidence,
+            local_min_accuracy=local_min_accuracy,
+            incremental=incremental,
+            content_cache=content_cache,
+            duplicate_of=duplicate_of,
+            model_routes=model_routes,
+            fallback_model=fallback_model,
+            route_stats_path=route_stats_path,
+            content_hashes=content_hashes
+        )
 
-    if not labels_dict:
-         log_callback("【警告】分類步驟未產生任何標籤結果 (可能資料夾為空或所有檔案讀取失敗)。")
-         # 根據需求，這裡可以選擇繼續執行合併（例如不合併策略），或直接返回 True
-         # 暫定為繼續，讓 perform_merging 處理空字典的情況
+        if labels_dict is None:
+            log_callback("【錯誤】分類步驟執行失敗，中止 Step 2/3 流程。")
+            return False
+
+        if not labels_dict:
+             log_callback("【警告】分類步驟未產生任何標籤結果 (可能資料夾為空或所有檔案讀取失敗)。")
+             # 根據需求，這裡可以選擇繼續執行合併（例如不合併策略），或直接返回 True
+             # 暫定為繼續，讓 perform_merging 處理空字典的情況
+
+        # 1.5 主題標籤是自由格式，合併幾乎相同的標籤，避免分成許多很小的分類
+        if label_canonicalization and classification_criteria == "主要內容主題 (需 API)" and labels_dict:
+            synonyms = load_synonym_map(label_synonyms_path, log_callback)
+            labels_dict, label_mapping = canonicalize_labels(labels_dict, label_similarity_threshold, synonyms)
+            for raw_label, canonical in sorted(label_mapping.items()):
+                log_callback(f"【日誌】標籤正規化：'{raw_label}' -> '{canonical}'")
+            log_callback(f"【日誌】標籤正規化完成：合併 {len(label_mapping)} 個標籤，"
+                         f"目前共 {len(set(labels_dict.values()))} 個分類。")
+            save_canonical_labels(label_folder, labels_dict, label_mapping, log_callback)
+        else:
+            save_canonical_labels(label_folder, None, None, log_callback)
+
+        # 2. 執行合併
+        merge_success = perform_merging(
+            labels_dict=labels_dict,
+            transcription_folder=transcription_folder,
+            output_queue_folder=output_queue_folder,
+            unpaired_folder=unpaired_folder,
+            merging_strategy=merging_strategy,
+            log_callback=log_callback,
+            content_cache=content_cache,
+            io_workers=merge_io_workers,
+            target_group_tokens=merge_target_group_tokens,
+            incremental=incremental,
+            passthrough=merge_passthrough,
+            allow_hardlink=merge_allow_hardlink,
+            content_hashes=content_hashes
+        )
 
-    # 2. 執行合併
-    merge_success = perform_merging(
-        labels_dict=labels_dict,
-        transcription_folder=transcription_folder,
-        output_queue_folder=output_queue_folder,
-        unpaired_folder=unpaired_folder,
-        merging_strategy=merging_strategy,
-        log_callback=log_callback
-    )
+        if not merge_success:
+             log_callback("【錯誤】合併步驟執行過程中發生錯誤。")
+             # 即使合併出錯，分類可能已成功，所以仍回傳 False 表示流程未完全成功
 
-    if not merge_success:
-         log_callback("【錯誤】合併步驟執行過程中發生錯誤。")
-         # 即使合併出錯，分類可能已成功，所以仍回傳 False 表示流程未完全成功
+        # 3. 分類與合併都已讀過 DOCX，清除已刪除或已修改的檔案留下的擷取快取 (依本次已計算的雜湊，不重新讀取)
+        prune_docx_text_cache(transcription_folder, log_callback, content_hashes.values())
 
-    log_callback("--- Step 2/3 處理流程結束 ---")
-    return merge_success # 回傳合併步驟的結果
+        log_callback("--- Step 2/3 處理流程結束 ---")
+        return merge_success # 回傳合併步驟的結果
+    finally:
+        log_callback(f"【日誌】內容快取：{content_cache.stats_text()}")
+        content_cache.close()
 
 # --- 可選：用於測試的區塊 ---
 if __name__ == "__main__":
@@ -94,6 +166,7 @@ if __name__ == "__main__":
 
     # --- 選擇測試條件 ---
     # test_criteria = "教學/示範 & 長度 (需 API)"
+    # test_criteria = "教學/示範 (長度本地判斷，需 API)"
     # test_criteria = "主要內容主題 (需 API)"
     test_criteria = "影片長度 (無需 API)"
 
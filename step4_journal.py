@@ -0,0 +1,102 @@
+# step4_journal.py
+# Step4 的進度日誌 (append-only JSON Lines)：每個檔案完成時立即追加一筆記錄，中斷後可從上次進度繼續
+import os
+import json
+import time
+import threading
+
+from file_utils import atomic_write_text
+
+# 日誌存放在 HTML 輸出資料夾內
+JOURNAL_FILENAME = "_step4_journal.jsonl"
+
+
+class Step4Journal:
+    """
+    記錄每個已完成的檔案：輸入內容雜湊、輸出路徑、模型、Prompt 雜湊與其他設定的雜湊。
+
+    每筆記錄以單次 write 追加一整行並 fsync，寫到一半中斷時最多只損失最後一行 (讀取時略過無法解析的行)。
+    同一個輸入檔以最後一筆記錄為準；compact() 會把日誌改寫成只剩最新記錄。記錄方法可在多個執行緒中呼叫。
+    影片的 processed 標記寫入 video_urls.json 後，記錄會標上 applied；completed_videos() 只回傳尚未寫入的記錄
+    (上次執行在寫入前中斷)，使用者之後清除 processed 標記時不會再被日誌蓋回。
+    """
+
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self._entries = {} # 輸入檔名 -> 最新記錄
+        self._torn_tail = False # 上次中斷時最後一行沒寫完 (下一筆需先換行)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, output_folder, log_callback=print):
+        """讀取輸出資料夾中的日誌 (不存在時為空)"""
+        journal = cls(os.path.join(output_folder, JOURNAL_FILENAME))
+        try:
+            with open(journal.journal_path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return journal
+        except OSError as e:
+            log_callback(f"【警告】讀取 Step4 進度日誌失敗: {e}，將視為沒有已完成的記錄。")
+            return journal
+
+        skipped = 0
+        for line in lines:
+            try:
+                entry = json.loads(line)
+                journal._entries[entry["input"]] = entry
+            except (ValueError, KeyError, TypeError):
+                skipped += 1 # 中斷時寫到一半的行
+        journal._torn_tail = bool(lines) and not lines[-1].endswith("\n")
+        if skipped:
+            log_callback(f"【警告】Step4 進度日誌中有 {skipped} 行無法解析，已略過。")
+        return journal
+
+    def is_done(self, filename, input_hash, model, prompt_hash, settings_hash):
+        """輸入內容、模型、Prompt 與設定都與記錄相同，且輸出檔仍存在時回傳 True"""
+        with self._lock:
+            entry = self._entries.get(filename)
+        return (entry is not None and entry.get("input_hash") == input_hash and entry.get("model") == model
+                and entry.get("prompt_hash") == prompt_hash and entry.get("settings_hash") == settings_hash
+                and os.path.exists(entry.get("output", "")))
+
+    def record(self, filename, input_hash, output_path, model, prompt_hash, settings_hash, video_names):
+        """檔案完成後立即追加一筆記錄"""
+        entry = {"input": filename, "input_hash": input_hash, "output": os.path.abspath(output_path),
+                 "model": model, "prompt_hash": prompt_hash, "settings_hash": settings_hash,
+                 "videos": list(video_names), "finished_at": time.strftime("%Y-%m-%d %H:%M:%S")}
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._torn_tail:
+                line = "\n" + line
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._torn_tail = False
+            self._entries[filename] = entry
+
+    def completed_videos(self):
+        """尚未寫入 video_urls.json (applied) 且輸出檔仍存在的記錄所對應的影片名稱"""
+        with self._lock:
+            entries = list(self._entries.values())
+        return {name for entry in entries if not entry.get("applied") and os.path.exists(entry.get("output", ""))
+                for name in entry.get("videos", [])}
+
+    def compact(self, log_callback=print, mark_applied=False):
+        """
+        把日誌改寫成每個輸入檔只剩最新一筆 (輸出檔已不存在的記錄一併移除)。
+
+        mark_applied 為 True (processed 標記已寫入 video_urls.json) 時，所有記錄標上 applied。
+        """
+        with self._lock:
+            entries = [entry for entry in self._entries.values() if os.path.exists(entry.get("output", ""))]
+            if mark_applied:
+                for entry in entries:
+                    entry["applied"] = True
+            try:
+                atomic_write_text(self.journal_path,
+                                  "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries))
+                self._torn_tail = False
+            except OSError as e:
+                log_callback(f"【警告】整理 Step4 進度日誌失敗: {e}")
@@ -0,0 +1,142 @@
+# template_renderer.py
+# 本地 HTML 模板渲染：模板以具名區塊 (slot) 與欄位標記宣告可替換的位置，由程式直接填入，不需呼叫 AI
+#
+# 模板語法：
+#   <!-- slot:body -->預設內容<!-- /slot:body -->   具名區塊，可整段替換 (未提供內容時保留預設內容)
+#   {{course_title}}                                欄位，以模板自訂設定 (template_customizations) 的值取代
+#   {{logo_url|https://example.com/logo.png}}       欄位，設定值為空時使用 | 後面的預設值
+#
+# 區塊名稱：title、body、summary、video (Step4 會填入內容的區塊；其他名稱在解析時即報錯，
+# Logo、研習會、課程、頁尾等固定內容請改用欄位，例如 {{logo_url}}、{{footer_address}})。
+# 欄位值會做 HTML 跳脫；區塊內容 (內文、影片嵌入代碼) 是 HTML，原樣放入。
+import re
+import html
+import hashlib
+import threading
+from collections import OrderedDict
+
+SLOT_NAMES = ("title", "body", "summary", "video")
+
+_SLOT_PATTERN = re.compile(r"<!--\s*slot:(\w+)\s*-->(.*?)<!--\s*/slot:\1\s*-->", re.S)
+_FIELD_PATTERN = re.compile(r"\{\{\s*(\w+)\s*(?:\|(.*?))?\}\}", re.S)
+_HEADING_PATTERN = re.compile(r"^\s*#{1,6}\s+(.+?)\s*#*\s*$")
+
+# 標題行的長度上限 (超過就不當作標題)
+MAX_TITLE_LENGTH = 60
+
+# 編譯結果快取 (以模板內容雜湊為鍵)，同一模板只解析一次
+_COMPILED_CACHE_SIZE = 16
+_compiled_cache = OrderedDict()
+_compiled_cache_lock = threading.Lock()
+
+
+class TemplateSyntaxError(ValueError):
+    """模板的區塊標記不正確 (例如未知的區塊名稱或區塊重複)"""
+
+
+def _compile_fields(text):
+    """將文字拆成 [("text", 字串) | ("field", 名稱, 預設值), ...]"""
+    segments = []
+    position = 0
+    for match in _FIELD_PATTERN.finditer(text):
+        if match.start() > position:
+            segments.append(("text", text[position:match.start()]))
+        segments.append(("field", match.group(1), match.group(2) or ""))
+        position = match.end()
+    if position < len(text):
+        segments.append(("text", text[position:]))
+    return segments
+
+
+class CompiledTemplate:
+    """已解析的模板：依序由固定文字、欄位與區塊組成，渲染時只做字串串接"""
+
+    def __init__(self, template_text):
+        self.segments = []
+        self.slots = set()
+        position = 0
+        for match in _SLOT_PATTERN.finditer(template_text):
+            name = match.group(1)
+            if name not in SLOT_NAMES:
+                raise TemplateSyntaxError(f"未知的模板區塊名稱: {name} (可用: {', '.join(SLOT_NAMES)}；"
+                                          f"固定內容請改用 {{{{欄位名稱}}}} 欄位)")
+            if name in self.slots:
+                raise TemplateSyntaxError(f"模板區塊重複: {name}")
+            self.slots.add(name)
+            self.segments.extend(_compile_fields(template_text[position:match.start()]))
+            self.segments.append(("slot", name, _compile_fields(match.group(2))))
+            position = match.end()
+        self.segments.extend(_compile_fields(template_text[position:]))
+
+    def has_slot(self, name):
+        return name in self.slots
+
+    @staticmethod
+    def _render_fields(segments, fields, parts):
+        for segment in segments:
+            if segment[0] == "text":
+                parts.append(segment[1])
+            else:
+                _, name, default = segment
+                value = fields.get(name)
+                parts.append(html.escape(str(value)) if value else default)
+
+    def render(self, slots=None, fields=None):
+        """
+        渲染模板。
+
+        Args:
+            slots (dict): {區塊名稱: HTML}；未提供 (或為 None) 的區塊保留模板中的預設內容，空字串表示移除該區塊。
+            fields (dict): {欄位名稱: 值}；值為空時使用欄位預設值。
+
+        Returns:
+            str: 完整 HTML。
+        """
+        slots = slots or {}
+        fields = fields or {}
+        parts = []
+        for segment in self.segments:
+            if segment[0] == "slot":
+                _, name, default_segments = segment
+                if slots.get(name) is not None:
+                    parts.append(slots[name])
+                else:
+                    self._render_fields(default_segments, fields, parts)
+            else:
+                self._render_fields([segment], fields, parts)
+        return "".join(parts)
+
+
+def compile_template(template_text):
+    """解析模板 (相同內容只解析一次)"""
+    key = hashlib.sha256(template_text.encode('utf-8')).hexdigest()
+    with _compiled_cache_lock:
+        compiled = _compiled_cache.get(key)
+        if compiled is not None:
+            _compiled_cache.move_to_end(key)
+            return compiled
+    compiled = CompiledTemplate(template_text)
+    with _compiled_cache_lock:
+        _compiled_cache[key] = compiled
+        while len(_compiled_cache) > _COMPILED_CACHE_SIZE:
+            _compiled_cache.popitem(last=False)
+    return compiled
+
+
+def extract_title(text, fallback):
+    """
+    從改寫後的文字取出標題：第一行是 Markdown 標題 (# ...) 或夠短的單獨一行時當作標題。
+
+    Returns:
+        tuple: (標題, 去掉標題行後的內文)；找不到標題時回傳 (fallback, 原文)。
+    """
+    lines = text.strip().split("\n")
+    first_line = lines[0].strip() if lines else ""
+    heading = _HEADING_PATTERN.match(first_line)
+    if heading:
+        title = heading.group(1).strip()
+    elif first_line and len(first_line) <= MAX_TITLE_LENGTH and len(lines) > 1 and not lines[1].strip():
+        title = first_line.strip("*").strip()
+    else:
+        return fallback, text
+    return title, "\n".join(lines[1:]).strip()
@@ -0,0 +1,152 @@
+# tests/test_gemini_stream.py
+# 以本地 HTTP 服務模擬 Gemini streamGenerateContent (SSE)，測試串流接收、暫存檔提交與中斷處理
+#
+# 執行：python -m unittest discover tests
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api_retry import RetryPolicy, CircuitBreaker
+import api_retry
+import gemini_stream
+from gemini_stream import stream_generate_content, StreamError, partial_path, PARTIAL_FOLDER_NAME
+
+
+def _sse_event(text, finish_reason=None):
+    candidate = {"content": {"parts": [{"text": text}]}}
+    event = {"candidates": [candidate]}
+    if finish_reason:
+        candidate["finishReason"] = finish_reason
+        event["usageMetadata"] = {"promptTokenCount": 10, "candidatesTokenCount": 7}
+    return b"data: " + json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\r\n\r\n"
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    """依 server.scenario 回傳串流：complete = 正常結束；cut = 送出兩段後斷線；no_finish = 沒有 finishReason"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.paths.append(self.path)
+        scenario = self.server.scenario
+        if scenario == "error":
+            self.send_response(400)
+            self.end_headers()
+            self.wfile.write(b'{"error": "bad request"}')
+            return
+        self.send_response(200)
+        # 刻意不標示 charset (與 Gemini 相同)，requests 會猜成 ISO-8859-1
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        pieces = ["# 標題\n\n", "第一段\n", "第二段"]
+        for index, piece in enumerate(pieces):
+            if scenario == "cut" and index == 2:
+                self.wfile.flush()
+                self.connection.shutdown(2)
+                return
+            last = index == len(pieces) - 1
+            self.wfile.write(_sse_event(piece, "STOP" if last and scenario == "complete" else None))
+            self.wfile.flush()
+
+
+class StreamGenerateContentTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), _StandInHandler)
+        cls.server.scenario = "complete"
+        cls.server.paths = []
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.endpoint = (f"http://127.0.0.1:{cls.server.server_port}/v1beta/models/test-model"
+                        f":streamGenerateContent?alt=sse&key=test")
+        # 不重試、不共用全域斷路器，測試結果不受其他呼叫影響
+        cls._defaults = (api_retry.DEFAULT_RETRY_POLICY, api_retry.DEFAULT_CIRCUIT_BREAKER)
+        api_retry.DEFAULT_RETRY_POLICY = RetryPolicy(max_attempts=1)
+        api_retry.DEFAULT_CIRCUIT_BREAKER = CircuitBreaker()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        api_retry.DEFAULT_RETRY_POLICY, api_retry.DEFAULT_CIRCUIT_BREAKER = cls._defaults
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.logs = []
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _stream(self, scenario, commit_path=None):
+        self.server.scenario = scenario
+        part = partial_path(self.folder, "A.html")
+        return part, stream_generate_content(self.endpoint, {"contents": []}, part, self.logs.append,
+                                             commit_path=commit_path, timeout=10, progress_interval=0)
+
+    def test_complete_stream_is_committed(self):
+        commit_path = os.path.join(self.folder, "A.html")
+        part, (text, usage) = self._stream("complete", commit_path)
+        self.assertEqual(text, "# 標題\n\n第一段\n第二段") # UTF-8 解碼正確
+        self.assertEqual(usage["candidatesTokenCount"], 7)
+        with open(commit_path, encoding="utf-8") as f:
+            self.assertEqual(f.read(), text)
+        self.assertFalse(os.path.exists(part))
+        self.assertTrue(any("串流生成中" in line for line in self.logs))
+
+    def test_partial_files_stay_out_of_output_folder(self):
+        part = partial_path(self.folder, "A.html")
+        self.assertEqual(os.path.dirname(part), os.path.join(self.folder, PARTIAL_FOLDER_NAME))
+
+    def test_cut_stream_keeps_partial_content(self):
+        with self.assertRaises(StreamError) as context:
+            self._stream("cut", os.path.join(self.folder, "A.html"))
+        partial = context.exception.partial_path
+        self.assertIsNotNone(partial)
+        with open(partial, encoding="utf-8") as f:
+            self.assertEqual(f.read(), "# 標題\n\n第一段\n")
+        self.assertFalse(os.path.exists(os.path.join(self.folder, "A.html")))
+
+    def test_stream_without_finish_reason_is_incomplete(self):
+        with self.assertRaises(StreamError) as context:
+            self._stream("no_finish")
+        self.assertIn("未正常結束", str(context.exception))
+        self.assertIsNotNone(context.exception.partial_path)
+
+    def test_error_status_leaves_no_partial(self):
+        with self.assertRaises(StreamError) as context:
+            self._stream("error")
+        self.assertIn("400", str(context.exception))
+        self.assertEqual(os.listdir(os.path.join(self.folder, PARTIAL_FOLDER_NAME)), [])
+
+    def test_only_transient_failures_are_marked(self):
+        # 模型路由只在暫時性失敗時改用備援模型：400 不標記，串流中斷才標記
+        api_retry.clear_transient_failure()
+        with self.assertRaises(StreamError):
+            self._stream("error")
+        self.assertFalse(api_retry.had_transient_failure())
+        with self.assertRaises(StreamError):
+            self._stream("cut")
+        self.assertTrue(api_retry.had_transient_failure())
+
+    def test_progress_counts_each_chunk_once(self):
+        calls = []
+        original = gemini_stream.estimate_tokens
+        gemini_stream.estimate_tokens = lambda text: calls.append(text) or original(text)
+        try:
+            self._stream("complete")
+        finally:
+            gemini_stream.estimate_tokens = original
+        self.assertEqual(calls, ["# 標題\n\n", "第一段\n", "第二段"])
+
+
+if __name__ == "__main__":
+    unittest.main()
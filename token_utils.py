@@ -0,0 +1,66 @@
+# token_utils.py
+# 本地 token 估算與轉錄稿節錄工具 (不需呼叫 API)
+import re
+
+# Step1 產生的轉錄稿格式：標頭 (檔名、影片長度) + 分隔線 + 轉錄內容
+TRANSCRIPT_BODY_MARKER = "---------------\n轉錄內容：\n"
+
+EXCERPT_STRATEGIES = ["head", "head_tail", "head_middle_tail"]
+EXCERPT_GAP_MARKER = "\n……(中略)……\n"
+
+# 中日韓文字大約 1 字 1 token；其他文字以約 4 字元 1 token 估算
+_CJK_PATTERN = re.compile("[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿＀-￯]")
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def estimate_tokens(text):
+    """粗估文字的 token 數量 (偏保守，用於預算控制而非計費)"""
+    if not text:
+        return 0
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    other_count = len(_WHITESPACE_PATTERN.sub("", text)) - cjk_count
+    return cjk_count + (other_count + 3) // 4
+
+
+def split_transcript_header(text):
+    """將轉錄稿拆成 (標頭, 內文)；找不到分隔線時標頭為空字串"""
+    index = text.find(TRANSCRIPT_BODY_MARKER)
+    if index == -1:
+        return "", text
+    split_at = index + len(TRANSCRIPT_BODY_MARKER)
+    return text[:split_at], text[split_at:]
+
+
+def excerpt_transcript(text, max_tokens, strategy="head_middle_tail"):
+    """
+    依 token 預算節錄轉錄稿，保留完整標頭 (含影片長度)，內文依策略取樣。
+
+    Args:
+        text (str): 完整轉錄稿。
+        max_tokens (int): 節錄後內文的估計 token 上限；0 或 None 表示不節錄。
+        strategy (str): "head" (開頭)、"head_tail" (頭尾)、"head_middle_tail" (頭、中、尾)。
+
+    Returns:
+        str: 節錄後的文字 (未超過預算時原樣回傳)。
+    """
+    if not max_tokens or strategy not in EXCERPT_STRATEGIES:
+        return text
+
+    header, body = split_transcript_header(text)
+    body_tokens = estimate_tokens(body)
+    if body_tokens <= max_tokens:
+        return text
+
+    # 以內文的平均 token 密度將預算換算成字元數
+    chars_budget = max(1, int(len(body) * max_tokens / body_tokens))
+    if strategy == "head":
+        samples = [body[:chars_budget]]
+    elif strategy == "head_tail":
+        half = chars_budget // 2
+        samples = [body[:half], body[len(body) - half:]]
+    else:
+        third = chars_budget // 3
+        middle_start = (len(body) - third) // 2
+        samples = [body[:third], body[middle_start:middle_start + third], body[len(body) - third:]]
+
+    return header + EXCERPT_GAP_MARKER.join(sample.strip() for sample in samples)
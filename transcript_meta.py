@@ -0,0 +1,58 @@
+# transcript_meta.py
+# 轉錄稿的結構化中繼資料 (sidecar)：Step1 寫入，後續步驟讀取，免去以正則解析全文標頭
+import os
+
+from file_utils import atomic_write_json, load_json
+
+# 與轉錄稿同名的 sidecar，例如 "01 課程.txt" -> "01 課程.meta.json"
+META_SUFFIX = ".meta.json"
+META_VERSION = 1
+
+
+def meta_path_for(transcript_path):
+    """取得轉錄稿對應的 sidecar 路徑"""
+    return os.path.splitext(transcript_path)[0] + META_SUFFIX
+
+
+def write_transcript_meta(transcript_path, duration, model, segment_count, language, content_hash):
+    """
+    寫入轉錄稿的 sidecar。
+
+    Args:
+        transcript_path (str): 已寫入的轉錄稿路徑 (用來記錄大小與修改時間以便判斷是否過期)。
+        duration (float): 影片長度 (秒)。
+        model (str): 使用的 Whisper 模型。
+        segment_count (int): Whisper 回傳的段落數。
+        language (str): 轉錄語言。
+        content_hash (str): 轉錄稿檔案內容的 SHA-256。
+    """
+    stat = os.stat(transcript_path)
+    atomic_write_json(meta_path_for(transcript_path), {
+        "version": META_VERSION,
+        "duration": round(duration, 2),
+        "model": model,
+        "segment_count": segment_count,
+        "language": language,
+        "content_hash": content_hash,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    })
+
+
+def load_transcript_meta(transcript_path):
+    """
+    讀取轉錄稿的 sidecar。
+
+    只看 sidecar 與轉錄稿的 stat，不讀轉錄稿內容；若 sidecar 不存在、格式不符，
+    或轉錄稿在寫入 sidecar 後被修改 (大小或修改時間不同)，回傳 None。
+    """
+    meta = load_json(meta_path_for(transcript_path))
+    if not isinstance(meta, dict) or meta.get("version") != META_VERSION:
+        return None
+    try:
+        stat = os.stat(transcript_path)
+    except OSError:
+        return None
+    if stat.st_size != meta.get("size") or stat.st_mtime_ns != meta.get("mtime_ns"):
+        return None
+    return meta
@@ -0,0 +1,70 @@
+# video_index.py
+# video_urls.json 的正規化索引：每次執行建立一次，合併檔名 (a+b) 的每一段都能以 O(1) 找到對應影片
+import re
+import unicodedata
+
+# 檔名開頭的序號，例如 "02 "、"01-02 "、"3_"、"12." (rename_files.py 會在既有序號前再加一層)
+_NUMERIC_PREFIX_PATTERN = re.compile(r"^\d+(?:[-_.]\d+)*[\s._-]*")
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize_video_name(name):
+    """比對用的影片名稱：NFKC (全形轉半形)、英文小寫、連續空白合併為一個"""
+    text = unicodedata.normalize("NFKC", name).lower()
+    return _WHITESPACE_PATTERN.sub(" ", text).strip()
+
+
+def strip_numeric_prefix(normalized_name):
+    """去除開頭序號；整個名稱都是序號時維持原樣"""
+    stripped = _NUMERIC_PREFIX_PATTERN.sub("", normalized_name)
+    return stripped or normalized_name
+
+
+class VideoUrlIndex:
+    """
+    video_urls.json 鍵值的查詢索引。
+
+    先以正規化後的完整名稱比對，找不到時再以去除序號後的名稱比對；
+    去除序號後有多個影片同名時該名稱不列入索引 (避免配錯影片)。
+    group_members ({檔名: [來源檔名, ...]}) 提供檔名本身無法拆出來源的合併檔 (例如 Step3 以雜湊命名的分組) 的來源清單。
+    """
+
+    def __init__(self, video_urls_data, group_members=None):
+        self.video_urls_data = video_urls_data
+        self.group_members = group_members or {}
+        self._by_name = {}
+        self._by_title = {}
+        ambiguous_titles = set()
+        for key in video_urls_data:
+            normalized = normalize_video_name(key)
+            self._by_name.setdefault(normalized, key)
+            title = strip_numeric_prefix(normalized)
+            if title in self._by_title and self._by_title[title] != key:
+                ambiguous_titles.add(title)
+            else:
+                self._by_title[title] = key
+        for title in ambiguous_titles:
+            del self._by_title[title]
+
+    def lookup(self, name):
+        """回傳 video_urls.json 中對應的鍵，找不到時回傳 None"""
+        normalized = normalize_video_name(name)
+        key = self._by_name.get(normalized)
+        if key is None:
+            key = self._by_title.get(strip_numeric_prefix(normalized))
+        return key
+
+    def videos_for(self, base_name):
+        """
+        合併檔名 (以 '+' 連接各來源) 中每一段對應的影片鍵，依出現順序且不重複；
+        檔名列在 group_members 中時改用其中的來源清單。
+        """
+        keys = []
+        components = self.group_members.get(base_name) or base_name.split("+")
+        for component in components:
+            if not component.strip():
+                continue
+            key = self.lookup(component)
+            if key is not None and key not in keys:
+                keys.append(key)
+        return keys